@@ -1,23 +1,83 @@
 import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 import importlib
 import os
 from typing import List
 from uuid import uuid4
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse
 from sqlalchemy import select
 from starlette.middleware.cors import CORSMiddleware
 
-from apps.main.models import Base
-from apps.main.routes import router as main_router
-from database import engine
+from apps.main.models import Base, get_changes_since, get_project_haikus_page, get_project_seq
+from apps.main.routes import router as main_router, schedule_change_feed_pruning
+from database import warm_up_pool
+from eventbus import event_bus
+from imagederivatives import shutdown_derivative_pool
+from jobs import JobWorker
+from llm import get_llm_client
+from logarchive import get_chain_logs, schedule_log_compaction
+from logsink import llm_log_sink
 from logger import logger
 from config import settings
+from migrate import run_migrations
+from metrics import registry
+from tracing import MemorySpanExporter, trace_id_for_chain, tracer
 
-app = FastAPI()
+
+async def warm_up():
+    ''' Open pooled db connections, run the dashboard's hot queries once and build the LLM client '''
+    started_at = asyncio.get_running_loop().time()
+    try:
+        await warm_up_pool(settings.startup_warmup_db_connections)
+        # project 0 doesn't exist, this only compiles (and caches) the statements
+        await get_project_seq(0)
+        await get_changes_since(0, 0)
+        await get_project_haikus_page(0)
+        await asyncio.to_thread(get_llm_client)
+    except Exception as e:
+        logger.error(f"[warm_up] failed: {e}", exc_info=True)
+        return
+    logger.info(f"[warm_up] done in {asyncio.get_running_loop().time() - started_at:.2f}s")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create / migrate tables if using SQLite
+    if settings.db_engine_url.startswith("sqlite"):
+        await asyncio.to_thread(run_migrations)
+        logger.info("SQLite database tables created/updated.")
+
+    await event_bus.start()
+    await llm_log_sink.start()
+    await tracer.start()
+
+    if settings.jobs_run_in_app:
+        app.state.job_worker = JobWorker(settings.jobs_worker_concurrency)
+        await app.state.job_worker.start()
+    await schedule_log_compaction()
+    await schedule_change_feed_pruning()
+
+    # not awaited: requests are served while it runs
+    warm_up_task = asyncio.create_task(warm_up()) if settings.startup_warmup else None
+
+    yield
+
+    if warm_up_task:
+        warm_up_task.cancel()
+    if settings.jobs_run_in_app:
+        await app.state.job_worker.stop()
+    await llm_log_sink.stop()
+    await event_bus.stop()
+    await tracer.stop()
+    shutdown_derivative_pool()
+
+
+# handlers' return values are serialized with orjson rather than the stdlib encoder
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Allow CORS for the frontend
 app.add_middleware(
@@ -31,12 +91,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create tables if using SQLite
-@app.on_event("startup")
-async def startup_event():
-    if settings.db_engine_url.startswith("sqlite"):
-        Base.metadata.create_all(bind=engine)
-        logger.info("SQLite database tables created/updated.")
+@app.get("/metrics")
+async def metrics():
+    """ Prometheus text format. Each worker process keeps its own metrics """
+    return PlainTextResponse(await registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/traces/{chain_id}")
+async def get_trace(chain_id: str):
+    """ A chain's spans, oldest first. Only with the memory exporter, and only what this process recorded """
+    if not isinstance(tracer.exporter, MemorySpanExporter):
+        raise HTTPException(status_code=400, detail="Traces are only kept in memory with TRACING_EXPORTER=memory")
+    await tracer.flush()
+    spans = tracer.exporter.get_trace(trace_id_for_chain(chain_id))
+    if not spans:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return [span.to_dict() for span in spans]
+
+
+@app.get("/llm-logs/{chain_id}")
+async def get_llm_logs(chain_id: str):
+    """ A chain's inference logs, oldest first, including the ones already archived (`"archived": true`) """
+    return await get_chain_logs(chain_id)
 
 
 app.include_router(main_router, prefix='/projects', tags=['projects'])
@@ -0,0 +1,155 @@
+import asyncio
+from contextlib import AsyncExitStack
+
+from config import settings
+from eventbus import event_bus, project_channel
+from logger import logger
+from tracing import tracer
+from wire import WireFormat, encode_off_loop, get_wire_format
+
+from .models import get_changes_since, get_project_seq, get_project_snapshot
+
+
+# Markers a broadcaster puts on a subscriber's queue instead of a (seq, text) message.
+RESYNC = 'resync'            # the subscriber fell behind, it should fetch a fresh snapshot
+DISCONNECT = 'disconnect'    # the subscriber fell behind, it should be closed
+
+
+class DashboardSubscriber:
+    def __init__(self, websocket, snapshot_mode: str = "full", wire_format: WireFormat = None):
+        self.websocket = websocket
+        self.snapshot_mode = snapshot_mode
+        self.wire_format = wire_format or get_wire_format('json')
+        self.queue = asyncio.Queue(maxsize=settings.dashboard_subscriber_queue_size)
+
+    def push(self, message):
+        ''' `message` is (seq, encoded), with a seq of None for ephemeral messages like partials '''
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # Drop what's queued, the marker tells the socket how to recover.
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            marker = DISCONNECT if settings.dashboard_slow_consumer_policy == 'disconnect' else RESYNC
+            logger.warning(f"[DashboardSubscriber] slow consumer, sending {marker}")
+            self.queue.put_nowait(marker)
+
+
+class ProjectBroadcaster:
+    '''
+    One per watched project. Listens for the project's events, debounces bursts of them,
+    fetches and encodes the new deltas once per wire format in use, and fans the encoded
+    messages out to every subscribed dashboard socket.
+    '''
+
+    def __init__(self, project_id: int):
+        self.project_id = project_id
+        self.subscribers = set()
+        self.seq = 0
+        self.exit_stack = AsyncExitStack()
+        self.task = None
+
+    async def start(self):
+        # Subscribe before reading the feed position, so no change lands in between unnoticed.
+        events = await self.exit_stack.enter_async_context(event_bus.subscribe(project_channel(self.project_id)))
+        self.seq = await get_project_seq(self.project_id)
+        self.task = asyncio.create_task(self.run(events))
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        await self.exit_stack.aclose()
+
+    async def run(self, events):
+        while True:
+            received = [await events.get()]
+            # Let the rest of a burst (e.g. parallel image prompts finishing) arrive, then push once.
+            await asyncio.sleep(settings.dashboard_debounce_ms / 1000)
+            while not events.empty():
+                received.append(events.get_nowait())
+
+            # Partials aren't in the change feed, they ride along on the event itself.
+            # Only the latest one per stream is worth sending.
+            partials = {event["partial"]["stream_id"]: event["partial"] for event in received if "partial" in event}
+            for partial in partials.values():
+                encoded = self.encode({"type": "partial", **partial})
+                for subscriber in list(self.subscribers):
+                    subscriber.push((None, encoded[subscriber.wire_format.name]))
+
+            if all("partial" in event for event in received):
+                continue
+
+            # one push can serve several chains, each gets a span for it in its own trace
+            contexts = {event["trace"]["span_id"]: event["trace"] for event in received if event.get("trace")}
+            spans = [
+                tracer.start_span("dashboard.broadcast", parent=context, project_id=self.project_id, subscribers=len(self.subscribers))
+                for context in contexts.values()
+            ]
+            try:
+                await self.broadcast()
+            except Exception as e:
+                logger.error(f"[ProjectBroadcaster] Error broadcasting project_id={self.project_id}: {e}", exc_info=True)
+                for span in spans:
+                    span.error = repr(e)
+            for span in spans:
+                tracer.end_span(span)
+
+    def encode(self, data) -> dict:
+        ''' wire format name -> `data` encoded in it, for each format the subscribers use '''
+        return {wire_format.name: wire_format.encode(data) for wire_format in {subscriber.wire_format for subscriber in self.subscribers}}
+
+    async def broadcast(self):
+        changes = await get_changes_since(self.project_id, self.seq)
+        if changes is None:
+            # Too far behind for deltas: one snapshot per mode the subscribers asked for.
+            snapshots = {}
+            for mode, wire_format in {(subscriber.snapshot_mode, subscriber.wire_format) for subscriber in self.subscribers}:
+                if mode not in snapshots:
+                    snapshots[mode] = (await get_project_snapshot(self.project_id, mode), {})
+                snapshot, encoded = snapshots[mode]
+                encoded[wire_format.name] = await encode_off_loop(wire_format, snapshot)
+                self.seq = snapshot["seq"]
+            for subscriber in list(self.subscribers):
+                if subscriber.snapshot_mode in snapshots:
+                    snapshot, encoded = snapshots[subscriber.snapshot_mode]
+                    subscriber.push((snapshot["seq"], encoded[subscriber.wire_format.name]))
+            return
+
+        if not changes:
+            return
+
+        messages = [(change["seq"], self.encode(change)) for change in changes]
+        self.seq = messages[-1][0]
+        logger.info(f"[ProjectBroadcaster] sending {len(messages)} messages to {len(self.subscribers)} dashboards for project_id={self.project_id}")
+        for subscriber in list(self.subscribers):
+            for seq, encoded in messages:
+                subscriber.push((seq, encoded[subscriber.wire_format.name]))
+
+
+broadcasters = {}
+broadcasters_lock = asyncio.Lock()
+
+
+async def subscribe_dashboard(project_id: int, websocket, snapshot_mode: str = "full", wire_format: WireFormat = None) -> DashboardSubscriber:
+    subscriber = DashboardSubscriber(websocket, snapshot_mode, wire_format)
+    async with broadcasters_lock:
+        if project_id not in broadcasters:
+            broadcaster = ProjectBroadcaster(project_id)
+            await broadcaster.start()
+            broadcasters[project_id] = broadcaster
+        broadcasters[project_id].subscribers.add(subscriber)
+    return subscriber
+
+
+async def unsubscribe_dashboard(project_id: int, subscriber: DashboardSubscriber):
+    async with broadcasters_lock:
+        broadcaster = broadcasters.get(project_id)
+        if not broadcaster:
+            return
+        broadcaster.subscribers.discard(subscriber)
+        if not broadcaster.subscribers:
+            del broadcasters[project_id]
+            await broadcaster.stop()
@@ -1,3 +1,5 @@
+import asyncio
+import base64
 import datetime
 import uuid
 
@@ -11,13 +13,18 @@ from sqlalchemy import (
     DateTime,
     JSON,
     Boolean,
+    Index,
     create_engine
 )
-from sqlalchemy.orm import relationship, joinedload
+from sqlalchemy import select, delete, update, func, or_, and_
+from sqlalchemy.orm import relationship, joinedload, selectinload
 from sqlalchemy.ext.declarative import declarative_base
 
+from blobstore import blob_store, guess_mime_type
 from config import settings
-from database import get_session
+from database import get_session, get_async_session
+from imagederivatives import generate_derivatives
+from tracing import traced
 
 
 Base = declarative_base()
@@ -35,8 +42,17 @@ class LLMLogTable(Base):
     response = Column(JSON, nullable=True)
     answer = Column(Text, nullable=True)
     success = Column(Boolean, default=False)
+    cache_key = Column(String, nullable=True)  # hash of the request, see llmcache.get_cache_key
+    cache_hit = Column(Boolean, default=False) # answered from the response cache, `response` points at the source log
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
+    __table_args__ = (
+        Index('ix_ai_llm_logs_chain_id_created_at', 'chain_id', 'created_at'),
+        Index('ix_ai_llm_logs_name_created_at', 'name', 'created_at'),
+        Index('ix_ai_llm_logs_cache_key_created_at', 'cache_key', 'created_at'),
+        Index('ix_ai_llm_logs_created_at', 'created_at'),
+    )
+
 
 class ProjectTable(Base):
     ''' This holds our project data '''
@@ -45,11 +61,16 @@ class ProjectTable(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     uuid = Column(String, default=lambda: str(uuid.uuid4()))
     name = Column(String)
+    change_seq = Column(Integer, nullable=False, default=0, server_default='0')  # the change feed's latest seq, see `record_change`
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     
     haikus = relationship('HaikuTable', back_populates='project')
 
+    __table_args__ = (
+        Index('ix_ai_project_uuid', 'uuid', unique=True),
+    )
+
 
 class HaikuTable(Base):
     ''' This holds our haiku data '''
@@ -65,6 +86,10 @@ class HaikuTable(Base):
     project = relationship('ProjectTable', back_populates='haikus')
     image_prompts = relationship('HaikuImagePromptTable', back_populates='haiku')
 
+    __table_args__ = (
+        Index('ix_ai_haiku_project_id_created_at', 'project_id', 'created_at'),
+    )
+
 
 class HaikuImagePromptTable(Base):
     __tablename__ = 'ai_haiku_image_prompt'
@@ -77,70 +102,341 @@ class HaikuImagePromptTable(Base):
     haiku = relationship('HaikuTable', back_populates='image_prompts')
     images = relationship('HaikuImageTable', back_populates='image_prompt')
 
+    __table_args__ = (
+        Index('ix_ai_haiku_image_prompt_haiku_id_created_at', 'haiku_id', 'created_at'),
+    )
+
 
 class HaikuImageTable(Base):
     __tablename__ = 'ai_haiku_image'
     
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     haiku_image_prompt_id = Column(String, ForeignKey('ai_haiku_image_prompt.id'))
-    image_b64 = Column(Text, nullable=False)
+    blob_hash = Column(String(64), nullable=False)  # sha256 of the image bytes, see blobstore.py
+    size = Column(Integer, nullable=False)
+    mime_type = Column(String, nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     
     image_prompt = relationship('HaikuImagePromptTable', back_populates='images')
+    derivatives = relationship('HaikuImageDerivativeTable', back_populates='image')
+
+    __table_args__ = (
+        Index('ix_ai_haiku_image_prompt_id_created_at', 'haiku_image_prompt_id', 'created_at'),
+    )
+
+
+class HaikuImageDerivativeTable(Base):
+    ''' A resized copy of a generated image, E.g. its webp thumbnail, see imagederivatives.py '''
+    __tablename__ = 'ai_haiku_image_derivative'
+
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    haiku_image_id = Column(String, ForeignKey('ai_haiku_image.id'), nullable=False)
+    variant = Column(String, nullable=False)  # a key of settings.image_derivative_sizes, E.g. "thumb"
+    format = Column(String, nullable=False)   # "webp" / "jpeg"
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    blob_hash = Column(String(64), nullable=False)
+    size = Column(Integer, nullable=False)
+    mime_type = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    image = relationship('HaikuImageTable', back_populates='derivatives')
+
+    __table_args__ = (
+        Index('ix_ai_haiku_image_derivative_variant', 'haiku_image_id', 'variant', 'format', unique=True),
+    )
+
+
+class ProjectChangeTable(Base):
+    ''' The per-project change feed that dashboards sync from, see `record_change` '''
+    __tablename__ = 'ai_project_change'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    project_id = Column(Integer, ForeignKey('ai_project.id'), nullable=False, index=True)
+    seq = Column(Integer, nullable=False)  # 1, 2, 3... within the project, allocated from ai_project.change_seq
+    kind = Column(String, nullable=False)  # E.g. "haiku_created", "image_saved"
+    data = Column(JSON, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_ai_project_change_project_id_seq', 'project_id', 'seq', unique=True),
+    )
+
+
+class JobTable(Base):
+    ''' The durable background job queue, see jobs.py '''
+    __tablename__ = 'ai_job'
+
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    name = Column(String, nullable=False)          # the registered handler, E.g. "process_haiku_critique"
+    payload = Column(JSON, nullable=False)         # keyword arguments for the handler
+    idempotency_key = Column(String, nullable=True, unique=True)
+    status = Column(String, nullable=False, default='queued')  # queued, running, succeeded, dead
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False)
+    run_after = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    locked_until = Column(DateTime, nullable=True) # while running; once passed, the job is up for grabs again
+    locked_by = Column(String, nullable=True)
+    result = Column(JSON, nullable=True)
+    last_error = Column(Text, nullable=True)
+    trace_context = Column(JSON, nullable=True)    # the span that queued the job, see tracing.py
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_ai_job_status_run_after', 'status', 'run_after'),
+    )
+
+
+class WorkflowStepTable(Base):
+    ''' A completed step of a workflow run, so a failed run can resume from it, see workflow.py '''
+    __tablename__ = 'ai_workflow_step'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    run_id = Column(String, nullable=False)     # also the chain_id of the run's inference calls
+    workflow = Column(String, nullable=False)
+    step = Column(String, nullable=False)
+    result = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_ai_workflow_step_run_id_step', 'run_id', 'step', unique=True),
+    )
+
+
+class LLMLogArchiveIndexTable(Base):
+    ''' Where a chain's archived ai_llm_logs rows are, one row per compressed frame, see logarchive.py '''
+    __tablename__ = 'ai_llm_log_archive_index'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chain_id = Column(String, nullable=False)
+    segment = Column(String, nullable=False)    # the day's segment file, relative to llm_log_archive_path
+    offset = Column(Integer, nullable=False)
+    length = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False)     # log rows in the frame
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_ai_llm_log_archive_index_chain_id', 'chain_id'),
+    )
+
+
+''' Serializers, shared by the dashboard snapshot and its deltas '''
+
+def serialize_haiku(haiku):
+    return {"id": haiku.id, "title": haiku.title, "text": haiku.text, "created_at": haiku.created_at.isoformat()}
+
+def serialize_image_prompt(prompt):
+    return {"id": prompt.id, "text": prompt.image_prompt}
+
+def serialize_image(image):
+    return {
+        "id": image.id,
+        "url": f"/projects/images/{image.id}",
+        # falls back to the original if the image has no thumbnail
+        "thumbnail_url": f"/projects/images/{image.id}?size=thumb",
+        "mime_type": image.mime_type,
+    }
+
+def serialize_critique(critique):
+    return {
+        "id": critique.id,
+        "creativity_score": critique.creativity_score,
+        "vocabulary_density": critique.vocabulary_density,
+        "rizz_level": critique.rizz_level,
+    }
 
 
 ''' Database interfaces '''
 
-def get_haiku_by_id(haiku_id):
+@traced("db.get_haiku_by_id")
+async def get_haiku_by_id(haiku_id):
     """ Fetch a Haiku by its ID, along with its Project ID """
-    with get_session() as session:
-        haiku = session.query(HaikuTable).filter(HaikuTable.id == haiku_id).first()
+    async with get_async_session() as session:
+        haiku = await session.scalar(select(HaikuTable).where(HaikuTable.id == haiku_id))
         return haiku and {column.name: getattr(haiku, column.name) for column in haiku.__table__.columns}
 
-def get_image_prompt_by_id(prompt_id):
+@traced("db.get_image_prompt_by_id")
+async def get_image_prompt_by_id(prompt_id):
     """ Fetch an Image Prompt by its ID """
-    with get_session() as session:
-        prompt = session.query(HaikuImagePromptTable).filter(HaikuImagePromptTable.id == prompt_id).first()
+    async with get_async_session() as session:
+        prompt = await session.scalar(select(HaikuImagePromptTable).where(HaikuImagePromptTable.id == prompt_id))
         return prompt and {column.name: getattr(prompt, column.name) for column in prompt.__table__.columns}
 
 
-def save_image_prompt(haiku_id: int, prompt_text: str):
+@traced("db.save_haiku")
+async def save_haiku(project_id: int, title: str, text: str, stream_id: str = None):
+    """ Store a new Haiku, returns its ID or None if the project doesn't exist """
+    async with get_async_session() as session:
+        project = await session.scalar(select(ProjectTable).where(ProjectTable.id == project_id))
+        if not project:
+            return None
+
+        new_haiku = HaikuTable(
+            project_id=project_id,
+            title=title,
+            text=text
+        )
+        session.add(new_haiku)
+        await session.flush()
+
+        await record_change(session, project_id, "haiku_created", {
+            "haiku": {**serialize_haiku(new_haiku), "image_prompts": [], "critiques": []},
+            "stream_id": stream_id,  # lets dashboards swap out the partial they were showing
+        })
+        await session.commit()
+        return new_haiku.id
+
+
+@traced("db.save_haiku_batch")
+async def save_haiku_batch(project_id: int, haikus: list):
+    """
+    Store many haikus in one transaction, each a dict of `title`, `text` and optionally a
+    `critique` (dict of scores) and `image_prompt` (text). Returns their IDs in order, or
+    None if the project doesn't exist
+    """
+    async with get_async_session() as session:
+        project = await session.scalar(select(ProjectTable).where(ProjectTable.id == project_id))
+        if not project:
+            return None
+
+        new_haikus = [HaikuTable(project_id=project_id, title=haiku["title"], text=haiku["text"]) for haiku in haikus]
+        session.add_all(new_haikus)
+        await session.flush()
+
+        for new_haiku, haiku in zip(new_haikus, haikus):
+            critiques = []
+            if haiku.get("critique"):
+                critiques.append(HaikuCritiqueTable(haiku_id=new_haiku.id, **haiku["critique"]))
+            image_prompts = []
+            if haiku.get("image_prompt"):
+                image_prompts.append(HaikuImagePromptTable(haiku_id=new_haiku.id, image_prompt=haiku["image_prompt"]))
+            session.add_all(critiques + image_prompts)
+            await session.flush()
+
+            await record_change(session, project_id, "haiku_created", {
+                "haiku": {
+                    **serialize_haiku(new_haiku),
+                    "image_prompts": [{**serialize_image_prompt(prompt), "images": []} for prompt in image_prompts],
+                    "critiques": [serialize_critique(critique) for critique in critiques],
+                },
+                "stream_id": None,
+            })
+
+        await session.commit()
+        return [new_haiku.id for new_haiku in new_haikus]
+
+
+@traced("db.save_image_prompt")
+async def save_image_prompt(haiku_id: int, prompt_text: str, stream_id: str = None):
     """ Store a new image prompt for a given Haiku """
-    with get_session() as session:
+    async with get_async_session() as session:
         new_prompt = HaikuImagePromptTable(
             haiku_id=haiku_id,
             image_prompt=prompt_text
         )
         session.add(new_prompt)
-        session.commit()
+        await session.flush()
+
+        project_id = await session.scalar(select(HaikuTable.project_id).where(HaikuTable.id == haiku_id))
+        await record_change(session, project_id, "image_prompt_saved", {
+            "haiku_id": haiku_id,
+            "image_prompt": {**serialize_image_prompt(new_prompt), "images": []},
+            "stream_id": stream_id,
+        })
+        await session.commit()
         return new_prompt.id
 
 
-def save_generated_image(prompt_id: str, base64_image: str):
-    """ Store a generated image in the database, linked to its image prompt """
-    with get_session() as session:
+async def get_image_by_id(image_id):
+    """ Fetch a generated image's blob reference by its ID """
+    async with get_async_session() as session:
+        image = await session.scalar(select(HaikuImageTable).where(HaikuImageTable.id == image_id))
+        return image and {column.name: getattr(image, column.name) for column in image.__table__.columns}
+
+
+async def get_image_derivative(image_id, variant, formats):
+    """ Fetch the blob reference of an image's `variant` in the first of `formats` it has, or None """
+    async with get_async_session() as session:
+        derivatives = (await session.scalars(
+            select(HaikuImageDerivativeTable)
+            .where(
+                HaikuImageDerivativeTable.haiku_image_id == image_id,
+                HaikuImageDerivativeTable.variant == variant,
+                HaikuImageDerivativeTable.format.in_(formats),
+            )
+        )).all()
+
+    by_format = {derivative.format: derivative for derivative in derivatives}
+    for image_format in formats:
+        if image_format in by_format:
+            derivative = by_format[image_format]
+            return {column.name: getattr(derivative, column.name) for column in derivative.__table__.columns}
+    return None
+
+
+@traced("db.save_generated_image")
+async def save_generated_image(prompt_id: str, image_bytes: bytes):
+    """ Store a generated image and its resized copies in the blob store, linked to its image prompt """
+    blob_hash = await asyncio.to_thread(blob_store.put, image_bytes)
+    derivatives = await generate_derivatives(image_bytes)
+    for derivative in derivatives:
+        derivative["blob_hash"] = await asyncio.to_thread(blob_store.put, derivative["data"])
+
+    async with get_async_session() as session:
         new_image = HaikuImageTable(
             haiku_image_prompt_id=prompt_id,
-            image_b64=base64_image
+            blob_hash=blob_hash,
+            size=len(image_bytes),
+            mime_type=guess_mime_type(image_bytes),
         )
         session.add(new_image)
-        session.commit()
+        await session.flush()
+
+        session.add_all([
+            HaikuImageDerivativeTable(
+                haiku_image_id=new_image.id,
+                variant=derivative["variant"],
+                format=derivative["format"],
+                width=derivative["width"],
+                height=derivative["height"],
+                blob_hash=derivative["blob_hash"],
+                size=len(derivative["data"]),
+                mime_type=derivative["mime_type"],
+            )
+            for derivative in derivatives
+        ])
+
+        haiku_id, project_id = (await session.execute(
+            select(HaikuTable.id, HaikuTable.project_id)
+            .join(HaikuImagePromptTable, HaikuImagePromptTable.haiku_id == HaikuTable.id)
+            .where(HaikuImagePromptTable.id == prompt_id)
+        )).one()
+        await record_change(session, project_id, "image_saved", {
+            "haiku_id": haiku_id,
+            "image_prompt_id": prompt_id,
+            "image": serialize_image(new_image),
+        })
+        await session.commit()
 
         return new_image.id  # Return the new image ID if needed
 
 
-def get_project_data(project_id):
+async def get_project_data(project_id):
     """ Fetch project data including haikus, image prompts, generated images, and critiques """
-    with get_session() as session:
-        project = (
-            session.query(ProjectTable)
+    async with get_async_session() as session:
+        # selectinload runs one IN query per level, instead of joining every level into one cartesian product
+        project = await session.scalar(
+            select(ProjectTable)
             .options(
-                joinedload(ProjectTable.haikus)
-                .joinedload(HaikuTable.image_prompts)
-                .joinedload(HaikuImagePromptTable.images)
+                selectinload(ProjectTable.haikus)
+                .selectinload(HaikuTable.image_prompts)
+                .selectinload(HaikuImagePromptTable.images),
+                selectinload(ProjectTable.haikus)
+                .selectinload(HaikuTable.critiques),
             )
-            .filter(ProjectTable.id == project_id)
-            .first()
+            .where(ProjectTable.id == project_id)
         )
 
         if not project:
@@ -151,26 +447,18 @@ def get_project_data(project_id):
             "name": project.name,
             "haikus": [
                 {
-                    "id": haiku.id,
-                    "title": haiku.title,
-                    "text": haiku.text,
-                    "created_at": haiku.created_at.isoformat(),
+                    **serialize_haiku(haiku),
                     "image_prompts": [
                         {
-                            "id": prompt.id,
-                            "text": prompt.image_prompt,
+                            **serialize_image_prompt(prompt),
                             "images": [
-                                {"id": img.id, "b64": img.image_b64} for img in sorted(prompt.images, key=lambda i: i.created_at, reverse=True)
+                                serialize_image(img) for img in sorted(prompt.images, key=lambda i: i.created_at, reverse=True)
                             ],
                         }
                         for prompt in sorted(haiku.image_prompts, key=lambda p: p.created_at, reverse=True)
                     ],
                     "critiques": [
-                        {
-                            "creativity_score": critique.creativity_score,
-                            "vocabulary_density": critique.vocabulary_density,
-                            "rizz_level": critique.rizz_level,
-                        }
+                        serialize_critique(critique)
                         for critique in sorted(haiku.critiques, key=lambda c: c.created_at, reverse=True)
                     ],
                 }
@@ -179,6 +467,218 @@ def get_project_data(project_id):
         }
 
 
+''' Dashboard change feed '''
+
+async def record_change(session, project_id: int, kind: str, data: dict):
+    """ Append a delta to a project's change feed, in the same transaction as the mutation it describes """
+    # The UPDATE holds the project's row lock until commit, so each project's changes commit in
+    # seq order: a reader never sees seq 11 while 10 is still in flight, and skips it for good.
+    seq = await session.scalar(
+        update(ProjectTable)
+        .where(ProjectTable.id == project_id)
+        .values(change_seq=ProjectTable.change_seq + 1)
+        .returning(ProjectTable.change_seq)
+        .execution_options(synchronize_session=False)
+    )
+    change = ProjectChangeTable(project_id=project_id, seq=seq, kind=kind, data=data)
+    session.add(change)
+    await session.flush()
+    return seq
+
+
+async def prune_change_feed() -> int:
+    """
+    Drop every project's deltas older than its latest `dashboard_feed_max_gap`, clients further
+    behind than that get a snapshot anyway. Runs as a periodic job rather than on every change.
+    """
+    async with get_async_session() as session:
+        result = await session.execute(
+            delete(ProjectChangeTable)
+            .where(ProjectChangeTable.seq <= (
+                select(ProjectTable.change_seq)
+                .where(ProjectTable.id == ProjectChangeTable.project_id)
+                .scalar_subquery() - settings.dashboard_feed_max_gap
+            ))
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+
+def serialize_change(change):
+    return {"type": "delta", "seq": change.seq, "kind": change.kind, "data": change.data, "created_at": change.created_at.isoformat()}
+
+
+async def get_changes_since(project_id: int, seq: int):
+    """ Fetch the deltas after `seq`, or None if the client is too far behind and needs a snapshot """
+    async with get_async_session() as session:
+        if seq > 0:
+            # `seq` is always one of this project's changes, if it was pruned we can't know what was missed.
+            seen = await session.scalar(
+                select(ProjectChangeTable.id)
+                .where(ProjectChangeTable.project_id == project_id, ProjectChangeTable.seq == seq)
+            )
+            if seen is None:
+                return None
+
+        changes = (await session.scalars(
+            select(ProjectChangeTable)
+            .where(ProjectChangeTable.project_id == project_id, ProjectChangeTable.seq > seq)
+            .order_by(ProjectChangeTable.seq)
+            .limit(settings.dashboard_feed_max_gap + 1)
+        )).all()
+
+        if len(changes) > settings.dashboard_feed_max_gap:
+            return None
+        return [serialize_change(change) for change in changes]
+
+
+async def get_project_seq(project_id: int):
+    """ The project's latest change feed position, 0 if it has no changes yet """
+    async with get_async_session() as session:
+        seq = await session.scalar(select(ProjectTable.change_seq).where(ProjectTable.id == project_id))
+        return seq or 0
+
+
+async def get_project_snapshot(project_id: int, mode: str = "full"):
+    """
+    The project, tagged with the feed position it reflects. In "full" mode that's every haiku,
+    in "summary" mode just the counts and latest images, and the client pages in the haikus.
+    """
+    # Read the position first: deltas are upserts, so replaying one the snapshot already has is harmless.
+    seq = await get_project_seq(project_id)
+    if mode == "summary":
+        return {"type": "snapshot", "mode": mode, "seq": seq, "summary": await get_project_summary(project_id)}
+    project_data = await get_project_data(project_id)
+    return {"type": "snapshot", "mode": mode, "seq": seq, "project": project_data}
+
+
+''' Paginated dashboard data '''
+
+def encode_cursor(created_at, id) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{id}".encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """ Raises ValueError for a malformed cursor """
+    try:
+        created_at, id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.datetime.fromisoformat(created_at), id
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+async def get_page(session, query, table, cursor: str = None, limit: int = 20):
+    """ Keyset pagination, newest first, on (created_at, id) """
+    if cursor:
+        created_at, id = decode_cursor(cursor)
+        id = table.id.type.python_type(id)
+        query = query.where(or_(
+            table.created_at < created_at,
+            and_(table.created_at == created_at, table.id < id),
+        ))
+
+    rows = (await session.scalars(
+        query.order_by(table.created_at.desc(), table.id.desc()).limit(limit + 1)
+    )).all()
+
+    next_cursor = encode_cursor(rows[limit - 1].created_at, rows[limit - 1].id) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def serialize_image_prompt_with_images(prompt):
+    return {
+        **serialize_image_prompt(prompt),
+        "images": [serialize_image(img) for img in sorted(prompt.images, key=lambda i: i.created_at, reverse=True)],
+    }
+
+
+async def get_project_haikus_page(project_id: int, cursor: str = None, limit: int = 20):
+    """ A page of a project's haikus, each with its image prompts, image references and critiques """
+    async with get_async_session() as session:
+        haikus, next_cursor = await get_page(
+            session,
+            select(HaikuTable)
+            .options(
+                selectinload(HaikuTable.image_prompts).selectinload(HaikuImagePromptTable.images),
+                selectinload(HaikuTable.critiques),
+            )
+            .where(HaikuTable.project_id == project_id),
+            HaikuTable, cursor, limit,
+        )
+        return {
+            "items": [
+                {
+                    **serialize_haiku(haiku),
+                    "image_prompts": [
+                        serialize_image_prompt_with_images(prompt)
+                        for prompt in sorted(haiku.image_prompts, key=lambda p: p.created_at, reverse=True)
+                    ],
+                    "critiques": [
+                        serialize_critique(critique)
+                        for critique in sorted(haiku.critiques, key=lambda c: c.created_at, reverse=True)
+                    ],
+                }
+                for haiku in haikus
+            ],
+            "next_cursor": next_cursor,
+        }
+
+
+async def get_haiku_image_prompts_page(haiku_id: int, cursor: str = None, limit: int = 20):
+    """ A page of a haiku's image prompts, each with its image references """
+    async with get_async_session() as session:
+        prompts, next_cursor = await get_page(
+            session,
+            select(HaikuImagePromptTable)
+            .options(selectinload(HaikuImagePromptTable.images))
+            .where(HaikuImagePromptTable.haiku_id == haiku_id),
+            HaikuImagePromptTable, cursor, limit,
+        )
+        return {"items": [serialize_image_prompt_with_images(prompt) for prompt in prompts], "next_cursor": next_cursor}
+
+
+async def get_image_prompt_images_page(prompt_id: str, cursor: str = None, limit: int = 20):
+    """ A page of an image prompt's image references """
+    async with get_async_session() as session:
+        images, next_cursor = await get_page(
+            session,
+            select(HaikuImageTable).where(HaikuImageTable.haiku_image_prompt_id == prompt_id),
+            HaikuImageTable, cursor, limit,
+        )
+        return {"items": [serialize_image(image) for image in images], "next_cursor": next_cursor}
+
+
+async def get_project_summary(project_id: int, thumbnail_count: int = 12):
+    """ Counts and the latest image references for a project, without loading its haikus """
+    async with get_async_session() as session:
+        project = await session.scalar(select(ProjectTable).where(ProjectTable.id == project_id))
+        if not project:
+            return None
+
+        haiku_ids = select(HaikuTable.id).where(HaikuTable.project_id == project_id).scalar_subquery()
+        prompt_ids = select(HaikuImagePromptTable.id).where(HaikuImagePromptTable.haiku_id.in_(haiku_ids)).scalar_subquery()
+
+        counts = {
+            "haikus": await session.scalar(select(func.count()).select_from(HaikuTable).where(HaikuTable.project_id == project_id)),
+            "image_prompts": await session.scalar(select(func.count()).select_from(HaikuImagePromptTable).where(HaikuImagePromptTable.haiku_id.in_(haiku_ids))),
+            "images": await session.scalar(select(func.count()).select_from(HaikuImageTable).where(HaikuImageTable.haiku_image_prompt_id.in_(prompt_ids))),
+            "critiques": await session.scalar(select(func.count()).select_from(HaikuCritiqueTable).where(HaikuCritiqueTable.haiku_id.in_(haiku_ids))),
+        }
+        latest_images = (await session.scalars(
+            select(HaikuImageTable)
+            .where(HaikuImageTable.haiku_image_prompt_id.in_(prompt_ids))
+            .order_by(HaikuImageTable.created_at.desc())
+            .limit(thumbnail_count)
+        )).all()
+
+        return {
+            "project_id": project.id,
+            "name": project.name,
+            "counts": counts,
+            "latest_images": [serialize_image(image) for image in latest_images],
+        }
+
+
 
 class HaikuCritiqueTable(Base):
     ''' Stores critique scores for haikus '''
@@ -193,13 +693,18 @@ class HaikuCritiqueTable(Base):
 
     haiku = relationship('HaikuTable', back_populates='critiques')
 
+    __table_args__ = (
+        Index('ix_ai_haiku_critique_haiku_id_created_at', 'haiku_id', 'created_at'),
+    )
+
 
 HaikuTable.critiques = relationship('HaikuCritiqueTable', back_populates='haiku')
 
 
-def save_haiku_critique(haiku_id, critique_data):
+@traced("db.save_haiku_critique")
+async def save_haiku_critique(haiku_id, critique_data):
     """ Saves a generated critique for a haiku """
-    with get_session() as session:
+    async with get_async_session() as session:
         critique = HaikuCritiqueTable(
             haiku_id=haiku_id,
             creativity_score=critique_data["creativity_score"],
@@ -207,5 +712,12 @@ def save_haiku_critique(haiku_id, critique_data):
             rizz_level=critique_data["rizz_level"],
         )
         session.add(critique)
-        session.commit()
+        await session.flush()
+
+        project_id = await session.scalar(select(HaikuTable.project_id).where(HaikuTable.id == haiku_id))
+        await record_change(session, project_id, "critique_saved", {
+            "haiku_id": haiku_id,
+            "critique": serialize_critique(critique),
+        })
+        await session.commit()
         return critique.id
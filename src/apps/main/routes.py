@@ -4,12 +4,15 @@ import json
 import base64
 import os
 import mimetypes
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.attributes import flag_modified
 from typing import Optional, List
-from uuid import uuid4
+from uuid import uuid4, uuid5, NAMESPACE_OID
 
 from fastapi import (
     FastAPI,
+    Query,
     Request,
     WebSocket,
     WebSocketDisconnect,
@@ -21,20 +24,31 @@ from fastapi import (
     BackgroundTasks,
     HTTPException
 )
-from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse
+from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse, Response, StreamingResponse
 from pydantic import BaseModel
 
+from blobstore import blob_store
 from config import settings
-from llm import ask_llm, get_llm_image
+from eventbus import event_bus, project_channel
+from jobs import enqueue_job, get_job, get_job_id, job_handler
+from llm import ask_llm, ask_llm_stream, get_llm_image, PRIORITY_BACKGROUND
+from llmbatch import LLMCall, ask_llm_many, get_offline_answers, poll_offline, submit_offline
+from workflow import Step, Workflow, get_checkpoints
 from logger import logger
+from tracing import current_trace_context, span
+from metrics import websocket_connections as websocket_connections_gauge, websocket_sent_bytes, websocket_sent_messages
+from wire import encode_off_loop, wire_formats
 
-from database import get_session
+from database import get_async_session
 
+from .broadcast import subscribe_dashboard, unsubscribe_dashboard, RESYNC, DISCONNECT
 from .models import (
     ProjectTable, HaikuTable, HaikuImagePromptTable,
-    get_project_data, get_haiku_by_id, save_image_prompt, save_generated_image,
-    get_image_prompt_by_id,
-    save_haiku_critique
+    get_project_data, get_haiku_by_id, save_haiku, save_haiku_batch, save_image_prompt, save_generated_image,
+    get_image_prompt_by_id, get_image_by_id, get_image_derivative,
+    save_haiku_critique,
+    record_change, serialize_haiku, serialize_image_prompt, get_changes_since, get_project_snapshot, prune_change_feed,
+    get_project_haikus_page, get_haiku_image_prompts_page, get_image_prompt_images_page, get_project_summary
 )
 from .prompts import get_haiku_prompt, get_haiku_image_prompt, get_haiku_critique_prompt
 from .schemas import Haiku, HaikuImagePrompt
@@ -43,10 +57,28 @@ from .schemas import Haiku, HaikuImagePrompt
 app = FastAPI()
 router = APIRouter()
 
-project_events = {}
 websocket_connections = {}
 
 
+async def notify_project(project_id: int):
+    """ Wake up every dashboard watching this project, in any worker """
+    with span("dashboard.notify", project_id=project_id):
+        # the broadcaster traces its push under this span
+        await event_bus.publish(project_channel(project_id), {"project_id": project_id, "trace": current_trace_context()})
+
+
+async def notify_project_partial(project_id: int, kind: str, stream_id: str, data: dict, done: bool = False):
+    """
+    Relay a partial (still streaming) result to the project's dashboards. A stream that ends
+    without the delta that replaces its partial, E.g. because it failed, sends one with `done`
+    so dashboards drop it.
+    """
+    await event_bus.publish(project_channel(project_id), {
+        "project_id": project_id,
+        "partial": {"kind": kind, "stream_id": stream_id, "data": data, "done": done},
+    })
+
+
 
 ''' Project Stuff '''
 
@@ -55,85 +87,372 @@ class ProjectCreate(BaseModel):
 
 @router.post("/")
 async def create_project(project: ProjectCreate):
-    with get_session() as session:
+    async with get_async_session() as session:
         new_project = ProjectTable(
             name=project.name,
         )
         session.add(new_project)
-        session.commit()
-        session.refresh(new_project)
+        await session.commit()
         return {"project_id": new_project.id}
 
 @router.get("/")
 async def get_projects():
-    with get_session() as session:
+    async with get_async_session() as session:
         # Get projects, most recent first
-        projects = session.query(ProjectTable).order_by(ProjectTable.id.desc()).all()
+        projects = (await session.scalars(select(ProjectTable).order_by(ProjectTable.id.desc()))).all()
         return [{"id": project.id, "name": project.name} for project in projects]
 
 
+''' Paginated Dashboard Data '''
+
+page_limit = Query(20, ge=1, le=100)
+
+
+async def get_page_or_400(get_page, *args, cursor, limit):
+    try:
+        return await get_page(*args, cursor=cursor, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/{project_id}/summary")
+async def get_project_summary_route(project_id: int):
+    """ Counts and latest image references, without any haikus """
+    summary = await get_project_summary(project_id)
+    if not summary:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return summary
+
+
+@router.get("/{project_id}/haikus")
+async def get_project_haikus(project_id: int, cursor: Optional[str] = None, limit: int = page_limit):
+    """ A page of haikus, newest first. Pass `next_cursor` back as `cursor` for the next page """
+    return await get_page_or_400(get_project_haikus_page, project_id, cursor=cursor, limit=limit)
+
+
+@router.get("/haikus/{haiku_id}/image-prompts")
+async def get_haiku_image_prompts(haiku_id: int, cursor: Optional[str] = None, limit: int = page_limit):
+    return await get_page_or_400(get_haiku_image_prompts_page, haiku_id, cursor=cursor, limit=limit)
+
+
+@router.get("/image-prompts/{prompt_id}/images")
+async def get_image_prompt_images(prompt_id: str, cursor: Optional[str] = None, limit: int = page_limit):
+    return await get_page_or_400(get_image_prompt_images_page, prompt_id, cursor=cursor, limit=limit)
+
+
 ''' Haiku Stuff '''
 class HaikuRequest(BaseModel):
     description: str
     project_id: int
+    stream: bool = False  # respond with server-sent events of the partial haiku
+
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {wire_formats['json'].encode(data)}\n\n"
+
+
+async def stream_haiku(haiku_req: HaikuRequest, stream_id: str, chain_id: str):
+    """
+    Generate a haiku, relaying partials to the project's dashboards as they stream in.
+    Yields the partials as well, then the saved haiku.
+    """
+    llm_query, llm_response_format = get_haiku_prompt(haiku_req.description)
+    try:
+        async for event in ask_llm_stream(
+            messages=[{"role": "user", "content": llm_query}],
+            response_format=llm_response_format,
+            chain_id=chain_id,
+            name="haiku-generate",
+        ):
+            if event["type"] == "partial":
+                await notify_project_partial(haiku_req.project_id, "haiku", stream_id, event["data"] or {})
+                yield event
+                continue
+
+            haiku = event["answer"]
+            # made current only between yields, since the generator may be resumed in another context
+            with span("haiku.save", chain_id=chain_id):
+                haiku_id = await save_haiku(haiku_req.project_id, haiku.title, haiku.text, stream_id=stream_id)
+                if haiku_id is None:
+                    raise HTTPException(status_code=404, detail="Project not found")
+
+                # Trigger WebSocket update
+                await notify_project(haiku_req.project_id)
+
+            yield {"type": "haiku", "data": {"id": haiku_id, "title": haiku.title, "text": haiku.text}}
+    except Exception as e:
+        # no haiku_created delta will replace the dashboards' partial
+        await notify_project_partial(haiku_req.project_id, "haiku", stream_id, {"error": str(e)}, done=True)
+        raise
 
 
 @router.post("/haiku")
 async def generate_haiku(haiku_req: HaikuRequest):
+    async with get_async_session() as session:
+        project = await session.scalar(select(ProjectTable).where(ProjectTable.id == haiku_req.project_id))
+        if not project:
+            raise HTTPException(status_code=404, detail="Project not found")
+
+    stream_id = str(uuid4())
+    chain_id = str(uuid4())
+
+    if haiku_req.stream:
+        async def event_stream():
+            try:
+                async for event in stream_haiku(haiku_req, stream_id, chain_id):
+                    yield sse_event(event["type"], event["data"])
+            except Exception as e:
+                logger.error(f"Error generating haiku", exc_info=True)
+                yield sse_event("error", {"detail": str(e)})
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
     try:
-        llm_query, llm_response_format = get_haiku_prompt(haiku_req.description)
-        haiku, completion, chain_id = await ask_llm(
-            messages=[{"role": "user", "content": llm_query}],
-            response_format=llm_response_format
-        )
+        with span("POST /projects/haiku", chain_id=chain_id, project_id=haiku_req.project_id):
+            async for event in stream_haiku(haiku_req, stream_id, chain_id):
+                pass
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error generating haiku", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
-    with get_session() as session:
-        project = session.query(ProjectTable).filter(ProjectTable.id == haiku_req.project_id).first()
+    return {"success": True, "chain_id": chain_id}
+
+
+class HaikuBatchRequest(BaseModel):
+    descriptions: List[str]
+    critique: bool = False       # also critique each new haiku
+    image_prompts: bool = False  # also write an image prompt for each new haiku
+    offline: bool = False        # go through the provider's batch API: cheaper, but can take hours
+
+
+@router.post("/{project_id}/haiku:batch")
+async def generate_haiku_batch(project_id: int, req: HaikuBatchRequest, idempotency_key: Optional[str] = Header(None)):
+    """
+    Generate a haiku per description, in background jobs of `haiku_batch_chunk_size`
+    descriptions each. Every call in the batch shares `batch_id` as its chain_id, and each
+    item's progress is sent to the project's dashboards as a `batch_item` partial.
+    """
+    if not req.descriptions:
+        raise HTTPException(status_code=400, detail="No descriptions")
+    if len(req.descriptions) > settings.haiku_batch_max_items:
+        raise HTTPException(status_code=400, detail=f"At most {settings.haiku_batch_max_items} descriptions per batch")
+
+    async with get_async_session() as session:
+        project = await session.scalar(select(ProjectTable).where(ProjectTable.id == project_id))
         if not project:
             raise HTTPException(status_code=404, detail="Project not found")
 
-        new_haiku = HaikuTable(
-            project_id=haiku_req.project_id,
-            title=haiku.title,
-            text=haiku.text
-        )
-        session.add(new_haiku)
-        session.commit()
-        session.refresh(new_haiku)
+    # a retried request maps to the same batch, and so to the same chunk jobs
+    batch_id = str(uuid5(NAMESPACE_OID, idempotency_key)) if idempotency_key else str(uuid4())
+
+    job_ids = []
+    chunk_size = settings.haiku_batch_chunk_size
+    with span("POST /projects/haiku:batch", chain_id=batch_id, project_id=project_id, total=len(req.descriptions)):
+        for start in range(0, len(req.descriptions), chunk_size):
+            job_ids.append(await enqueue_job(
+                "process_haiku_batch_chunk",
+                {
+                    "project_id": project_id,
+                    "batch_id": batch_id,
+                    "start": start,
+                    "descriptions": req.descriptions[start:start + chunk_size],
+                    "critique": req.critique,
+                    "image_prompts": req.image_prompts,
+                    "offline": req.offline,
+                },
+                idempotency_key=f"haiku-batch:{batch_id}:{start}",
+            ))
+
+    return {"message": "Haikus are being generated.", "batch_id": batch_id, "total": len(req.descriptions), "job_ids": job_ids}
+
+
+def get_haiku_calls(descriptions: List[str]) -> list:
+    calls = []
+    for description in descriptions:
+        prompt_text, response_format = get_haiku_prompt(description)
+        calls.append(LLMCall(messages=[{"role": "user", "content": prompt_text}], response_format=response_format, name="haiku-generate"))
+    return calls
+
+
+def get_follow_up_calls(chunk: dict, haikus: dict) -> list:
+    """ (item, step, LLMCall) for each haiku's critique / image prompt, if the batch asked for them """
+    follow_up_calls = []
+    for i, haiku in haikus.items():
+        if chunk["critique"]:
+            prompt_text, response_format = get_haiku_critique_prompt(haiku["text"])
+            follow_up_calls.append((i, "critique", LLMCall(messages=[{"role": "user", "content": prompt_text}], response_format=response_format, name="haiku-critique")))
+        if chunk["image_prompts"]:
+            prompt_text, response_format = get_haiku_image_prompt(haiku["text"], further_details=None)
+            follow_up_calls.append((i, "image_prompt", LLMCall(messages=[{"role": "user", "content": prompt_text}], response_format=response_format, name="haiku-image-prompt")))
+    return follow_up_calls
+
+
+async def report_batch_item(chunk: dict, i: int, status: str, **data):
+    batch_id, index = chunk["batch_id"], chunk["start"] + i
+    await notify_project_partial(chunk["project_id"], "batch_item", f"{batch_id}:{index}", {
+        "batch_id": batch_id, "index": index, "status": status, **data,
+    })
+
+
+async def get_batch_haikus(chunk: dict, answers: list) -> dict:
+    """ Item -> haiku for the answers that worked, the others are reported as failed """
+    haikus = {}
+    for i, answer in enumerate(answers):
+        if isinstance(answer, Exception):
+            await report_batch_item(chunk, i, "failed", error=str(answer))
+        else:
+            haikus[i] = {"title": answer.title, "text": answer.text}
+    if not haikus:
+        raise Exception(f"Every haiku in batch {chunk['batch_id']} chunk {chunk['start']} failed")
+    return haikus
+
+
+def add_follow_ups(chunk: dict, haikus: dict, follow_up_calls: list, answers: list):
+    for (i, step, _), answer in zip(follow_up_calls, answers):
+        if isinstance(answer, Exception):
+            # keep the haiku, just without this step
+            logger.warning(f"[process_haiku_batch_chunk] {step} failed for batch {chunk['batch_id']} item {chunk['start'] + i}: {answer}")
+        elif step == "critique":
+            haikus[i]["critique"] = answer.model_dump()
+        else:
+            haikus[i]["image_prompt"] = answer.text
+
+
+async def save_batch_chunk(chunk: dict, haikus: dict) -> dict:
+    haiku_ids = await save_haiku_batch(chunk["project_id"], list(haikus.values()))
+    if haiku_ids is None:
+        raise ValueError(f"Project {chunk['project_id']} not found")
+
+    for i, haiku_id in zip(haikus, haiku_ids):
+        await report_batch_item(chunk, i, "saved", haiku_id=haiku_id)
+    await notify_project(chunk["project_id"])
+
+    failed = [chunk["start"] + i for i in range(len(chunk["descriptions"])) if i not in haikus]
+    return {"haiku_ids": haiku_ids, "failed": failed}
+
+
+@job_handler()
+async def process_haiku_batch_chunk(
+    project_id: int,
+    batch_id: str,
+    start: int,
+    descriptions: List[str],
+    critique: bool = False,
+    image_prompts: bool = False,
+    offline: bool = False,
+):
+    """
+    Background job for one chunk of a haiku batch: generates the haikus (then their
+    critiques / image prompts), and saves them all in a single transaction. Failed items are
+    reported and skipped rather than failing (and retrying) the whole chunk. Offline chunks
+    are submitted here and finished by `poll_haiku_batch_chunk`.
+    """
+    chunk = {
+        "project_id": project_id, "batch_id": batch_id, "start": start, "descriptions": descriptions,
+        "critique": critique, "image_prompts": image_prompts,
+    }
+    if offline:
+        return await submit_batch_chunk(chunk, "haikus", get_haiku_calls(descriptions))
+
+    answers = await ask_llm_many(get_haiku_calls(descriptions), chain_id=batch_id, concurrency=settings.haiku_batch_concurrency)
+    haikus = await get_batch_haikus(chunk, answers)
+
+    if follow_up_calls := get_follow_up_calls(chunk, haikus):
+        answers = await ask_llm_many([call for _, _, call in follow_up_calls], chain_id=batch_id, concurrency=settings.haiku_batch_concurrency)
+        add_follow_ups(chunk, haikus, follow_up_calls, answers)
+    return await save_batch_chunk(chunk, haikus)
+
 
-    # Trigger WebSocket update
-    if haiku_req.project_id in project_events:
-        project_events[haiku_req.project_id].set()
+def get_batch_poll_key(chunk: dict, stage: str, polls: int) -> str:
+    return f"haiku-batch-poll:{chunk['batch_id']}:{chunk['start']}:{stage}:{polls}"
+
+
+async def submit_batch_chunk(chunk: dict, stage: str, calls: list, haikus: dict = None) -> dict:
+    """
+    Submit a chunk's calls as one offline batch, and queue the job that polls it. That job's
+    payload is where the batch id is kept, so a retried job finds it there instead of paying
+    for another batch.
+    """
+    if poll_job_id := await get_job_id(get_batch_poll_key(chunk, stage, 0)):
+        return {"stage": stage, "poll_job_id": poll_job_id}  # an earlier attempt submitted it
 
-    return {"success": True}
+    llm_batch_id = await submit_offline(calls)
+    poll_job_id = await enqueue_job(
+        "poll_haiku_batch_chunk",
+        {"chunk": chunk, "stage": stage, "llm_batch_id": llm_batch_id, "haikus": haikus},
+        idempotency_key=get_batch_poll_key(chunk, stage, 0),
+    )
+    logger.info(f"[submit_batch_chunk] batch {chunk['batch_id']} chunk {chunk['start']} {stage}: {llm_batch_id}")
+    return {"stage": stage, "llm_batch_id": llm_batch_id, "poll_job_id": poll_job_id}
+
+
+@job_handler()
+async def poll_haiku_batch_chunk(chunk: dict, stage: str, llm_batch_id: str, haikus: Optional[dict] = None, polls: int = 0):
+    """
+    Background job that checks on an offline batch once, and while it's still running queues
+    itself again `llm_batch_poll_interval` later, rather than holding a worker slot for hours.
+    Once the haikus are in, their critiques / image prompts go out as the next batch; once
+    those are in too, the chunk is saved.
+    """
+    output = await poll_offline(llm_batch_id)
+    if output is None:
+        poll_job_id = await enqueue_job(
+            "poll_haiku_batch_chunk",
+            {"chunk": chunk, "stage": stage, "llm_batch_id": llm_batch_id, "haikus": haikus, "polls": polls + 1},
+            idempotency_key=get_batch_poll_key(chunk, stage, polls + 1),
+            run_after=datetime.utcnow() + timedelta(seconds=settings.llm_batch_poll_interval),
+        )
+        return {"stage": stage, "llm_batch_id": llm_batch_id, "pending": True, "poll_job_id": poll_job_id}
+
+    if stage == "haikus":
+        answers = await get_offline_answers(get_haiku_calls(chunk["descriptions"]), output, chain_id=chunk["batch_id"])
+        haikus = await get_batch_haikus(chunk, answers)
+        if follow_up_calls := get_follow_up_calls(chunk, haikus):
+            return await submit_batch_chunk(chunk, "follow_ups", [call for _, _, call in follow_up_calls], haikus)
+    else:
+        haikus = {int(i): haiku for i, haiku in haikus.items()}  # JSON object keys come back as strings
+        follow_up_calls = get_follow_up_calls(chunk, haikus)
+        answers = await get_offline_answers([call for _, _, call in follow_up_calls], output, chain_id=chunk["batch_id"])
+        add_follow_ups(chunk, haikus, follow_up_calls, answers)
+    return await save_batch_chunk(chunk, haikus)
 
 
 class HaikuInferRequest(BaseModel):
     haiku_id: int
 
 @router.post("/haiku-critique")
-async def generate_haiku_critique(req: HaikuInferRequest, background_tasks: BackgroundTasks):
+async def generate_haiku_critique(req: HaikuInferRequest, idempotency_key: Optional[str] = Header(None)):
     haiku_id = req.haiku_id
-    haiku = get_haiku_by_id(haiku_id)
+    haiku = await get_haiku_by_id(haiku_id)
     
     if not haiku:
         raise HTTPException(status_code=404, detail="Haiku not found")
-    
-    prompt_text, response_format = get_haiku_critique_prompt(haiku['text'])
 
-    # Background critique generation
-    background_tasks.add_task(process_haiku_critique, haiku_id, prompt_text, response_format)
+    # Background critique generation, its calls continue this chain (see tracing.py)
+    chain_id = str(uuid4())
+    with span("POST /projects/haiku-critique", chain_id=chain_id, haiku_id=haiku_id):
+        job_id = await enqueue_job(
+            "process_haiku_critique",
+            {"haiku_id": haiku_id},
+            # namespaced, so a client re-using a key across endpoints doesn't get another endpoint's job back
+            idempotency_key=idempotency_key and f"process_haiku_critique:{idempotency_key}",
+        )
 
-    return {"message": "Haiku critique is being generated."}
+    return {"message": "Haiku critique is being generated.", "job_id": job_id, "chain_id": chain_id}
 
 
-async def process_haiku_critique(haiku_id: int, prompt_text: str, response_format):
-    """ Background task for generating haiku critique and storing it in the database """
+@job_handler()
+async def process_haiku_critique(haiku_id: int):
+    """ Background job for generating haiku critique and storing it in the database """
     try:
-        critique, completion, chain_id = await ask_llm(messages=[{"role": "user", "content": prompt_text}], response_format=response_format)
+        haiku = await get_haiku_by_id(haiku_id)
+        if not haiku:
+            raise ValueError(f"Haiku {haiku_id} not found")
+
+        prompt_text, response_format = get_haiku_critique_prompt(haiku['text'])
+        critique, completion, chain_id = await ask_llm(messages=[{"role": "user", "content": prompt_text}], response_format=response_format, priority=PRIORITY_BACKGROUND)
 
         critique_data = {
             "creativity_score": critique.creativity_score,
@@ -142,66 +461,89 @@ async def process_haiku_critique(haiku_id: int, prompt_text: str, response_forma
         }
 
         # Save critique to database
-        save_haiku_critique(haiku_id, critique_data)
+        critique_id = await save_haiku_critique(haiku_id, critique_data)
 
         # Notify WebSocket clients
-        haiku = get_haiku_by_id(haiku_id)
-        if haiku and haiku["project_id"] in project_events:
-            project_events[haiku["project_id"]].set()
+        await notify_project(haiku["project_id"])
+
+        return {"critique_id": critique_id}
 
     except Exception as e:
         logger.error(f"[process_haiku_critique] Exception: {e}", exc_info=True)
+        raise
 
 
 
+# one image prompt is generated per entry
+image_prompt_further_details = [
+    None,
+    "Write an image prompt that would make Genghis Khan proud.",
+    "Write an image prompt for a scene that would make a Gold-specked gecko write this haiku.",
+]
+
+
 @router.post("/generate-image-prompts")
-async def generate_image_prompts(req: HaikuInferRequest, background_tasks: BackgroundTasks):
+async def generate_image_prompts(req: HaikuInferRequest, idempotency_key: Optional[str] = Header(None)):
     """ 
-    Queue background tasks for generating image prompts one by one,  
+    Queue background jobs for generating image prompts one by one,  
     notifying the WebSocket after each prompt is saved.
     """
     haiku_id = req.haiku_id
-    haiku = get_haiku_by_id(haiku_id)
+    haiku = await get_haiku_by_id(haiku_id)
 
     if not haiku:
         raise HTTPException(status_code=404, detail="Haiku not found")
 
-    prompts = [
-        get_haiku_image_prompt(haiku['text'], further_details=None),
-        get_haiku_image_prompt(haiku['text'], further_details="Write an image prompt that would make Genghis Khan proud."),
-        get_haiku_image_prompt(haiku['text'], further_details="Write an image prompt for a scene that would make a Gold-specked gecko write this haiku."),
-    ]
-    
     llm_chain_id = str(uuid4())
 
-    for prompt_text, response_format in prompts:
-        background_tasks.add_task(
-            process_image_prompt,
-            chain_id=llm_chain_id,
-            haiku_id=haiku_id,
-            response_format=response_format,
-            prompt_text=prompt_text,
-            project_id=haiku['project_id']
-        )
-
-    return {"message": "Image prompts are being generated."}
+    job_ids = []
+    with span("POST /projects/generate-image-prompts", chain_id=llm_chain_id, haiku_id=haiku_id):
+        for i, details in enumerate(image_prompt_further_details):
+            job_ids.append(await enqueue_job(
+                "process_image_prompt",
+                {
+                    "chain_id": llm_chain_id,
+                    "haiku_id": haiku_id,
+                    "project_id": haiku['project_id'],
+                    "further_details": details,
+                },
+                idempotency_key=idempotency_key and f"process_image_prompt:{idempotency_key}:{i}",
+            ))
+
+    return {"message": "Image prompts are being generated.", "job_ids": job_ids, "chain_id": llm_chain_id}
+
+
+@job_handler()
+async def process_image_prompt(chain_id: str, haiku_id: int, project_id: int, further_details: Optional[str] = None):
+    """ Background job for generating an image prompt and updating WebSocket """
+    stream_id = str(uuid4())
+    try:
+        haiku = await get_haiku_by_id(haiku_id)
+        if not haiku:
+            raise ValueError(f"Haiku {haiku_id} not found")
 
+        prompt_text, response_format = get_haiku_image_prompt(haiku['text'], further_details=further_details)
 
-async def process_image_prompt(chain_id: str, haiku_id: int, prompt_text: str, project_id: int, response_format):
-    """ Background task for generating an image prompt and updating WebSocket """
-    try:
-        image_prompt, completion, chain_id = await ask_llm(chain_id=chain_id, response_format=response_format, messages=[{"role": "user", "content": prompt_text}])
+        async for event in ask_llm_stream(chain_id=chain_id, response_format=response_format, messages=[{"role": "user", "content": prompt_text}], priority=PRIORITY_BACKGROUND):
+            if event["type"] == "partial":
+                await notify_project_partial(project_id, "image_prompt", stream_id, {"haiku_id": haiku_id, **(event["data"] or {})})
+            else:
+                image_prompt = event["answer"]
         
-        prompt_id = save_image_prompt(
+        prompt_id = await save_image_prompt(
             haiku_id,
-            prompt_text=image_prompt.text
+            prompt_text=image_prompt.text,
+            stream_id=stream_id
         )
 
         # Notify WebSocket after each image prompt is created
-        if project_id in project_events:
-            project_events[project_id].set()
+        await notify_project(project_id)
+
+        return {"prompt_id": prompt_id}
     except Exception as e:
         logger.error(f"[process_image_prompt] Error generating prompt for haiku {haiku_id}: {e}")
+        await notify_project_partial(project_id, "image_prompt", stream_id, {"haiku_id": haiku_id, "error": str(e)}, done=True)
+        raise
 
 
 class UpdateImagePromptRequest(BaseModel):
@@ -211,18 +553,26 @@ class UpdateImagePromptRequest(BaseModel):
 @router.put("/update-image-prompt")
 async def update_image_prompt(req: UpdateImagePromptRequest):
     """ Update an existing image prompt """
-    with get_session() as session:
-        prompt = session.query(HaikuImagePromptTable).filter(HaikuImagePromptTable.id == req.prompt_id).first()
+    async with get_async_session() as session:
+        prompt = await session.scalar(
+            select(HaikuImagePromptTable)
+            .options(joinedload(HaikuImagePromptTable.haiku))
+            .where(HaikuImagePromptTable.id == req.prompt_id)
+        )
         if not prompt:
             raise HTTPException(status_code=404, detail="Image prompt not found")
 
         prompt.image_prompt = req.new_text
-        session.commit()
 
-        # Notify WebSocket clients
         project_id = prompt.haiku.project_id
-        if project_id in project_events:
-            project_events[project_id].set()
+        await record_change(session, project_id, "image_prompt_updated", {
+            "haiku_id": prompt.haiku_id,
+            "image_prompt": serialize_image_prompt(prompt),
+        })
+        await session.commit()
+
+        # Notify WebSocket clients
+        await notify_project(project_id)
 
         return {"message": "Image prompt updated successfully"}
 
@@ -232,85 +582,368 @@ class GenerateImageRequest(BaseModel):
     haiku_id: int
 
 @router.post("/generate-image")
-async def generate_image(req: GenerateImageRequest, background_tasks: BackgroundTasks):
+async def generate_image(req: GenerateImageRequest, idempotency_key: Optional[str] = Header(None)):
     """ Generate an image for an image prompt in the background """
-    background_tasks.add_task(process_image_generation, req.prompt_id, req.haiku_id)
-    return {"message": "Image generation started."}
+    chain_id = str(uuid4())
+    with span("POST /projects/generate-image", chain_id=chain_id, prompt_id=req.prompt_id):
+        job_id = await enqueue_job(
+            "process_image_generation",
+            {"prompt_id": req.prompt_id, "haiku_id": req.haiku_id},
+            idempotency_key=idempotency_key and f"process_image_generation:{idempotency_key}",
+        )
+    return {"message": "Image generation started.", "job_id": job_id, "chain_id": chain_id}
 
 
+@job_handler()
 async def process_image_generation(prompt_id: str, haiku_id: int):
-    """ Background task for generating an image and storing it in the database """
+    """ Background job for generating an image and storing it in the database """
     try:
-        haiku = get_haiku_by_id(haiku_id)
+        haiku = await get_haiku_by_id(haiku_id)
         if not haiku:
-            raise HTTPException(status_code=404, detail="Haiku not found")
+            raise ValueError(f"Haiku {haiku_id} not found")
 
         logger.info(f"[process_image_generation] Generating image for prompt_id={prompt_id}")
         
-        prompt = get_image_prompt_by_id(prompt_id)
+        prompt = await get_image_prompt_by_id(prompt_id)
+        if not prompt:
+            raise ValueError(f"Image prompt {prompt_id} not found")
         
         image_data = await get_llm_image(prompt['image_prompt'])
         
         if not image_data or not isinstance(image_data, list) or not image_data[0]:
-            raise ValueError("No valid image data returned from LLM. Returned: {image_data}")
-
-        base64_image = base64.b64encode(image_data[0]).decode('utf-8')
+            raise ValueError(f"No valid image data returned from LLM. Returned: {image_data}")
 
-        save_generated_image(prompt_id, base64_image)
+        image_id = await save_generated_image(prompt_id, image_data[0])
 
         logger.info(f"[process_image_generation] Image successfully stored for prompt_id={prompt_id}")
 
         # Notify WebSocket clients
-        if haiku['project_id'] in project_events:
-            project_events[haiku['project_id']].set()
+        await notify_project(haiku['project_id'])
+
+        return {"image_id": image_id}
     
     except Exception as e:
         logger.error(f"[process_image_generation] Exception: {e}", exc_info=True)
+        raise
+
+
+''' Workflow Stuff '''
+
+async def save_pipeline_haiku(run, haiku):
+    project_id = run.inputs["project_id"]
+    haiku_id = await save_haiku(project_id, haiku.title, haiku.text)
+    if haiku_id is None:
+        raise ValueError(f"Project {project_id} not found")
+    await notify_project(project_id)
+    return {"id": haiku_id, "title": haiku.title, "text": haiku.text}
+
+
+async def save_pipeline_critique(run, critique):
+    critique_id = await save_haiku_critique(run.results["haiku"]["id"], critique.model_dump())
+    await notify_project(run.inputs["project_id"])
+    return {"id": critique_id, **critique.model_dump()}
+
+
+def image_prompt_step(i: int, further_details: Optional[str]):
+    async def save(run, prompt):
+        prompt_id = await save_image_prompt(run.results["haiku"]["id"], prompt.text)
+        await notify_project(run.inputs["project_id"])
+        return {"id": prompt_id, "text": prompt.text}
+
+    return Step(
+        name=f"image_prompt_{i}",
+        depends_on=("haiku",),
+        prompt=lambda run: get_haiku_image_prompt(run.results["haiku"]["text"], further_details=further_details),
+        save=save,
+    )
+
+
+def image_step(i: int):
+    async def generate(run):
+        prompt = run.results[f"image_prompt_{i}"]
+        image_data = await get_llm_image(prompt["text"], chain_id=run.run_id)
+        if not image_data or not isinstance(image_data, list) or not image_data[0]:
+            raise ValueError(f"No valid image data returned from LLM. Returned: {image_data}")
+        image_id = await save_generated_image(prompt["id"], image_data[0])
+        await notify_project(run.inputs["project_id"])
+        return {"id": image_id}
+
+    return Step(
+        name=f"image_{i}",
+        depends_on=(f"image_prompt_{i}",),
+        run=generate,
+        when=lambda run: run.inputs.get("images", False),
+    )
+
+
+# haiku -> critique, and haiku -> image prompts -> images (when asked for)
+haiku_pipeline = Workflow("haiku-pipeline", [
+    Step(
+        name="haiku",
+        prompt=lambda run: get_haiku_prompt(run.inputs["description"]),
+        save=save_pipeline_haiku,
+    ),
+    Step(
+        name="critique",
+        depends_on=("haiku",),
+        prompt=lambda run: get_haiku_critique_prompt(run.results["haiku"]["text"]),
+        save=save_pipeline_critique,
+    ),
+    *[image_prompt_step(i, details) for i, details in enumerate(image_prompt_further_details)],
+    *[image_step(i) for i in range(len(image_prompt_further_details))],
+])
+
+
+class HaikuPipelineRequest(BaseModel):
+    project_id: int
+    description: str
+    images: bool = False  # also generate an image for each image prompt
+
+
+@router.post("/haiku-pipeline")
+async def start_haiku_pipeline(req: HaikuPipelineRequest, idempotency_key: Optional[str] = Header(None)):
+    """ Run the whole haiku pipeline in the background. `run_id` is also the chain_id of its calls """
+    async with get_async_session() as session:
+        project = await session.scalar(select(ProjectTable).where(ProjectTable.id == req.project_id))
+        if not project:
+            raise HTTPException(status_code=404, detail="Project not found")
+
+    run_id = str(uuid5(NAMESPACE_OID, idempotency_key)) if idempotency_key else str(uuid4())
+    with span("POST /projects/haiku-pipeline", chain_id=run_id, project_id=req.project_id):
+        job_id = await enqueue_job(
+            "run_workflow",
+            {"workflow": haiku_pipeline.name, "run_id": run_id, "inputs": req.model_dump()},
+            idempotency_key=f"workflow:{run_id}",
+        )
+    return {"message": "Haiku pipeline started.", "run_id": run_id, "job_id": job_id}
+
+
+@router.get("/workflows/{run_id}")
+async def get_workflow_run(run_id: str):
+    """ The results of a workflow run's completed steps, by step name """
+    return {"run_id": run_id, "steps": await get_checkpoints(run_id)}
+
+
+''' Job Stuff '''
+
+@router.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """ Status of a background job, E.g. one returned by /haiku-critique """
+    job = await get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return {
+        key: job[key]
+        for key in ["id", "name", "status", "attempts", "max_attempts", "result", "last_error", "created_at", "updated_at", "finished_at"]
+    }
+
+
+''' Image Stuff '''
+
+def parse_range_header(range_header: str, size: int):
+    """ Parse a single `bytes=start-end` range into inclusive offsets, or None if unsatisfiable """
+    try:
+        unit, _, byte_range = range_header.partition('=')
+        if unit.strip() != 'bytes' or ',' in byte_range:
+            return None
+        start, _, end = byte_range.strip().partition('-')
+        if not start:
+            # suffix range, e.g. `bytes=-500` is the last 500 bytes
+            length = int(end)
+            if length <= 0:
+                return None
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+
+    if start >= size or start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+def get_accepted_image_formats(accept: Optional[str]):
+    """ Derivative formats in the order we'd rather serve them, webp only if the client says it takes it """
+    if accept and 'image/webp' in accept:
+        return ['webp', 'jpeg']
+    return ['jpeg']
+
+
+@router.get("/images/{image_id}")
+async def get_image(
+    image_id: str,
+    size: str = "original",
+    range: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
+):
+    """
+    Stream a generated image from the blob store, with ETag and Range support.
+    `?size=thumb` / `?size=medium` (see settings.image_derivative_sizes) serve a resized
+    copy, as webp when the client accepts it, otherwise jpeg.
+    """
+    if size != "original" and size not in settings.image_derivative_sizes:
+        raise HTTPException(status_code=400, detail=f"Unknown image size: {size}")
+
+    image = None
+    if size != "original":
+        image = await get_image_derivative(image_id, size, get_accepted_image_formats(accept))
+    # the original, or its fallback when it has no such derivative (E.g. it predates them, or resizing failed)
+    immutable = image is not None or size == "original"
+    image = image or await get_image_by_id(image_id)
+    if not image:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    etag = f'"{image["blob_hash"]}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        # the blob behind an image id and size never changes, though a fallback may later get a derivative
+        "Cache-Control": "public, max-age=31536000, immutable" if immutable else "public, max-age=3600",
+    }
+    if size != "original":
+        headers["Vary"] = "Accept"
+
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return Response(status_code=304, headers=headers)
+
+    size = image["size"]
+    if range:
+        byte_range = parse_range_header(range, size)
+        if not byte_range:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        start, end = byte_range
+        return StreamingResponse(
+            blob_store.iter_range(image["blob_hash"], start, end),
+            status_code=206,
+            media_type=image["mime_type"],
+            headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)},
+        )
+
+    return StreamingResponse(
+        blob_store.iter_range(image["blob_hash"]),
+        media_type=image["mime_type"],
+        headers={**headers, "Content-Length": str(size)},
+    )
 
 
 ''' Project UI Sync '''
 @router.websocket("/dashboard/{project_id}")
-async def dashboard_websocket(websocket: WebSocket, project_id: int):
+async def dashboard_websocket(websocket: WebSocket, project_id: int, since: Optional[int] = None, snapshot: str = "full", format: str = "json"):
+    """
+    Sync a project dashboard. The first message is a snapshot, unless the client
+    reconnects with `?since=<last seen seq>` and is close enough behind to just get the
+    missing deltas. After that, the project's broadcaster pushes each change as a small delta.
+    With `?snapshot=summary`, snapshots only carry counts, and the client pages in haikus
+    from `/{project_id}/haikus`. With `?format=msgpack`, messages are MessagePack binary
+    frames instead of JSON text frames.
+    """
     await websocket.accept()
+    wire_format = wire_formats.get(format, wire_formats["json"])
 
-    logger.info(f"[dashboard_websocket] connected")
-    
-    # Initialize the event for this dashboard.
-    if project_id not in project_events:
-        project_events[project_id] = asyncio.Event()
-
-    # Send initial dashboard data.
-    project_data = get_project_data(project_id)
-    await websocket.send_text(json.dumps(project_data))
+    logger.info(f"[dashboard_websocket] connected since={since}")
+    websocket_connections.setdefault(project_id, []).append(websocket)
+    websocket_connections_gauge.inc()
 
-    websocket_open = True
+    # Subscribe before the initial send, so nothing broadcast in between is missed.
+    snapshot_mode = "summary" if snapshot == "summary" else "full"
+    subscriber = await subscribe_dashboard(project_id, websocket, snapshot_mode, wire_format)
 
-    while websocket_open:
-        logger.info(f"[dashboard_websocket] waiting for event")
-        try:
-            await project_events[project_id].wait()
-            project_events[project_id].clear()
-        except Exception as e:
-            logger.error(f"[dashboard_websocket] Error waiting for event : {e}", exc_info=True)
-            break
+    async def send(encoded, kind: str):
+        await wire_format.send(websocket, encoded)
+        websocket_sent_messages.inc(kind=kind)
+        # before permessage-deflate; JSON is near enough to ascii that chars ~ bytes
+        websocket_sent_bytes.inc(len(encoded), kind=kind)
 
-        logger.info(f"[dashboard_websocket] event triggered")
+    async def send_snapshot():
+        project_snapshot = await get_project_snapshot(project_id, snapshot_mode)
+        await send(await encode_off_loop(wire_format, project_snapshot), "snapshot")
+        return project_snapshot["seq"]
 
-        # asyncio.create_task(improve_dashboard_data())
-        
-        try:
-            project_data = get_project_data(project_id)
-            await websocket.send_text(json.dumps(project_data))
-            pass
-        except WebSocketDisconnect:
-            logger.info(f"[dashboard_websocket] WebSocket disconnected for dashboard {project_id}")
-            websocket_open = False
-            break
-        except Exception as e:
-            logger.error(f"[dashboard_websocket] Error sending message over WebSocket project_id={project_id}", exc_info=True)
-            websocket_open = False
-            break
-
-    # Safely remove the websocket connection.
-    if project_id in websocket_connections and websocket in websocket_connections[project_id]:
-        websocket_connections[project_id].remove(websocket)
+    receive = get = None
+    try:
+        # Send initial dashboard data.
+        changes = None if since is None else await get_changes_since(project_id, since)
+        if changes is None:
+            seq = await send_snapshot()
+        else:
+            for change in changes:
+                await send(wire_format.encode(change), "delta")
+            seq = changes[-1]["seq"] if changes else since
+
+        # Race the client's side against the queue, so a disconnect (or a server shutdown) is noticed
+        # even while the project is quiet. Dashboards don't send anything else, anything they do is ignored.
+        receive = asyncio.ensure_future(websocket.receive())
+        get = asyncio.ensure_future(subscriber.queue.get())
+        while True:
+            logger.info(f"[dashboard_websocket] waiting for event")
+            done, _ = await asyncio.wait({receive, get}, return_when=asyncio.FIRST_COMPLETED)
+            if receive in done:
+                if receive.result()["type"] == "websocket.disconnect":
+                    logger.info(f"[dashboard_websocket] WebSocket disconnected for dashboard {project_id}")
+                    break
+                receive = asyncio.ensure_future(websocket.receive())
+            if get not in done:
+                continue
+            message = get.result()
+            get = asyncio.ensure_future(subscriber.queue.get())
+
+            if message == RESYNC:
+                seq = await send_snapshot()
+                continue
+            if message == DISCONNECT:
+                logger.info(f"[dashboard_websocket] closing slow dashboard {project_id}")
+                await websocket.close(code=1013)
+                break
+
+            message_seq, encoded = message
+            if message_seq is None:
+                await send(encoded, "partial")  # ephemeral, e.g. a partial haiku
+                continue
+            if message_seq <= seq:
+                continue  # already covered by the initial send
+            await send(encoded, "broadcast")  # a delta, or a snapshot when the broadcaster fell behind
+            seq = message_seq
+
+    except WebSocketDisconnect:
+        logger.info(f"[dashboard_websocket] WebSocket disconnected for dashboard {project_id}")
+    except Exception as e:
+        logger.error(f"[dashboard_websocket] Error sending message over WebSocket project_id={project_id}", exc_info=True)
+    finally:
+        for task in (receive, get):
+            if task:
+                task.cancel()
+        websocket_connections_gauge.dec()
+        await unsubscribe_dashboard(project_id, subscriber)
+
+        # Safely remove the websocket connection.
+        if project_id in websocket_connections and websocket in websocket_connections[project_id]:
+            websocket_connections[project_id].remove(websocket)
+            if not websocket_connections[project_id]:
+                del websocket_connections[project_id]
+
+
+def get_next_prune_time(now: datetime) -> datetime:
+    interval = settings.dashboard_feed_prune_interval_s
+    return datetime.fromtimestamp((now.timestamp() // interval + 1) * interval)
+
+
+async def schedule_change_feed_pruning():
+    """ Queue the next feed prune. Every process calls this, the idempotency key keeps it to one job per interval """
+    run_at = get_next_prune_time(datetime.utcnow())
+    await enqueue_job(
+        "prune_change_feeds",
+        {},
+        idempotency_key=f"prune-change-feeds:{run_at.isoformat()}",
+        run_after=run_at,
+    )
+
+
+@job_handler()
+async def prune_change_feeds():
+    """ Background job: trim the dashboards' change feeds, then queue the next run """
+    pruned = await prune_change_feed()
+    await schedule_change_feed_pruning()
+    return {"pruned": pruned}
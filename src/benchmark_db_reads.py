@@ -0,0 +1,130 @@
+''' Measures read latency on the event loop while background jobs write to the database.
+
+Usage: `python -m benchmark_db_reads --duration 20 --readers 10 --writers 4`
+
+Starts `fakeopenai` and `uvicorn app:app` on a fresh SQLite database (as `loadtest` does), seeds
+a project with haikus and image prompts, then has `--readers` clients poll `GET /projects/` for
+`--duration` seconds, first on their own and then while `--writers` clients keep queueing
+`/haiku-critique` and `/generate-image` jobs for the in-app job worker. Prints both runs as
+JSON: read p50 / p99 / max, and how many critiques and images the jobs saved meanwhile. With
+the database calls on the event loop's thread, every job's write stalled the reads behind it.
+'''
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+from loadtest import get_app_env, get_fake_provider_args, read_metric, stop_process, summarize, wait_for_http
+
+
+async def seed(http: httpx.AsyncClient, haikus: int) -> tuple:
+    ''' A project with `haikus` haikus, each with an image prompt, returns (haiku ids, (prompt id, haiku id)s) '''
+    project_id = (await http.post("/projects/", json={"name": "benchmark"})).json()["project_id"]
+    for i in range(haikus):
+        await http.post("/projects/haiku", json={"project_id": project_id, "description": f"benchmark {i}"})
+    haiku_ids = [haiku["id"] for haiku in (await http.get(f"/projects/{project_id}/haikus", params={"limit": 100})).json()["items"]]
+    for haiku_id in haiku_ids:
+        await http.post("/projects/generate-image-prompts", json={"haiku_id": haiku_id})
+
+    prompts = []
+    for haiku_id in haiku_ids:
+        while not (page := (await http.get(f"/projects/haikus/{haiku_id}/image-prompts")).json())["items"]:
+            await asyncio.sleep(0.1)  # still queued
+        prompts += [(prompt["id"], haiku_id) for prompt in page["items"]]
+    return haiku_ids, prompts
+
+
+async def read_projects(http: httpx.AsyncClient, latencies: list, errors: list, deadline: float):
+    while time.monotonic() < deadline:
+        started_at = time.perf_counter()
+        try:
+            (await http.get("/projects/")).raise_for_status()
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+            continue
+        latencies.append(time.perf_counter() - started_at)
+
+
+async def queue_writes(http: httpx.AsyncClient, haiku_ids: list, prompts: list, errors: list, deadline: float, pause: float):
+    while time.monotonic() < deadline:
+        prompt_id, haiku_id = random.choice(prompts)
+        try:
+            await http.post("/projects/haiku-critique", json={"haiku_id": random.choice(haiku_ids)})
+            await http.post("/projects/generate-image", json={"prompt_id": prompt_id, "haiku_id": haiku_id})
+        except httpx.HTTPError as e:
+            # a rare keep-alive connection that never gets its response, the server never saw the request
+            errors.append(type(e).__name__)
+        await asyncio.sleep(pause)
+
+
+async def count_saved(http: httpx.AsyncClient) -> float:
+    ''' Jobs that have succeeded so far '''
+    metrics = (await http.get("/metrics")).text
+    return read_metric(metrics, "job_queue_depth").get('status="succeeded"', 0)
+
+
+async def run_scenario(name: str, http: httpx.AsyncClient, haiku_ids: list, prompts: list, writers: int, args) -> dict:
+    latencies, errors = [], []
+    succeeded_before = await count_saved(http)
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(
+        *[read_projects(http, latencies, errors, deadline) for _ in range(args.readers)],
+        *[queue_writes(http, haiku_ids, prompts, errors, deadline, args.writer_pause) for _ in range(writers)],
+    )
+    return {
+        "scenario": name,
+        "reads": len(latencies),
+        **summarize(latencies),
+        "jobs_succeeded": int(await count_saved(http) - succeeded_before),
+        "client_errors": dict(Counter(errors)),
+    }
+
+
+async def main(args):
+    base_url = f"http://127.0.0.1:{args.port}"
+    with tempfile.TemporaryDirectory() as directory:
+        fake = subprocess.Popen([sys.executable, "-m", "fakeopenai", *get_fake_provider_args(args)])
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--port", str(args.port), "--log-level", "warning"],
+            env=get_app_env(args, directory),
+        )
+        try:
+            await wait_for_http(f"http://127.0.0.1:{args.fake_port}/stats", fake)
+            await wait_for_http(f"{base_url}/metrics", server)
+            async with httpx.AsyncClient(base_url=base_url, timeout=30) as http:
+                haiku_ids, prompts = await seed(http, args.haikus)
+                results = [
+                    await run_scenario("reads only", http, haiku_ids, prompts, 0, args),
+                    await run_scenario("reads while jobs write", http, haiku_ids, prompts, args.writers, args),
+                ]
+        finally:
+            for process in (server, fake):
+                stop_process(process)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark GET /projects/ latency while image and critique jobs write.")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per scenario")
+    parser.add_argument("--readers", type=int, default=10)
+    parser.add_argument("--writers", type=int, default=4, help="clients queueing a critique and an image job at a time")
+    parser.add_argument("--writer-pause", type=float, default=0.05, help="seconds between a writer's pairs of jobs")
+    parser.add_argument("--haikus", type=int, default=20, help="seeded haikus, up to 100")
+    parser.add_argument("--job-concurrency", type=int, default=16)
+    parser.add_argument("--port", type=int, default=8022)
+    parser.add_argument("--fake-port", type=int, default=8023)
+    parser.add_argument("--chat-latency", default="fixed:50")
+    parser.add_argument("--image-latency", default="fixed:200")
+    parser.add_argument("--image-size", default="512x512")
+    args = parser.parse_args()
+    # what get_fake_provider_args / get_app_env expect from a loadtest run
+    args.error_rate = args.rate_limit_rate = 0.0
+    args.provider_limits = False
+    asyncio.run(main(args))
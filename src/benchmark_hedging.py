@@ -0,0 +1,90 @@
+''' Measures what hedging buys in tail latency, against two `fakeopenai` endpoints.
+
+Usage: `python -m benchmark_hedging --requests 400 --concurrency 20`
+
+Starts a primary with a heavy-tailed latency (`--primary-latency`, lognormal with a large sigma)
+and a secondary with a steadier one, routes the same model to both, and runs the same calls
+through `llm_router` with hedging off and then on. Prints both runs as JSON: p50 / p95 / p99,
+how many calls were hedged and how many requests each endpoint served. The hedged run sends
+a few percent more requests in exchange for a shorter tail.
+'''
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+
+from benchmark_llm_client import wait_for_server
+from config import settings
+from llmrouter import LLMRouter
+from metrics import percentile
+
+
+async def run_scenario(name: str, router: LLMRouter, stats_urls: list, args) -> dict:
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    hedged = 0
+
+    def send_to(endpoint, client):
+        return client.chat.completions.create(model=endpoint.model, messages=[{"role": "user", "content": "benchmark"}])
+
+    async def call():
+        nonlocal hedged
+        async with semaphore:
+            started_at = time.perf_counter()
+            _, endpoint = await router.run("benchmark", "gpt-4o-mini", send_to)
+            latencies.append(time.perf_counter() - started_at)
+            hedged += endpoint is not router.routes["benchmark"][0]
+
+    before = [await wait_for_server(url) for url in stats_urls]
+    # warm up the primary's latency window, so hedging has a p95 to go by
+    await asyncio.gather(*[call() for _ in range(settings.llm_hedge_min_samples)])
+    latencies.clear()
+    hedged = 0
+    await asyncio.gather(*[call() for _ in range(args.requests)])
+    after = [await wait_for_server(url) for url in stats_urls]
+
+    return {
+        "scenario": name,
+        "requests": args.requests,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "won_by_secondary": hedged,
+        "requests_served": [end["requests"] - start["requests"] for start, end in zip(before, after)],
+    }
+
+
+async def main(args):
+    ports = (args.port, args.port + 1)
+    servers = [
+        subprocess.Popen([sys.executable, "-m", "fakeopenai", "--port", str(port), "--chat-latency", latency])
+        for port, latency in zip(ports, (args.primary_latency, args.secondary_latency))
+    ]
+    routes = {"benchmark": [
+        {"model": "gpt-4o-mini", "base_url": f"http://127.0.0.1:{port}/v1", "api_key": "benchmark"} for port in ports
+    ]}
+    stats_urls = [f"http://127.0.0.1:{port}/stats" for port in ports]
+    try:
+        results = []
+        for hedging_enabled in (False, True):
+            settings.llm_hedging_enabled = hedging_enabled
+            name = "hedged" if hedging_enabled else "primary only"
+            results.append(await run_scenario(name, LLMRouter(routes), stats_urls, args))
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark hedged LLM requests against two local fake servers.")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--primary-latency", default="lognormal:200,1.0")
+    parser.add_argument("--secondary-latency", default="lognormal:250,0.3")
+    parser.add_argument("--port", type=int, default=8012)
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,91 @@
+''' Measures what connection reuse in the shared OpenAI client is worth, against `fakeopenai`.
+
+Usage: `python -m benchmark_llm_client --requests 500 --concurrency 20`
+
+Runs the same burst of chat calls through a client with the configured pool (keep-alive) and
+through one that closes every connection after use, and prints both runs as JSON. The fake
+server is plain HTTP on localhost, so this only counts TCP setup: against the provider each new
+connection also costs a TLS handshake, over a real network round trip.
+'''
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+
+import httpx
+
+from llm import create_llm_client, get_llm_limits
+from metrics import percentile
+
+
+async def wait_for_server(stats_url: str, timeout: float = 15):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as http:
+        while True:
+            try:
+                return (await http.get(stats_url)).json()
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+async def run_scenario(name: str, base_url: str, stats_url: str, limits: httpx.Limits, requests: int, concurrency: int) -> dict:
+    client = create_llm_client(base_url=base_url, limits=limits, http2=False)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def call(i):
+        async with semaphore:
+            started_at = time.perf_counter()
+            await client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "user", "content": f"benchmark {i}"}])
+            latencies.append(time.perf_counter() - started_at)
+
+    before = await wait_for_server(stats_url)
+    started_at = time.perf_counter()
+    await asyncio.gather(*[call(i) for i in range(requests)])
+    seconds = time.perf_counter() - started_at
+    after = await wait_for_server(stats_url)
+    await client.close()
+
+    return {
+        "scenario": name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(requests / seconds, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "connections_opened": after["connections"] - before["connections"],
+    }
+
+
+async def main(args):
+    server = subprocess.Popen([
+        sys.executable, "-m", "fakeopenai", "--port", str(args.port), "--chat-latency", f"fixed:{args.latency_ms}",
+    ])
+    base_url = f"http://127.0.0.1:{args.port}/v1"
+    stats_url = f"http://127.0.0.1:{args.port}/stats"
+    try:
+        await wait_for_server(stats_url)
+        no_keepalive = httpx.Limits(max_connections=get_llm_limits().max_connections, max_keepalive_connections=0)
+        results = [
+            await run_scenario("keep-alive", base_url, stats_url, get_llm_limits(), args.requests, args.concurrency),
+            await run_scenario("no keep-alive", base_url, stats_url, no_keepalive, args.requests, args.concurrency),
+        ]
+    finally:
+        server.terminate()
+        server.wait()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark OpenAI client connection reuse against a local fake server.")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--port", type=int, default=8011)
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,123 @@
+''' Measures what the batched log sink is worth in LLM calls per second, against `fakeopenai`.
+
+Usage: `python -m benchmark_llm_logging --requests 2000 --concurrency 50`
+
+Runs the same burst of `ask_llm` calls on a fresh SQLite database twice: with `llm_log_sink`
+stopped, so each call inserts and commits its own `ai_llm_logs` row before returning (as every
+call did before logsink.py), and with the sink running, so calls only queue their row. Prints
+both runs as JSON: calls per second, p50 / p99 of `ask_llm` and of the wait on its log write,
+and the rows each run left in the table, which should equal the calls. The OpenAI SDK's own
+request building costs several ms of CPU per call, so both runs top out around 100 calls per
+second on one core and the log wait is the number to compare.
+'''
+import os
+import tempfile
+
+# before anything imports config: a throwaway database, and no cache or limits between the calls and the fake
+benchmark_dir = tempfile.mkdtemp(prefix="benchmark_llm_logging_")
+os.environ.update({
+    "DB_ENGINE_URL": f"sqlite:///{benchmark_dir}/benchmark.sqlite",
+    "OPENAI_API_KEY": "benchmark",
+    "LLM_CACHE_ENABLED": "false",
+    "LLM_MAX_CONCURRENCY": "1000",
+    "LLM_REQUESTS_PER_MINUTE": "10000000",
+    "LLM_TOKENS_PER_MINUTE": "10000000000",
+    "TRACING_EXPORTER": "none",
+})
+
+import argparse
+import asyncio
+import json
+import logging
+import subprocess
+import sys
+import time
+
+from sqlalchemy import func, select
+
+from apps.main.models import LLMLogTable
+from benchmark_llm_client import wait_for_server
+from config import settings
+from database import get_async_session
+from logger import logger
+from logsink import llm_log_sink
+from metrics import percentile
+from migrate import run_migrations
+
+
+async def count_logs(name: str) -> int:
+    async with get_async_session() as session:
+        return await session.scalar(select(func.count()).where(LLMLogTable.name == name))
+
+
+async def run_scenario(name: str, requests: int, concurrency: int) -> dict:
+    from llm import ask_llm
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, log_waits = [], []
+    write = llm_log_sink.write
+
+    async def timed_write(record):
+        # how long the call waits on its log row
+        started_at = time.perf_counter()
+        try:
+            return await write(record)
+        finally:
+            log_waits.append(time.perf_counter() - started_at)
+
+    async def call(i):
+        async with semaphore:
+            started_at = time.perf_counter()
+            await ask_llm([{"role": "user", "content": f"benchmark {i}"}], model="gpt-4o-mini", name=name)
+            latencies.append(time.perf_counter() - started_at)
+
+    llm_log_sink.write = timed_write
+    started_at = time.perf_counter()
+    try:
+        await asyncio.gather(*[call(i) for i in range(requests)])
+    finally:
+        del llm_log_sink.write
+    seconds = time.perf_counter() - started_at
+    await llm_log_sink.flush()  # rows still queued when the burst ended
+
+    return {
+        "scenario": name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "seconds": round(seconds, 3),
+        "calls_per_second": round(requests / seconds, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "log_write_p50_ms": round(percentile(log_waits, 0.5) * 1000, 2),
+        "log_write_p99_ms": round(percentile(log_waits, 0.99) * 1000, 2),
+        "rows_logged": await count_logs(name),
+    }
+
+
+async def main(args):
+    server = subprocess.Popen([
+        sys.executable, "-m", "fakeopenai", "--port", str(args.port), "--chat-latency", f"fixed:{args.latency_ms}",
+    ])
+    try:
+        await wait_for_server(f"http://127.0.0.1:{args.port}/stats")
+        results = [await run_scenario("inline", args.requests, args.concurrency)]
+        await llm_log_sink.start()
+        results.append(await run_scenario("batched", args.requests, args.concurrency))
+        await llm_log_sink.stop()
+    finally:
+        server.terminate()
+        server.wait()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ask_llm throughput with inline vs batched log writes.")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--port", type=int, default=8012)
+    args = parser.parse_args()
+    settings.llm_base_url = f"http://127.0.0.1:{args.port}/v1"  # read when the client is first created
+    logger.setLevel(logging.WARNING)  # ask_llm logs every call at INFO
+    run_migrations()
+    asyncio.run(main(args))
@@ -0,0 +1,124 @@
+''' Measures what loading a large project costs as one full snapshot vs the summary and paginated endpoints.
+
+Usage: `python -m benchmark_snapshot --haikus 5000 --images-per-haiku 10`
+
+Seeds a fresh SQLite database with one project of `--haikus` haikus, each with two image
+prompts, `--images-per-haiku` image references (rows only, no blobs) and a critique. Then,
+on its own each time: the full snapshot the dashboard socket used to send on connect, the
+summary snapshot it sends now, the first page of haikus a dashboard shows next to it, and
+every page one after the other (a client that scrolls to the bottom). Prints JSON: time,
+bytes as the socket encodes them (`wire.py` json) and the peak Python memory for each.
+'''
+import os
+import tempfile
+
+# before anything imports config
+benchmark_dir = tempfile.mkdtemp(prefix="benchmark_snapshot_")
+os.environ.update({
+    "DB_ENGINE_URL": f"sqlite:///{benchmark_dir}/benchmark.sqlite",
+    "BLOB_STORE_PATH": os.path.join(benchmark_dir, "blobs"),
+})
+
+import argparse
+import asyncio
+import datetime
+import json
+import time
+import tracemalloc
+from uuid import uuid4
+
+from sqlalchemy import insert
+
+from apps.main.models import (
+    HaikuCritiqueTable, HaikuImagePromptTable, HaikuImageTable, HaikuTable, ProjectTable,
+    get_project_haikus_page, get_project_snapshot,
+)
+from database import get_engine
+from migrate import run_migrations
+from wire import wire_formats
+
+PROMPTS_PER_HAIKU = 2
+
+
+def seed(haikus: int, images_per_haiku: int) -> int:
+    ''' Inserts the project in bulk, returns its id '''
+    started_at = datetime.datetime(2025, 1, 1)
+    with get_engine().begin() as connection:
+        project_id = connection.execute(insert(ProjectTable).values(name="benchmark")).inserted_primary_key[0]
+        for first in range(0, haikus, 500):
+            haiku_rows, prompt_rows, image_rows, critique_rows = [], [], [], []
+            for h in range(first, min(first + 500, haikus)):
+                created_at = started_at + datetime.timedelta(seconds=h)
+                haiku_rows.append({"id": h + 1, "project_id": project_id, "title": f"Haiku number {h}", "created_at": created_at,
+                                   "text": "An old silent pond\nA frog jumps into the pond—\nSplash! Silence again."})
+                critique_rows.append({"id": str(uuid4()), "haiku_id": h + 1, "creativity_score": 7, "vocabulary_density": 1, "rizz_level": 3, "created_at": created_at})
+                for p in range(PROMPTS_PER_HAIKU):
+                    prompt_id = str(uuid4())
+                    prompt_rows.append({"id": prompt_id, "haiku_id": h + 1, "created_at": created_at,
+                                        "image_prompt": "A quiet pond at dawn, mist over the water, a frog mid-leap, ukiyo-e woodblock style."})
+                    image_rows += [
+                        {"id": str(uuid4()), "haiku_image_prompt_id": prompt_id, "blob_hash": "0" * 64, "size": 200_000, "mime_type": "image/png", "created_at": created_at}
+                        for _ in range(p, images_per_haiku, PROMPTS_PER_HAIKU)
+                    ]
+            for table, rows in ((HaikuTable, haiku_rows), (HaikuImagePromptTable, prompt_rows), (HaikuImageTable, image_rows), (HaikuCritiqueTable, critique_rows)):
+                connection.execute(insert(table), rows)
+    return project_id
+
+
+async def read_all_pages(project_id: int, limit: int) -> dict:
+    pages, cursor = [], None
+    while True:
+        page = await get_project_haikus_page(project_id, cursor=cursor, limit=limit)
+        pages.append(page)
+        if not (cursor := page["next_cursor"]):
+            return {"pages": pages}
+
+
+async def measure(name: str, load) -> dict:
+    encode = wire_formats["json"].encode
+    started_at = time.perf_counter()
+    data = await load()
+    loaded_at = time.perf_counter()
+    encoded = encode(data)
+    finished_at = time.perf_counter()
+
+    # again under tracemalloc, which slows everything down, for the memory alone
+    tracemalloc.start()
+    encode(await load())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "scenario": name,
+        "load_ms": round((loaded_at - started_at) * 1000, 1),
+        "encode_ms": round((finished_at - loaded_at) * 1000, 1),
+        "bytes": len(encoded),
+        "peak_memory_mb": round(peak / 2**20, 1),
+    }
+
+
+async def main(args):
+    async def first_paint():
+        # what a dashboard loads on connect in summary mode
+        summary = await get_project_snapshot(project_id, mode="summary")
+        return {"snapshot": summary, "page": await get_project_haikus_page(project_id, limit=args.page_size)}
+
+    project_id = seed(args.haikus, args.images_per_haiku)
+    await get_project_snapshot(project_id, mode="summary")  # warm the pool and the page cache
+    results = [
+        await measure("full snapshot", lambda: get_project_snapshot(project_id, mode="full")),
+        await measure("summary snapshot", lambda: get_project_snapshot(project_id, mode="summary")),
+        await measure(f"summary + first page of {args.page_size}", first_paint),
+        await measure(f"every page of {args.all_pages_size}", lambda: read_all_pages(project_id, args.all_pages_size)),
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark a large project's full snapshot against its summary and pages.")
+    parser.add_argument("--haikus", type=int, default=5000)
+    parser.add_argument("--images-per-haiku", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--all-pages-size", type=int, default=100, help="page size when reading every page")
+    args = parser.parse_args()
+    run_migrations()
+    asyncio.run(main(args))
@@ -0,0 +1,89 @@
+''' Checks how long the app takes to import and to answer its first request, against a budget.
+
+Usage: `python -m benchmark_startup` (exits with 1 when over budget, so it can gate CI)
+
+Import time comes from `python -X importtime -c "import app"`, with the slowest top-level
+imports listed to show where a regression came from. Time to first request is from launching
+`uvicorn app:app` on a fresh SQLite database to its first `GET /metrics` response, so it
+includes the migrations. Run it a few times, the first run also pays for cold disk caches.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+
+# budgets, in ms: raise them deliberately, alongside the change that needs it
+import_budget_ms = 1500
+first_request_budget_ms = 4000
+
+
+def measure_import(module: str = "app") -> dict:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):   # nested imports are indented under their importer
+            imports.append((name.strip(), int(cumulative_us)))
+
+    total_ms = next(us for name, us in imports if name == module) / 1000
+    slowest = sorted((item for item in imports if item[0] != module), key=lambda item: -item[1])[:10]
+    return {"import_ms": round(total_ms, 1), "slowest_imports_ms": {name: round(us / 1000, 1) for name, us in slowest}}
+
+
+def measure_first_request(port: int, timeout: float = 60) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **os.environ,
+            "DB_ENGINE_URL": f"sqlite:///{directory}/startup.sqlite",
+            "BLOB_STORE_PATH": os.path.join(directory, "blobs"),
+        }
+        started_at = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+            env=env,
+        )
+        try:
+            while True:
+                try:
+                    if httpx.get(f"http://127.0.0.1:{port}/metrics").status_code == 200:
+                        return (time.perf_counter() - started_at) * 1000
+                except httpx.TransportError:
+                    pass
+                if server.poll() is not None:
+                    raise RuntimeError(f"uvicorn exited with {server.returncode}")
+                if time.perf_counter() - started_at > timeout:
+                    raise TimeoutError(f"No response within {timeout}s")
+                time.sleep(0.02)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure import time and time to first request against a budget.")
+    parser.add_argument("--port", type=int, default=8012)
+    parser.add_argument("--import-budget-ms", type=float, default=import_budget_ms)
+    parser.add_argument("--first-request-budget-ms", type=float, default=first_request_budget_ms)
+    args = parser.parse_args()
+
+    report = measure_import()
+    report["first_request_ms"] = round(measure_first_request(args.port), 1)
+    report["over_budget"] = [
+        name for name, value, budget in (
+            ("import_ms", report["import_ms"], args.import_budget_ms),
+            ("first_request_ms", report["first_request_ms"], args.first_request_budget_ms),
+        ) if value > budget
+    ]
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if report["over_budget"] else 0)
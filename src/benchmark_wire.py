@@ -0,0 +1,97 @@
+''' Encode time and bytes on the wire for a large dashboard snapshot, per wire format.
+
+Usage: `python -m benchmark_wire --haikus 2000`
+
+Compares the stdlib encoder the dashboard used to use with the formats in `wire.py`. The
+"deflated" size is what permessage-deflate would send for a whole message. With
+`--inline-image-kb`, each image also carries that many bytes of data (base64 text in JSON,
+raw binary in MessagePack), E.g. for clients that want images inline rather than by URL.
+'''
+import argparse
+import base64
+import json
+import os
+import statistics
+import time
+import zlib
+from datetime import datetime
+
+from wire import wire_formats
+
+
+def make_snapshot(haikus: int, inline_image_kb: int = 0, binary: bool = False) -> dict:
+    created_at = datetime(2025, 1, 1).isoformat()
+    image_data = os.urandom(inline_image_kb * 1024)
+
+    def make_image(i):
+        image = {"id": f"image-{i}", "url": f"/projects/images/image-{i}", "thumbnail_url": f"/projects/images/image-{i}?size=thumb", "mime_type": "image/png", "created_at": created_at}
+        if inline_image_kb:
+            image["data"] = image_data if binary else base64.b64encode(image_data).decode()
+        return image
+
+    return {
+        "type": "snapshot",
+        "mode": "full",
+        "seq": 123456,
+        "project": {
+            "id": 1,
+            "name": "benchmark",
+            "haikus": [
+                {
+                    "id": h,
+                    "title": f"Haiku number {h}",
+                    "text": "An old silent pond\nA frog jumps into the pond—\nSplash! Silence again.",
+                    "created_at": created_at,
+                    "critiques": [{"id": h, "creativity_score": 7, "vocabulary_density": 0.8, "rizz_level": "medium"}],
+                    "image_prompts": [
+                        {
+                            "id": f"prompt-{h}-{p}",
+                            "prompt_text": "A quiet pond at dawn, mist over the water, a frog mid-leap, ukiyo-e woodblock style, muted greens and blues.",
+                            "created_at": created_at,
+                            "images": [make_image(f"{h}-{p}")],
+                        }
+                        for p in range(3)
+                    ],
+                }
+                for h in range(haikus)
+            ],
+        },
+    }
+
+
+def deflated_size(encoded) -> int:
+    data = encoded.encode() if isinstance(encoded, str) else encoded
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)   # raw deflate, as permessage-deflate sends it
+    return len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))
+
+
+def measure(name: str, encode, snapshot: dict, repeats: int) -> dict:
+    timings = []
+    for _ in range(repeats):
+        started_at = time.perf_counter()
+        encoded = encode(snapshot)
+        timings.append(time.perf_counter() - started_at)
+    size = len(encoded.encode() if isinstance(encoded, str) else encoded)
+    return {
+        "format": name,
+        "encode_ms": round(statistics.median(timings) * 1000, 2),
+        "bytes": size,
+        "deflated_bytes": deflated_size(encoded),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark dashboard snapshot encodings.")
+    parser.add_argument("--haikus", type=int, default=2000)
+    parser.add_argument("--inline-image-kb", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    text_snapshot = make_snapshot(args.haikus, args.inline_image_kb)
+    binary_snapshot = make_snapshot(args.haikus, args.inline_image_kb, binary=True)
+    results = [
+        measure("stdlib json", json.dumps, text_snapshot, args.repeats),
+        measure("json (orjson)", wire_formats["json"].encode, text_snapshot, args.repeats),
+        measure("msgpack", wire_formats["msgpack"].encode, binary_snapshot, args.repeats),
+    ]
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,120 @@
+import hashlib
+import mmap
+import os
+import tempfile
+
+from config import settings
+from logger import logger
+
+
+def guess_mime_type(data: bytes) -> str:
+    ''' Sniff the handful of image formats our providers return '''
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    return 'application/octet-stream'
+
+
+class BlobStore:
+    ''' Content-addressed storage: blobs are written once and looked up by their sha256 hex digest '''
+
+    def put(self, data: bytes) -> str:
+        raise NotImplementedError
+
+    def exists(self, digest: str) -> bool:
+        raise NotImplementedError
+
+    def size(self, digest: str) -> int:
+        raise NotImplementedError
+
+    def iter_range(self, digest: str, start: int = 0, end: int = None, chunk_size: int = 64 * 1024):
+        ''' Yield the bytes of [start, end] (inclusive, like an http Range) in chunks '''
+        raise NotImplementedError
+
+    def get(self, digest: str) -> bytes:
+        return b''.join(self.iter_range(digest))
+
+
+class LocalBlobStore(BlobStore):
+    ''' Stores blobs on the local filesystem, sharded as <root>/ab/cd/abcd... '''
+
+    def __init__(self, root: str, use_mmap: bool = False):
+        self.root = root
+        self.use_mmap = use_mmap
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        if len(digest) != 64 or not all(c in '0123456789abcdef' for c in digest):
+            raise ValueError(f"Invalid blob digest: {digest}")
+        return os.path.join(self.root, digest[0:2], digest[2:4], digest)
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file and rename so readers never see a partial blob.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        logger.info(f"[LocalBlobStore] stored blob {digest} ({len(data)} bytes)")
+        return digest
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def size(self, digest: str) -> int:
+        return os.path.getsize(self.path(digest))
+
+    def iter_range(self, digest: str, start: int = 0, end: int = None, chunk_size: int = 64 * 1024):
+        path = self.path(digest)
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if end is None or end >= size:
+                end = size - 1
+            if size == 0 or start > end:
+                return
+
+            if self.use_mmap:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for offset in range(start, end + 1, chunk_size):
+                        yield mm[offset:min(offset + chunk_size, end + 1)]
+                return
+
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+blob_store_backends = {
+    'local': lambda: LocalBlobStore(settings.blob_store_path, use_mmap=settings.blob_store_mmap),
+}
+
+
+def get_blob_store() -> BlobStore:
+    try:
+        return blob_store_backends[settings.blob_store_backend]()
+    except KeyError:
+        raise ValueError(f"Unknown blob store backend: {settings.blob_store_backend}")
+
+
+blob_store = get_blob_store()
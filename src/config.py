@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -6,8 +8,147 @@ class Settings(BaseSettings):
 
     openai_api_key: str = ""
     db_engine_url: str = "sqlite:///./ai_workflow_starter.sqlite"
+    db_echo: bool = False  # log every SQL statement
+
+    # SQLite tuning, applied to every new connection (see database.py). WAL lets reads run alongside the
+    # one writer, and a writer waits up to busy_timeout for the lock instead of failing with "database is locked"
+    db_sqlite_journal_mode: str = "wal"
+    db_sqlite_synchronous: str = "normal"    # with WAL, only the last commits can be lost on power loss, never corrupted
+    db_sqlite_busy_timeout_ms: int = 5000
+    db_sqlite_mmap_size: int = 256 * 1024 * 1024
+
+    # connection pool for other backends (E.g. Postgres). Each process has two engines (sync and async), each with its own pool
+    db_pool_size: int = 10
+    db_max_overflow: int = 20
+    db_pool_timeout: int = 30        # seconds to wait for a connection before failing
+    db_pool_recycle: int = 1800      # seconds, connections older than this are replaced
+    db_pool_pre_ping: bool = True    # check a connection before handing it out, so a restarted server isn't an error
 
     env: str = "dev"
+
+    # generated images are stored here, addressed by sha256
+    blob_store_backend: str = "local"
+    blob_store_path: str = "./blobs"
+    blob_store_mmap: bool = False
+    # generated images also get resized copies for the dashboard, made in a process pool, see imagederivatives.py
+    image_derivative_sizes: dict = {"thumb": 256, "medium": 512}
+    image_derivative_formats: list = ["webp", "jpeg"]
+    image_derivative_quality: int = 80
+    image_derivative_workers: int = 2
+
+    # dashboards further behind than this many changes are sent a full snapshot instead of deltas
+    dashboard_feed_max_gap: int = 500
+    # older deltas are pruned by a periodic job rather than on every change
+    dashboard_feed_prune_interval_s: int = 300
+    # events arriving within this window are pushed to dashboards as one update
+    dashboard_debounce_ms: int = 100
+    # per-socket backlog; when a slow socket overflows it, either "snapshot" (resync it) or "disconnect"
+    dashboard_subscriber_queue_size: int = 100
+    dashboard_slow_consumer_policy: str = "snapshot"
+    # dashboard snapshots are encoded (see wire.py) in a thread pool of this size, off the event loop
+    wire_encode_workers: int = 2
+
+    # "local" for a single worker, "unix" to share project events between uvicorn workers on one host
+    event_bus_backend: str = "local"
+    event_bus_socket_path: str = "/tmp/ai_workflow_starter_events.sock"
+
+    # identical ask_llm calls are answered from an in-memory LRU, and optionally from earlier ai_llm_logs rows
+    llm_cache_enabled: bool = True
+    llm_cache_max_entries: int = 1024
+    llm_cache_ttl_seconds: int = 3600
+    llm_cache_persistent: bool = False
+    # near-duplicate prompts (E.g. "a cat in rain" / "cat in the rain") can reuse an answer, see semanticcache.py.
+    # Only for call names with a cosine similarity threshold here, unless semantic_cache_default_threshold is set
+    semantic_cache_enabled: bool = False
+    semantic_cache_thresholds: dict = {"haiku-generate": 0.9}
+    semantic_cache_default_threshold: Optional[float] = None
+    semantic_cache_embedder: str = "hashing"
+    semantic_cache_dims: int = 1024
+    semantic_cache_max_entries: int = 2000   # per (model, name)
+    semantic_cache_ttl_seconds: int = 86400
+
+    # the shared OpenAI client, see create_llm_client in llm.py. llm_base_url points it at another
+    # OpenAI-compatible server (E.g. `python -m fakeopenai`), None is the provider
+    llm_base_url: Optional[str] = None
+    llm_http2: bool = True
+    llm_max_connections: int = 100
+    llm_max_keepalive_connections: int = 20
+    llm_keepalive_expiry: float = 60            # seconds an idle connection is kept open
+    llm_connect_timeout: float = 5
+    llm_write_timeout: float = 30
+    llm_pool_timeout: float = 30                # seconds to wait for a free connection
+    llm_text_read_timeout: float = 120          # chat calls; for streams, the longest gap between chunks
+    llm_image_read_timeout: float = 180
+
+    # ai_llm_logs rows are written in batches of up to llm_log_batch_size, at least every llm_log_flush_ms
+    llm_log_batch_size: int = 100
+    llm_log_flush_ms: int = 250
+    llm_log_max_pending: int = 10000
+    # successful responses: the fraction kept in full, the rest only keep id / model / usage
+    llm_log_response_sample_rate: float = 1.0
+    llm_log_response_max_bytes: int = 65536
+
+    # per call name, the endpoints to send it to, see llmrouter.py. The first healthy one is the primary; a call
+    # it hasn't answered within its p95 is hedged to the next, and a failing one falls back to the next. E.g.
+    # LLM_ROUTES='{"haiku-generate": [{"model": "gpt-4o-mini"}, {"model": "gpt-4o-mini", "base_url": "https://example.com/v1", "api_key": "..."}, {"model": "gpt-4o"}]}'
+    llm_routes: dict = {}
+    llm_hedging_enabled: bool = True
+    llm_hedge_min_samples: int = 20            # no hedging until an endpoint has this many latencies for its p95
+    llm_hedge_min_delay_ms: int = 250
+    llm_latency_window: int = 200              # recent latencies kept per endpoint
+    llm_latency_ewma_alpha: float = 0.2
+    llm_endpoint_failure_threshold: int = 3    # failures in a row before an endpoint is skipped for the cooldown
+    llm_endpoint_cooldown_seconds: float = 30
+
+    # a daily job moves ai_llm_logs rows older than llm_log_retention_days into zstd-compressed segment
+    # files, one per day, under llm_log_archive_path (see logarchive.py). 0 keeps every row in the table
+    llm_log_retention_days: int = 30
+    llm_log_archive_path: str = "./llm_log_archive"
+    llm_log_compaction_hour: int = 3            # UTC
+    llm_log_compaction_batch_size: int = 5000
+    llm_log_compression_level: int = 10
+
+    # provider call scheduling, see llmscheduler.py. Per-model overrides go in llm_model_limits,
+    # e.g. LLM_MODEL_LIMITS='{"dall-e-3": {"max_concurrency": 2, "requests_per_minute": 7, "tokens_per_minute": 1000000}}'
+    llm_max_concurrency: int = 8
+    llm_requests_per_minute: int = 500
+    llm_tokens_per_minute: int = 200000
+    llm_model_limits: dict = {}
+    llm_estimated_completion_tokens: int = 500
+    llm_max_retries: int = 5
+    llm_retry_base_delay: float = 0.5
+    llm_retry_max_delay: float = 30
+
+    # POST /projects/{id}/haiku:batch: descriptions are split into chunks, each one job and one transaction
+    haiku_batch_max_items: int = 1000
+    haiku_batch_chunk_size: int = 25
+    haiku_batch_concurrency: int = 8
+    # offline batches go through "openai" (the Batch API) or "local" (a stub that answers instantly)
+    llm_batch_backend: str = "openai"
+    llm_batch_poll_interval: float = 30
+
+    # spans, see tracing.py. Exporters: "none", "memory" (GET /traces/{chain_id}), "file" (JSON lines) or "otlp"
+    tracing_exporter: str = "memory"
+    tracing_memory_max_spans: int = 10000
+    tracing_file_path: str = "./traces.jsonl"
+    tracing_otlp_endpoint: str = "http://localhost:4318/v1/traces"
+    tracing_service_name: str = "ai-workflow-starter"
+    tracing_flush_ms: int = 1000
+    tracing_max_pending: int = 10000
+
+    # after startup, open this many pooled db connections, run the dashboard's hot queries once and build the
+    # LLM client, in the background, so the first requests don't pay for them (see warm_up in app.py)
+    startup_warmup: bool = True
+    startup_warmup_db_connections: int = 4
+
+    # background jobs, see jobs.py. Set JOBS_RUN_IN_APP=false when running `python -m workers` separately
+    jobs_run_in_app: bool = True
+    jobs_worker_concurrency: int = 4
+    jobs_poll_interval: float = 1.0
+    jobs_visibility_timeout: int = 300
+    jobs_max_attempts: int = 5
+    jobs_retry_base_delay: float = 2
+    jobs_retry_max_delay: float = 300
     
 
 settings = Settings()
\ No newline at end of file
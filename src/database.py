@@ -1,21 +1,136 @@
+import asyncio
 import datetime
+import functools
+import time
 import uuid
 import json
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
 
 from config import settings
 from logger import logger
+from metrics import db_query_duration
 
 
-engine = create_engine(settings.db_engine_url, echo=True)
-SessionLocal = sessionmaker(bind=engine)
+# sync driver -> async driver, used to derive the async url from `db_engine_url`
+async_drivers = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+}
+
+
+def get_async_engine_url(url: str) -> str:
+    url = make_url(url)
+    drivername = async_drivers.get(url.drivername, url.drivername)
+    return url.set(drivername=drivername).render_as_string(hide_password=False)
+
+
+def get_query_operation(statement: str) -> str:
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''
+    return operation if operation in ('SELECT', 'INSERT', 'UPDATE', 'DELETE') else 'OTHER'
+
+
+def time_queries(sync_engine):
+    ''' Observe every statement's duration in `db_query_duration_seconds` '''
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_started_at = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        db_query_duration.observe(time.perf_counter() - context._query_started_at, operation=get_query_operation(statement))
+
+
+def get_engine_options(url: str) -> dict:
+    ''' `create_engine` keyword arguments for the url's backend '''
+    # DB_ECHO=true logs every statement, which is handy when debugging but slows every query down
+    options = {'echo': settings.db_echo}
+    if make_url(url).get_backend_name() == 'sqlite':
+        # the pool hands connections to whichever thread asks (E.g. asyncio.to_thread), one at a time
+        options['connect_args'] = {'check_same_thread': False, 'timeout': settings.db_sqlite_busy_timeout_ms / 1000}
+    else:
+        options.update(
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+            pool_recycle=settings.db_pool_recycle,
+            pool_pre_ping=settings.db_pool_pre_ping,
+        )
+    return options
+
+
+def get_sqlite_pragmas() -> dict:
+    return {
+        'journal_mode': settings.db_sqlite_journal_mode,
+        'synchronous': settings.db_sqlite_synchronous,
+        'busy_timeout': int(settings.db_sqlite_busy_timeout_ms),
+        'mmap_size': int(settings.db_sqlite_mmap_size),
+    }
+
+
+def tune_sqlite(sync_engine):
+    ''' Set `get_sqlite_pragmas` on every new connection, a no-op for other backends '''
+    if sync_engine.dialect.name != 'sqlite':
+        return
+
+    pragmas = get_sqlite_pragmas()
+
+    @event.listens_for(sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    logger.info(f"[database] SQLite pragmas: {pragmas}")
+
+
+# Engines are built on first use rather than at import, so importing the app (E.g. each worker
+# on a restart, or a script that never touches the db) doesn't pay for them.
+
+@functools.cache
+def get_engine():
+    engine = create_engine(settings.db_engine_url, **get_engine_options(settings.db_engine_url))
+    tune_sqlite(engine)
+    time_queries(engine)
+    return engine
+
+
+@functools.cache
+def get_async_engine():
+    async_engine_url = get_async_engine_url(settings.db_engine_url)
+    async_engine = create_async_engine(async_engine_url, **get_engine_options(async_engine_url))
+    tune_sqlite(async_engine.sync_engine)
+    time_queries(async_engine.sync_engine)
+    return async_engine
+
+
+@functools.cache
+def get_sessionmaker():
+    return sessionmaker(bind=get_engine())
+
+
+@functools.cache
+def get_async_sessionmaker():
+    return async_sessionmaker(bind=get_async_engine(), expire_on_commit=False)
+
+
+async def warm_up_pool(connections: int):
+    ''' Open up to `connections` pooled connections at once, so the first requests don't each open one '''
+    async def connect():
+        async with get_async_engine().connect() as connection:
+            await connection.execute(text("SELECT 1"))
+
+    await asyncio.gather(*[connect() for _ in range(connections)])
 
 
 @contextmanager
 def get_session():
-    session = SessionLocal()
+    session = get_sessionmaker()()
     try:
         yield session
         session.commit()
@@ -23,4 +138,18 @@ def get_session():
         session.rollback()
         raise
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
+
+
+@asynccontextmanager
+async def get_async_session():
+    ''' Same contract as `get_session`, but doesn't block the event loop '''
+    session = get_async_sessionmaker()()
+    try:
+        yield session
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
@@ -0,0 +1,171 @@
+import asyncio
+import fcntl
+import json
+import os
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+from config import settings
+from logger import logger
+
+
+class LocalEventBus:
+    ''' In-process pub/sub: every subscriber gets its own queue, so nobody steals another's wakeup '''
+
+    def __init__(self):
+        self.subscribers = defaultdict(set)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, channel: str, message: dict):
+        self.deliver(channel, message)
+
+    def deliver(self, channel: str, message: dict):
+        for queue in self.subscribers.get(channel, ()):
+            queue.put_nowait(message)
+
+    @asynccontextmanager
+    async def subscribe(self, channel: str):
+        queue = asyncio.Queue()
+        self.subscribers[channel].add(queue)
+        try:
+            yield queue
+        finally:
+            self.subscribers[channel].discard(queue)
+            if not self.subscribers[channel]:
+                del self.subscribers[channel]
+
+
+class UnixSocketEventBus(LocalEventBus):
+    '''
+    Cross-process pub/sub for running several uvicorn workers on one host.
+
+    Whichever worker grabs the lock file first also runs a tiny broker on a UNIX socket,
+    every worker (the broker's included) connects to it as a client, and the broker relays
+    newline-delimited JSON frames between them. If the broker's worker dies its lock is
+    released and the next worker to reconnect takes over.
+    '''
+
+    def __init__(self, socket_path: str, reconnect_delay: float = 0.5):
+        super().__init__()
+        self.socket_path = socket_path
+        self.lock_path = f"{socket_path}.lock"
+        self.reconnect_delay = reconnect_delay
+        self.node_id = str(uuid4())
+        self.lock_file = None
+        self.server = None
+        self.broker_writers = set()
+        self.writer = None
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.writer:
+            self.writer.close()
+        if self.server:
+            self.server.close()
+            for writer in list(self.broker_writers):
+                writer.close()
+            await self.server.wait_closed()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        if self.lock_file:
+            self.lock_file.close()
+
+    async def publish(self, channel: str, message: dict):
+        # Deliver locally right away, the broker only has to reach the other workers.
+        self.deliver(channel, message)
+
+        if not self.writer:
+            logger.warning(f"[UnixSocketEventBus] not connected to the broker, {channel} only published locally")
+            return
+        frame = json.dumps({"origin": self.node_id, "channel": channel, "message": message})
+        try:
+            self.writer.write(frame.encode() + b"\n")
+            await self.writer.drain()
+        except (ConnectionError, RuntimeError) as e:
+            logger.warning(f"[UnixSocketEventBus] failed to publish {channel} to the broker: {e}")
+
+    async def run(self):
+        while True:
+            try:
+                await self.try_become_broker()
+                reader, self.writer = await asyncio.open_unix_connection(self.socket_path)
+                logger.info(f"[UnixSocketEventBus] connected to broker at {self.socket_path}")
+                while line := await reader.readline():
+                    frame = json.loads(line)
+                    if frame["origin"] != self.node_id:
+                        self.deliver(frame["channel"], frame["message"])
+            except asyncio.CancelledError:
+                raise
+            except (ConnectionError, FileNotFoundError) as e:
+                logger.info(f"[UnixSocketEventBus] broker unavailable: {e}")
+            except Exception as e:
+                logger.error(f"[UnixSocketEventBus] error reading from broker: {e}", exc_info=True)
+
+            self.writer = None
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def try_become_broker(self):
+        if self.server:
+            return
+
+        if not self.lock_file:
+            self.lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return  # another worker is the broker
+
+        # We hold the lock, so any socket file left behind belongs to a dead broker.
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = await asyncio.start_unix_server(self.handle_broker_client, path=self.socket_path)
+        logger.info(f"[UnixSocketEventBus] running broker at {self.socket_path}")
+
+    async def handle_broker_client(self, reader, writer):
+        self.broker_writers.add(writer)
+        try:
+            while line := await reader.readline():
+                for other in list(self.broker_writers):
+                    if other is not writer:
+                        other.write(line)
+        except (ConnectionError, asyncio.CancelledError):
+            # a leaf task per client, nothing to propagate the cancellation to on shutdown
+            pass
+        finally:
+            self.broker_writers.discard(writer)
+            writer.close()
+
+
+event_bus_backends = {
+    'local': LocalEventBus,
+    'unix': lambda: UnixSocketEventBus(settings.event_bus_socket_path),
+}
+
+
+def get_event_bus():
+    try:
+        return event_bus_backends[settings.event_bus_backend]()
+    except KeyError:
+        raise ValueError(f"Unknown event bus backend: {settings.event_bus_backend}")
+
+
+def project_channel(project_id: int) -> str:
+    return f"project:{project_id}"
+
+
+event_bus = get_event_bus()
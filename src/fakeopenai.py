@@ -0,0 +1,177 @@
+''' A stand-in for the OpenAI API, for benchmarks and load tests without the provider (or its bill).
+
+Usage: `python -m fakeopenai --port 8001 --chat-latency lognormal:800,0.4 --error-rate 0.01`,
+then run the app with `LLM_BASE_URL=http://127.0.0.1:8001/v1`.
+
+Chat completions (streamed or not) are answered with the simplest value matching the request's
+JSON schema, images with a PNG of noise at the requested (or `--image-size`) size, which
+compresses about as badly as a real one. Latencies are drawn from a distribution:
+`fixed:<ms>`, `uniform:<min ms>,<max ms>` or `lognormal:<median ms>,<sigma>`.
+`--error-rate` answers that fraction of calls with a 500 and `--rate-limit-rate` with a 429.
+`GET /stats` counts the requests served, errors injected and the client connections used.
+'''
+import argparse
+import asyncio
+import base64
+import functools
+import io
+import json
+import os
+import random
+import time
+from uuid import uuid4
+
+import uvicorn
+from fastapi import APIRouter, FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from llmbatch import stub_from_schema
+
+
+def parse_latency(spec: str):
+    ''' A function returning a latency in seconds, drawn from the distribution `spec` describes '''
+    kind, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(',') if value]
+    if kind == 'fixed':
+        return lambda: values[0] / 1000
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1]) / 1000
+    if kind == 'lognormal':
+        median_ms, sigma = values
+        return lambda: random.lognormvariate(0, sigma) * median_ms / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+router = APIRouter()
+
+
+def create_app(chat_latency: str = 'fixed:0', image_latency: str = 'fixed:0', error_rate: float = 0.0, rate_limit_rate: float = 0.0, image_size: str = None) -> FastAPI:
+    ''' A fake provider with its own settings and stats, so tests can run several side by side (E.g. via httpx.ASGITransport) '''
+    fake = FastAPI()
+    fake.state.chat_latency = parse_latency(chat_latency)
+    fake.state.image_latency = parse_latency(image_latency)
+    fake.state.error_rate = error_rate
+    fake.state.rate_limit_rate = rate_limit_rate
+    fake.state.image_size = image_size
+    fake.state.stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+    fake.state.connections = set()
+    fake.middleware("http")(count_requests)
+    fake.include_router(router)
+    return fake
+
+
+async def count_requests(request: Request, call_next):
+    if request.url.path.startswith('/v1/'):
+        request.app.state.stats["requests"] += 1
+        request.app.state.connections.add(request.scope.get('client'))
+    return await call_next(request)
+
+
+@router.get("/stats")
+async def get_stats(request: Request):
+    return {**request.app.state.stats, "connections": len(request.app.state.connections)}
+
+
+def get_injected_error(state):
+    ''' An OpenAI-shaped error response for this call, or None '''
+    roll = random.random()
+    if roll < state.rate_limit_rate:
+        state.stats["rate_limited"] += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached (fake)", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429,
+            headers={"retry-after-ms": "200", "x-ratelimit-reset-requests": "200ms"},
+        )
+    if roll < state.rate_limit_rate + state.error_rate:
+        state.stats["errors"] += 1
+        return JSONResponse({"error": {"message": "Internal error (fake)", "type": "server_error", "code": None}}, status_code=500)
+    return None
+
+
+def get_stub_content(body: dict) -> str:
+    response_format = body.get('response_format') or {}
+    if response_format.get('type') == 'json_schema':
+        return json.dumps(stub_from_schema(response_format['json_schema']['schema']))
+    return 'stub'
+
+
+def get_usage(body: dict, content: str) -> dict:
+    prompt_tokens = sum(len(str(message.get('content', ''))) for message in body.get('messages', [])) // 4
+    completion_tokens = len(content) // 4
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+
+async def stream_completion(completion_id: str, body: dict, content: str, chunk_size: int = 8):
+    created = int(time.time())
+    chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": body['model']}
+    yield f"data: {json.dumps({**chunk, 'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}]})}\n\n"
+    for start in range(0, len(content), chunk_size):
+        delta = {'content': content[start:start + chunk_size]}
+        yield f"data: {json.dumps({**chunk, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]})}\n\n"
+        await asyncio.sleep(0)
+    yield f"data: {json.dumps({**chunk, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})}\n\n"
+    if (body.get('stream_options') or {}).get('include_usage'):
+        yield f"data: {json.dumps({**chunk, 'choices': [], 'usage': get_usage(body, content)})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@router.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    await asyncio.sleep(request.app.state.chat_latency())
+    if (error := get_injected_error(request.app.state)) is not None:
+        return error
+
+    content = get_stub_content(body)
+    completion_id = f"chatcmpl-fake-{uuid4()}"
+    if body.get('stream'):
+        return StreamingResponse(stream_completion(completion_id, body, content), media_type="text/event-stream")
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body['model'],
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": get_usage(body, content),
+    }
+
+
+@functools.lru_cache(maxsize=8)
+def get_noise_png_b64(size: str) -> str:
+    ''' Made once per size, noise so the PNG is about as big as a real image '''
+    from PIL import Image
+
+    width, height = (int(value) for value in size.split('x'))
+    image = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+@router.post("/v1/images/generations")
+async def images_generations(request: Request):
+    body = await request.json()
+    await asyncio.sleep(request.app.state.image_latency())
+    if (error := get_injected_error(request.app.state)) is not None:
+        return error
+
+    image_b64 = await asyncio.to_thread(get_noise_png_b64, request.app.state.image_size or body.get('size') or '1024x1024')
+    return {
+        "created": int(time.time()),
+        "data": [{"b64_json": image_b64, "revised_prompt": body.get('prompt')} for _ in range(body.get('n') or 1)],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake OpenAI API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--chat-latency", default="fixed:0", help="E.g. fixed:200, uniform:100,300 or lognormal:800,0.4")
+    parser.add_argument("--image-latency", default="fixed:0")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of calls answered with a 429")
+    parser.add_argument("--image-size", default=None, help="E.g. 512x512, instead of the size each request asks for")
+    args = parser.parse_args()
+
+    app = create_app(args.chat_latency, args.image_latency, args.error_rate, args.rate_limit_rate, args.image_size)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -12,9 +12,10 @@ import PsychologyIcon from "@mui/icons-material/Psychology";
 
 interface HaikuCardProps {
   haiku: any;
+  pendingPrompts?: any[];
 }
 
-const HaikuCard: React.FC<HaikuCardProps> = ({ haiku }) => {
+const HaikuCard: React.FC<HaikuCardProps> = ({ haiku, pendingPrompts = [] }) => {
   const [loading, setLoading] = useState(false);
   const [editModalOpen, setEditModalOpen] = useState(false);
   const [imageModalOpen, setImageModalOpen] = useState(false);
@@ -72,8 +73,8 @@ const HaikuCard: React.FC<HaikuCardProps> = ({ haiku }) => {
     }
   };
 
-  const openImageModal = (b64Image: string) => {
-    setSelectedImage(`data:image/png;base64,${b64Image}`);
+  const openImageModal = (imageUrl: string) => {
+    setSelectedImage(`http://localhost:8000${imageUrl}`);
     setImageModalOpen(true);
   };
 
@@ -108,8 +109,13 @@ const HaikuCard: React.FC<HaikuCardProps> = ({ haiku }) => {
         >{haiku.text}</Typography>
 
         {/* Image Prompts Section */}
-        {haiku.image_prompts && haiku.image_prompts.length > 0 && (
+        {((haiku.image_prompts && haiku.image_prompts.length > 0) || pendingPrompts.length > 0) && (
           <Box sx={{ mt: 2, display: "flex", gap: 2, flexWrap: "wrap", overflowX: "auto" }}>
+            {pendingPrompts.map((partial) => (
+              <Card key={partial.stream_id} sx={{ p: 2, minWidth: 250, opacity: 0.6 }}>
+                <Typography variant="body2">{partial.data.text || "Writing image prompt..."}</Typography>
+              </Card>
+            ))}
             {haiku.image_prompts.map((prompt) => (
               <Card key={prompt.id} sx={{ p: 2, minWidth: 250, position: "relative" }}>
                 <IconButton
@@ -138,7 +144,7 @@ const HaikuCard: React.FC<HaikuCardProps> = ({ haiku }) => {
                       <CardMedia
                         key={img.id}
                         component="img"
-                        image={`data:image/png;base64,${img.b64}`}
+                        image={`http://localhost:8000${img.thumbnail_url ?? img.url}`}
                         alt="Generated"
                         sx={{
                           borderRadius: 1,
@@ -147,7 +153,7 @@ const HaikuCard: React.FC<HaikuCardProps> = ({ haiku }) => {
                           width: 80,
                           cursor: "pointer",
                         }}
-                        onClick={() => openImageModal(img.b64)}
+                        onClick={() => openImageModal(img.url)}
                       />
                     ))}
                   </Box>
@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { useParams } from 'react-router-dom';
 import {
   Container,
@@ -10,10 +10,69 @@ import {
   DialogContent,
   TextField,
   DialogActions,
+  Card,
+  CardHeader,
+  CardContent,
 } from '@mui/material';
 import ReconnectingWebSocket from 'reconnecting-websocket';
 import HaikuCard from './HaikuCard';
 
+// Insert `item` at the front of `list`, or merge it into the existing entry with the same id.
+const upsert = (list: any[], item: any) =>
+  list.some((existing) => existing.id === item.id)
+    ? list.map((existing) => (existing.id === item.id ? { ...existing, ...item } : existing))
+    : [item, ...list];
+
+const updateHaiku = (haikus: any[], haikuId: number, update: (haiku: any) => any) =>
+  haikus.map((haiku) => (haiku.id === haikuId ? update(haiku) : haiku));
+
+const applyDelta = (haikus: any[], delta: any) => {
+  const { kind, data } = delta;
+  switch (kind) {
+    case "haiku_created":
+      return upsert(haikus, data.haiku);
+    case "image_prompt_saved":
+    case "image_prompt_updated":
+      return updateHaiku(haikus, data.haiku_id, (haiku) => ({
+        ...haiku,
+        image_prompts: upsert(haiku.image_prompts || [], data.image_prompt),
+      }));
+    case "image_saved":
+      return updateHaiku(haikus, data.haiku_id, (haiku) => ({
+        ...haiku,
+        image_prompts: (haiku.image_prompts || []).map((prompt) =>
+          prompt.id === data.image_prompt_id
+            ? { ...prompt, images: upsert(prompt.images || [], data.image) }
+            : prompt
+        ),
+      }));
+    case "critique_saved":
+      return updateHaiku(haikus, data.haiku_id, (haiku) => ({
+        ...haiku,
+        critiques: upsert(haiku.critiques || [], data.critique),
+      }));
+    default:
+      console.warn("Unknown dashboard delta:", kind);
+      return haikus;
+  }
+};
+
+// Partial kinds this dashboard shows; others (E.g. "batch_item" progress) aren't kept.
+const RENDERED_PARTIALS = new Set(["haiku", "image_prompt"]);
+// A partial that hasn't been updated for this long belongs to a stream that died without telling us.
+const PARTIAL_TTL_MS = 60 * 1000;
+
+const dropStalePartials = (partials: Record<string, any>, now: number) => {
+  const fresh = Object.entries(partials).filter(([, partial]) => now - partial.receivedAt < PARTIAL_TTL_MS);
+  return fresh.length === Object.keys(partials).length ? partials : Object.fromEntries(fresh);
+};
+
+// Add a page of older haikus to the end of `list`, skipping any we already have.
+const appendPage = (list: any[], items: any[]) => [
+  ...list,
+  ...items.filter((item) => !list.some((existing) => existing.id === item.id)),
+];
+
 const ProjectDashboard = () => {
   const { id } = useParams();
   const [projectName, setProjectName] = useState('');
@@ -21,26 +80,92 @@ const ProjectDashboard = () => {
   const [haikuModalOpen, setHaikuModalOpen] = useState(false);
   const [description, setDescription] = useState('');
   const [loading, setLoading] = useState(false);
+  // Last change feed position we applied, sent on reconnect so we only get what we missed.
+  const seqRef = useRef<number | null>(null);
+  // Results still streaming in, by stream_id, until the delta that saves them arrives or the stream ends.
+  const [partials, setPartials] = useState<Record<string, any>>({});
+  // Haikus are paged in as you scroll: undefined until the first page loads, null once there are no more.
+  const nextCursorRef = useRef<string | null | undefined>(undefined);
+  const loadingMoreRef = useRef(false);
+  const sentinelRef = useRef<HTMLDivElement | null>(null);
+
+  const loadMoreHaikus = async () => {
+    if (!id || loadingMoreRef.current || nextCursorRef.current === null) return;
+    loadingMoreRef.current = true;
+    try {
+      const cursor = nextCursorRef.current ? `&cursor=${encodeURIComponent(nextCursorRef.current)}` : "";
+      const response = await fetch(`http://localhost:8000/projects/${id}/haikus?limit=20${cursor}`);
+      const page = await response.json();
+      if (!response.ok) {
+        console.error("Error loading haikus:", page.detail);
+        return;
+      }
+      setHaikus((current) => appendPage(current, page.items));
+      nextCursorRef.current = page.next_cursor;
+    } catch (error) {
+      console.error("Error loading haikus:", error);
+    } finally {
+      loadingMoreRef.current = false;
+    }
+  };
+
+  useEffect(() => {
+    const sentinel = sentinelRef.current;
+    if (!sentinel) return;
+    const observer = new IntersectionObserver((entries) => {
+      if (entries[0].isIntersecting) loadMoreHaikus();
+    });
+    observer.observe(sentinel);
+    return () => observer.disconnect();
+  }, [id]);
 
   useEffect(() => {
     if (!id) return;
-    const wsUrl = `ws://localhost:8000/projects/dashboard/${id}`;
+    seqRef.current = null;
+    setPartials({});
+    const wsUrl = () => {
+      // Summary snapshots only carry counts, the haikus themselves are paged in.
+      const url = `ws://localhost:8000/projects/dashboard/${id}?snapshot=summary`;
+      return seqRef.current === null ? url : `${url}&since=${seqRef.current}`;
+    };
     const rws = new ReconnectingWebSocket(wsUrl);
+    const sweep = setInterval(() => setPartials((current) => dropStalePartials(current, Date.now())), PARTIAL_TTL_MS / 4);
 
     rws.addEventListener('message', (event) => {
-      console.log("Received data:", event.data);
       try {
-        const projectData = JSON.parse(event.data);
-        setProjectName(projectData.name);
-        if (projectData && projectData.haikus) {
-          setHaikus(projectData.haikus);
+        const message = JSON.parse(event.data);
+        if (message.type === "partial") {
+          if (message.done) {
+            // ended without a delta to replace it, E.g. the stream failed
+            setPartials(({ [message.stream_id]: _done, ...rest }) => rest);
+          } else if (RENDERED_PARTIALS.has(message.kind)) {
+            setPartials((current) => ({ ...current, [message.stream_id]: { ...message, receivedAt: Date.now() } }));
+          }
+          return;
         }
+        if (message.type === "snapshot") {
+          const summary = message.summary;
+          if (summary) {
+            setProjectName(summary.name);
+            setHaikus([]);
+            nextCursorRef.current = undefined;
+            loadMoreHaikus();
+          }
+        } else if (message.type === "delta") {
+          setHaikus((current) => applyDelta(current, message));
+          const streamId = message.data && message.data.stream_id;
+          if (streamId) {
+            setPartials(({ [streamId]: _done, ...rest }) => rest);
+          }
+        }
+        seqRef.current = message.seq;
       } catch (err) {
         console.error("Error parsing project data:", err);
       }
     });
 
     return () => {
+      clearInterval(sweep);
       rws.close();
     };
   }, [id]);
@@ -108,9 +233,26 @@ const ProjectDashboard = () => {
         <Button sx={{ mb: 4 }} variant="contained" onClick={() => setHaikuModalOpen(true)}>
           Create Haiku
         </Button>
-        {haikus.map((haiku, index) => (
-          <HaikuCard key={index} haiku={haiku} />
+        {Object.values(partials)
+          .filter((partial) => partial.kind === "haiku")
+          .map((partial) => (
+            <Card key={partial.stream_id} sx={{ mb: 4, opacity: 0.6 }}>
+              <CardHeader title={partial.data.title || "Writing haiku..."} />
+              <CardContent>
+                <Typography variant="body1">{partial.data.text}</Typography>
+              </CardContent>
+            </Card>
+          ))}
+        {haikus.map((haiku) => (
+          <HaikuCard
+            key={haiku.id}
+            haiku={haiku}
+            pendingPrompts={Object.values(partials).filter(
+              (partial) => partial.kind === "image_prompt" && partial.data.haiku_id === haiku.id
+            )}
+          />
         ))}
+        <div ref={sentinelRef} />
       </Box>
     </Container>
   );
@@ -0,0 +1,74 @@
+import asyncio
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+from config import settings
+from logger import logger
+
+
+mime_types = {
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+}
+
+
+def make_derivatives(image_bytes: bytes, sizes: dict, formats: list, quality: int) -> list:
+    '''
+    Resize an image to fit each of `sizes` ({variant: max edge in px}) and encode it in
+    each of `formats`. CPU bound, so it runs in `derivative_pool`, not on the event loop.
+    '''
+    from PIL import Image  # imported here so only the pool's processes pay for it
+
+    derivatives = []
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.load()
+        # JPEG has no alpha channel, and WebP doesn't need one for generated art.
+        image = image.convert('RGB')
+        for variant, max_edge in sizes.items():
+            resized = image.copy()
+            resized.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            for image_format in formats:
+                buffer = io.BytesIO()
+                resized.save(buffer, format=image_format.upper(), quality=quality, optimize=True)
+                derivatives.append({
+                    "variant": variant,
+                    "format": image_format,
+                    "width": resized.width,
+                    "height": resized.height,
+                    "mime_type": mime_types[image_format],
+                    "data": buffer.getvalue(),
+                })
+    return derivatives
+
+
+derivative_pool = None
+
+
+def get_derivative_pool() -> ProcessPoolExecutor:
+    global derivative_pool
+    if derivative_pool is None:
+        derivative_pool = ProcessPoolExecutor(max_workers=settings.image_derivative_workers)
+    return derivative_pool
+
+
+async def generate_derivatives(image_bytes: bytes) -> list:
+    """ Thumbnails / medium sizes of an image, or [] if they couldn't be made (the original is still served) """
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            get_derivative_pool(),
+            make_derivatives,
+            image_bytes,
+            settings.image_derivative_sizes,
+            settings.image_derivative_formats,
+            settings.image_derivative_quality,
+        )
+    except Exception as e:
+        logger.error(f"[generate_derivatives] Failed to make image derivatives: {e}", exc_info=True)
+        return []
+
+
+def shutdown_derivative_pool():
+    global derivative_pool
+    if derivative_pool is not None:
+        derivative_pool.shutdown(cancel_futures=True)
+        derivative_pool = None
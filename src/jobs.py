@@ -0,0 +1,258 @@
+import asyncio
+import datetime
+import os
+import socket
+import time
+from uuid import uuid4
+
+from sqlalchemy import select, update, func, or_, and_
+from sqlalchemy.exc import IntegrityError
+
+from config import settings
+from logger import logger
+from metrics import registry, job_duration, job_queue_depth
+from tracing import current_trace_context, tracer
+
+from database import get_async_session
+from apps.main.models import JobTable
+
+
+# name -> async handler, called with the job's payload as keyword arguments
+job_handlers = {}
+
+# lets workers in this process pick up a new job right away instead of at their next poll
+job_wakeup = asyncio.Event()
+
+
+def job_handler(name=None):
+    ''' Register an async function as a job handler, under its own name by default '''
+    def register(func):
+        job_handlers[name or func.__name__] = func
+        return func
+    return register
+
+
+async def enqueue_job(name: str, payload: dict, idempotency_key: str = None, max_attempts: int = None, run_after: datetime.datetime = None) -> str:
+    """
+    Queue a job and return its id. Re-using an idempotency key returns the original job's id.
+    `run_after` (naive UTC) delays it, E.g. for scheduled maintenance.
+    """
+    if name not in job_handlers:
+        raise ValueError(f"No job handler registered for {name}")
+
+    try:
+        if idempotency_key and (existing_id := await get_job_id(idempotency_key)):
+            return existing_id
+
+        async with get_async_session() as session:
+            job = JobTable(
+                name=name,
+                payload=payload,
+                idempotency_key=idempotency_key,
+                max_attempts=max_attempts or settings.jobs_max_attempts,
+                run_after=run_after or datetime.datetime.utcnow(),
+                trace_context=current_trace_context(),
+            )
+            session.add(job)
+            await session.commit()
+    except IntegrityError:
+        # Someone else enqueued the same idempotency key between our check and insert.
+        return await get_job_id(idempotency_key)
+
+    job_wakeup.set()
+    return job.id
+
+
+async def get_job_id(idempotency_key: str):
+    """ The id of the job queued with `idempotency_key`, or None """
+    async with get_async_session() as session:
+        return await session.scalar(select(JobTable.id).where(JobTable.idempotency_key == idempotency_key))
+
+
+async def get_job(job_id: str):
+    """ Fetch a job's status """
+    async with get_async_session() as session:
+        job = await session.scalar(select(JobTable).where(JobTable.id == job_id))
+        return job and {column.name: getattr(job, column.name) for column in job.__table__.columns}
+
+
+async def claim_job(worker_id: str):
+    """ Atomically take the next runnable job, or a running one whose worker stopped heartbeating """
+    now = datetime.datetime.utcnow()
+    claimable_id = (
+        select(JobTable.id)
+        .where(or_(
+            and_(JobTable.status == 'queued', JobTable.run_after <= now),
+            and_(JobTable.status == 'running', JobTable.locked_until < now, JobTable.attempts < JobTable.max_attempts),
+        ))
+        .order_by(JobTable.run_after)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    async with get_async_session() as session:
+        result = await session.execute(
+            update(JobTable)
+            .where(JobTable.id == claimable_id)
+            .values(
+                status='running',
+                attempts=JobTable.attempts + 1,
+                locked_until=now + datetime.timedelta(seconds=settings.jobs_visibility_timeout),
+                locked_by=worker_id,
+                updated_at=now,
+            )
+            .returning(
+                JobTable.id, JobTable.name, JobTable.payload, JobTable.attempts, JobTable.max_attempts,
+                JobTable.run_after, JobTable.trace_context,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        return result.first()
+
+
+async def extend_job_lock(job_id: str, worker_id: str):
+    now = datetime.datetime.utcnow()
+    async with get_async_session() as session:
+        await session.execute(
+            update(JobTable)
+            .where(JobTable.id == job_id, JobTable.locked_by == worker_id, JobTable.status == 'running')
+            .values(locked_until=now + datetime.timedelta(seconds=settings.jobs_visibility_timeout), updated_at=now)
+            .execution_options(synchronize_session=False)
+        )
+
+
+async def complete_job(job_id: str, worker_id: str, result=None):
+    now = datetime.datetime.utcnow()
+    async with get_async_session() as session:
+        await session.execute(
+            update(JobTable)
+            .where(JobTable.id == job_id, JobTable.locked_by == worker_id)
+            .values(status='succeeded', result=result, locked_until=None, finished_at=now, updated_at=now)
+            .execution_options(synchronize_session=False)
+        )
+
+
+async def fail_job(job_id: str, worker_id: str, attempts: int, max_attempts: int, error: str):
+    """ Requeue with backoff, or dead-letter the job once it is out of attempts """
+    now = datetime.datetime.utcnow()
+    if attempts >= max_attempts:
+        values = dict(status='dead', finished_at=now)
+    else:
+        delay = min(settings.jobs_retry_max_delay, settings.jobs_retry_base_delay * 2 ** (attempts - 1))
+        values = dict(status='queued', run_after=now + datetime.timedelta(seconds=delay))
+
+    async with get_async_session() as session:
+        await session.execute(
+            update(JobTable)
+            .where(JobTable.id == job_id, JobTable.locked_by == worker_id)
+            .values(**values, last_error=error, locked_until=None, updated_at=now)
+            .execution_options(synchronize_session=False)
+        )
+    return values['status']
+
+
+async def dead_letter_expired_jobs():
+    """ Running jobs whose lock expired on their last attempt won't be claimed again """
+    now = datetime.datetime.utcnow()
+    async with get_async_session() as session:
+        result = await session.execute(
+            update(JobTable)
+            .where(JobTable.status == 'running', JobTable.locked_until < now, JobTable.attempts >= JobTable.max_attempts)
+            .values(status='dead', last_error='visibility timeout expired', finished_at=now, updated_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+
+
+@registry.collector
+async def collect_job_queue_depth():
+    async with get_async_session() as session:
+        counts = dict((await session.execute(select(JobTable.status, func.count()).group_by(JobTable.status))).all())
+    for status in ('queued', 'running', 'succeeded', 'dead'):
+        job_queue_depth.set(counts.get(status, 0), status=status)
+
+
+class JobWorker:
+    ''' Runs up to `concurrency` jobs at once from the queue, in this process '''
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.tasks = []
+
+    async def start(self):
+        logger.info(f"[JobWorker] {self.worker_id} starting with concurrency={self.concurrency}")
+        self.tasks = [asyncio.create_task(self.run_slot()) for _ in range(self.concurrency)]
+        self.tasks.append(asyncio.create_task(self.sweep()))
+
+    async def stop(self):
+        # Interrupted jobs keep their lock until it expires, then get retried.
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        logger.info(f"[JobWorker] {self.worker_id} stopped")
+
+    async def run_slot(self):
+        while True:
+            try:
+                job = await claim_job(self.worker_id)
+            except Exception as e:
+                logger.error(f"[JobWorker] Error claiming job: {e}", exc_info=True)
+                job = None
+
+            if not job:
+                try:
+                    await asyncio.wait_for(job_wakeup.wait(), settings.jobs_poll_interval)
+                    job_wakeup.clear()
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self.run_job(job)
+            except Exception as e:
+                # E.g. a locked database on complete_job: the job's lock expires and it gets claimed again
+                logger.error(f"[JobWorker] Error finishing {job.name} job_id={job.id}: {e}", exc_info=True)
+
+    async def run_job(self, job):
+        handler = job_handlers.get(job.name)
+        heartbeat = asyncio.create_task(self.heartbeat(job.id))
+        logger.info(f"[JobWorker] running {job.name} job_id={job.id} attempt={job.attempts}/{job.max_attempts}")
+
+        # How long the job sat in the queue, from when it became runnable to now
+        queued_at_ns = int(job.run_after.replace(tzinfo=datetime.timezone.utc).timestamp() * 1e9)
+        tracer.end_span(tracer.start_span(f"job.queue_wait {job.name}", parent=job.trace_context, start_ns=queued_at_ns, job_id=job.id))
+
+        started_at = time.perf_counter()
+        try:
+            if not handler:
+                raise ValueError(f"No job handler registered for {job.name}")
+            with tracer.span(f"job {job.name}", parent=job.trace_context, job_id=job.id, attempt=job.attempts):
+                result = await handler(**job.payload)
+        except Exception as e:
+            job_duration.observe(time.perf_counter() - started_at, name=job.name, outcome="error")
+            status = await fail_job(job.id, self.worker_id, job.attempts, job.max_attempts, repr(e))
+            logger.error(f"[JobWorker] {job.name} job_id={job.id} failed ({status}): {e}", exc_info=True)
+        else:
+            job_duration.observe(time.perf_counter() - started_at, name=job.name, outcome="success")
+            await complete_job(job.id, self.worker_id, result)
+        finally:
+            heartbeat.cancel()
+
+    async def heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(settings.jobs_visibility_timeout / 3)
+            try:
+                await extend_job_lock(job_id, self.worker_id)
+            except Exception as e:
+                # keep beating: one failed extension (E.g. a locked database) shouldn't hand the job to another worker
+                logger.error(f"[JobWorker] Error extending the lock on job_id={job_id}: {e}", exc_info=True)
+
+    async def sweep(self):
+        while True:
+            await asyncio.sleep(settings.jobs_visibility_timeout)
+            try:
+                if count := await dead_letter_expired_jobs():
+                    logger.warning(f"[JobWorker] dead-lettered {count} jobs whose lock expired on their last attempt")
+            except Exception as e:
+                logger.error(f"[JobWorker] Error sweeping expired jobs: {e}", exc_info=True)
@@ -1,22 +1,78 @@
+import asyncio
 import base64
+import functools
 import json
+import time
 from uuid import uuid4
 
-from openai import AsyncOpenAI
+import httpx
 from slugify import slugify
 
 from config import settings
 from logger import logger
 
-from database import get_session
+from database import get_async_session
 from apps.main.models import LLMLogTable
+from llmcache import CachedResponse, get_cache_key, response_cache
+from logsink import llm_log_sink
+from semanticcache import semantic_cache
+from metrics import llm_cache_hits, llm_request_duration, record_usage
+from tracing import current_chain_id, span, tracer
+from llmscheduler import llm_scheduler, is_retryable, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from llmrouter import get_endpoint_client, llm_router
 
 default_image_model = 'dall-e-3'
 default_image_size = "1024x1024"
 default_image_response_format = 'b64_json' # or url
 default_image_style = 'natural' # or vivid
 
-client = AsyncOpenAI(api_key=settings.openai_api_key)
+def get_llm_timeout(read_timeout: float) -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=settings.llm_connect_timeout,
+        read=read_timeout,
+        write=settings.llm_write_timeout,
+        pool=settings.llm_pool_timeout,
+    )
+
+
+text_timeout = get_llm_timeout(settings.llm_text_read_timeout)
+image_timeout = get_llm_timeout(settings.llm_image_read_timeout)
+
+
+def get_llm_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.llm_max_connections,
+        max_keepalive_connections=settings.llm_max_keepalive_connections,
+        keepalive_expiry=settings.llm_keepalive_expiry,
+    )
+
+
+def create_llm_client(base_url: str = None, limits: httpx.Limits = None, http2: bool = None, api_key: str = None):
+    '''
+    An OpenAI client with its own connection pool. Every call should share `get_llm_client()`,
+    so a burst of calls reuses warm (TLS, and with HTTP/2 multiplexed) connections instead of
+    opening new ones.
+    '''
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient  # the SDK is slow to import, so only on first use
+
+    http_client = DefaultAsyncHttpxClient(
+        http2=settings.llm_http2 if http2 is None else http2,
+        limits=limits or get_llm_limits(),
+        timeout=text_timeout,
+    )
+    # retries are handled by llm_scheduler, so they respect our rate limits and priorities
+    return AsyncOpenAI(
+        api_key=api_key or settings.openai_api_key,
+        base_url=base_url or settings.llm_base_url,
+        max_retries=0,
+        timeout=text_timeout,
+        http_client=http_client,
+    )
+
+
+@functools.cache
+def get_llm_client():
+    return create_llm_client()
 
 if settings.env == "prod":
     default_model = 'gpt-4o-2024-08-06'
@@ -27,11 +83,36 @@ else:
     default_model = 'o3-mini'
 
 
-async def ask_llm(messages, response_format=None, model=default_model, chain_id=None, name=None):
-    
-    if not chain_id:
-        chain_id = uuid4()
+# cache_key -> future of the CachedResponse, so concurrent identical calls share one request
+inflight_llm_calls = {}
+
+
+def release_flight(cache_key, flight):
+    ''' Stop sharing `flight`; calls still waiting on it get an error if it never got an answer '''
+    if inflight_llm_calls.get(cache_key) is flight:
+        del inflight_llm_calls[cache_key]
+    if not flight.done():
+        flight.set_exception(Exception("LLM call was cancelled"))
+        flight.exception()  # mark retrieved, nobody may have joined this flight
+
 
+def serialize_answer(answer):
+    if isinstance(answer, str):
+        return answer
+    if hasattr(answer, "model_dump_json"):
+        return answer.model_dump_json()
+    try:
+        return json.dumps(answer, default=str)
+    except Exception:
+        return str(answer)
+
+
+async def save_llm_log(**log_data):
+    """ Queue an inference call's log row, see logsink.py. Returns the log id """
+    return await llm_log_sink.write(log_data)
+
+
+def get_chat_settings(messages, response_format, model):
     chat_settings = {
         'model': model,
         'messages': messages,
@@ -43,75 +124,283 @@ async def ask_llm(messages, response_format=None, model=default_model, chain_id=
     if response_format:
         chat_settings['response_format'] = response_format
 
+    return chat_settings
+
+
+def get_call_name(messages, name=None):
     if not name:
         try:
             name = slugify(json.dumps(messages)[0:20])
         except Exception as e:
             logger.error(f"Failed to generate name for LLM call: {e}", exc_info=True)
+    return name
+
+
+def get_response_data(completion):
+    """ A JSON-serializable version of the completion, for the log """
+    try:
+        if hasattr(completion, "model_dump"):
+            return completion.model_dump()
+        elif hasattr(completion, "__dict__"):
+            return completion.__dict__
+        else:
+            return {"raw": str(completion)}
+    except Exception:
+        return {"raw": str(completion)}
+
+
+async def get_semantic_cache_hit(model, name, messages, response_format):
+    """ A near-duplicate call's answer and its similarity, or (None, None), see semanticcache.py """
+    match = await semantic_cache.get(model, name, messages)
+    if match is None:
+        return None, None
+    try:
+        answer = response_format.model_validate_json(match.answer_text) if response_format else match.answer_text
+    except Exception as e:
+        logger.warning(f"[get_semantic_cache_hit] could not rebuild answer from log {match.log_id}: {e}")
+        return None, None
+    return CachedResponse(answer=answer, completion=None, log_id=match.log_id), match.similarity
+
+
+def get_cached_from(cached, similarity):
+    """ The `response` logged for a cache hit """
+    if similarity is None:
+        return {"cached_from": cached.log_id}
+    return {"cached_from": cached.log_id, "similarity": round(similarity, 4)}
+
+
+def estimate_tokens(messages):
+    return len(json.dumps(messages)) // 4 + settings.llm_estimated_completion_tokens
+
+
+async def ask_llm(messages, response_format=None, model=default_model, chain_id=None, name=None, cache=True, priority=PRIORITY_INTERACTIVE):
+    
+    if not chain_id:
+        # continue the chain of the route / job we were called from, see tracing.py
+        chain_id = current_chain_id() or uuid4()
+
+    chat_settings = get_chat_settings(messages, response_format, model)
+    name = get_call_name(messages, name)
 
     logger.info(f'****\n[ask_llm] messages={json.dumps(messages)[0:100]}...\n***********')
 
+    cache_key = None
+    flight = None
+    if cache and settings.llm_cache_enabled:
+        cache_key = get_cache_key(chat_settings)
+        joined = inflight_llm_calls.get(cache_key)
+        if joined is None:
+            # registered before the first await, so an identical call starting during the lookups joins this one
+            flight = asyncio.get_running_loop().create_future()
+            inflight_llm_calls[cache_key] = flight
+
+        try:
+            with span("llm.cache_lookup", chain_id=chain_id, call_name=name or '') as lookup_span:
+                similarity = None
+                if joined is not None:
+                    logger.info(f"[ask_llm] joining in-flight call name={name}")
+                    cached = await asyncio.shield(joined)
+                else:
+                    cached = await response_cache.get(cache_key, response_format)
+                    if cached is None:
+                        cached, similarity = await get_semantic_cache_hit(model, name, messages, response_format)
+                lookup_span.set(hit=cached is not None)
+        except BaseException:
+            if flight:
+                release_flight(cache_key, flight)
+            raise
+
+        if cached is not None:
+            if flight:
+                flight.set_result(cached)
+                release_flight(cache_key, flight)
+            llm_cache_hits.inc(name=name or '', tier="exact" if similarity is None else "semantic")
+            await save_llm_log(
+                model=model,
+                name=name,
+                chain_id=str(chain_id),
+                messages=messages,
+                response=get_cached_from(cached, similarity),
+                answer=serialize_answer(cached.answer),
+                success=True,
+                cache_key=cache_key,
+                cache_hit=True,
+            )
+            return cached.answer, cached.completion, chain_id
+
     # Initialize variables for logging
     success = False
     answer = None
     response_data = None
     completion = None
+    answered_model = model
 
-    try:
-        completion = await client.beta.chat.completions.parse(**chat_settings)
-        if response_format:
-            answer = completion.choices[0].message.parsed
-        else:
-            answer = completion.choices[0].message.content
-        success = True
-    except Exception as e:
-        logger.error(f"[ask_llm] Exception during LLM call: {e}")
-        answer = f"LLM call failed: {str(e)}"
-        response_data = {"error": str(e)}
-        success = False
+    def send_to(endpoint, client):
+        # each endpoint has its own limiter, see LLMEndpoint.key
+        return llm_scheduler.run(
+            endpoint.key,
+            lambda: client.beta.chat.completions.with_raw_response.parse(**{**chat_settings, 'model': endpoint.model}),
+            priority=priority,
+            estimated_tokens=estimate_tokens(messages),
+        )
 
-    # Prepare a JSON-serializable version of the completion if not already set
-    if response_data is None:
+    try:
         try:
-            if hasattr(completion, "model_dump"):
-                sql_response_data = completion.model_dump()
-            elif hasattr(completion, "__dict__"):
-                sql_response_data = completion.__dict__
+            with llm_request_duration.time(model=model, name=name or ''), span("llm.request", chain_id=chain_id, model=model, call_name=name or '') as request_span:
+                completion, endpoint = await llm_router.run(name, model, send_to)
+                request_span.set(endpoint=endpoint.key)
+            answered_model = endpoint.model
+            record_usage(answered_model, name, completion.usage)
+            if response_format:
+                answer = completion.choices[0].message.parsed
             else:
-                sql_response_data = {"raw": str(completion)}
-        except Exception:
-            sql_response_data = {"raw": str(completion)}
+                answer = completion.choices[0].message.content
+            success = True
+        except Exception as e:
+            logger.error(f"[ask_llm] Exception during LLM call: {e}")
+            answer = f"LLM call failed: {str(e)}"
+            response_data = {"error": str(e)}
+            success = False
 
-    # Ensure answer is a string.
-    if not isinstance(answer, str):
-        try:
-            sql_answer = json.dumps(answer, default=str)
-        except Exception:
-            sql_answer = str(answer)
+        # Prepare a JSON-serializable version of the completion if not already set
+        if response_data is None:
+            response_data = get_response_data(completion)
 
-    # Save the inference call to the database.
-    with get_session() as session:
-        try:
-            log_entry = LLMLogTable(
+        # Save the inference call to the database.
+        with span("llm.log", chain_id=chain_id):
+            log_id = await save_llm_log(
+                model=answered_model,
+                name=name,
+                chain_id=str(chain_id),
+                messages=messages,
+                response=response_data,
+                answer=serialize_answer(answer),
+                success=success,
+                cache_key=cache_key,
+            )
+
+        if success and cache_key:
+            await semantic_cache.add(model, name, messages, serialize_answer(answer), log_id)
+
+        if flight:
+            if success:
+                cached = CachedResponse(answer=answer, completion=completion, log_id=log_id)
+                await response_cache.set(cache_key, cached)
+                flight.set_result(cached)
+            else:
+                flight.set_exception(Exception(answer))
+                flight.exception()  # mark retrieved, nobody may have joined this flight
+    finally:
+        if flight:
+            release_flight(cache_key, flight)
+
+    if not success:
+        raise Exception(answer)
+    return answer, completion, chain_id
+
+
+async def ask_llm_stream(messages, response_format=None, model=default_model, chain_id=None, name=None, cache=True, priority=PRIORITY_INTERACTIVE):
+    """
+    Like `ask_llm`, but streams. Yields `{"type": "partial", "data": ...}` as the output arrives
+    (an incrementally parsed dict when there is a `response_format`, otherwise the text so far),
+    then one `{"type": "final", "answer": ..., "completion": ..., "chain_id": ...}`.
+    The final answer is logged (and cached) exactly like `ask_llm`'s.
+    """
+    if not chain_id:
+        chain_id = current_chain_id() or uuid4()
+
+    chat_settings = get_chat_settings(messages, response_format, model)
+    name = get_call_name(messages, name)
+
+    logger.info(f'****\n[ask_llm_stream] messages={json.dumps(messages)[0:100]}...\n***********')
+
+    cache_key = None
+    if cache and settings.llm_cache_enabled:
+        cache_key = get_cache_key(chat_settings)
+        cached = await response_cache.get(cache_key, response_format)
+        similarity = None
+        if cached is None:
+            cached, similarity = await get_semantic_cache_hit(model, name, messages, response_format)
+        if cached is not None:
+            llm_cache_hits.inc(name=name or '', tier="exact" if similarity is None else "semantic")
+            await save_llm_log(
                 model=model,
                 name=name,
                 chain_id=str(chain_id),
                 messages=messages,
-                response=sql_response_data,
-                answer=sql_answer,
-                success=success
+                response=get_cached_from(cached, similarity),
+                answer=serialize_answer(cached.answer),
+                success=True,
+                cache_key=cache_key,
+                cache_hit=True,
             )
-            session.add(log_entry)
-            session.commit()
+            yield {"type": "final", "answer": cached.answer, "completion": cached.completion, "chain_id": chain_id}
+            return
+
+    success = False
+    completion = None
+    estimated_tokens = estimate_tokens(messages)
+    started_at = time.perf_counter()
+    # Not hedged: once output has been relayed we're committed to one endpoint. The first healthy one.
+    endpoint = llm_router.get_endpoints(name, model)[0]
+    client = get_endpoint_client(endpoint.base_url, endpoint.api_key)
+    # not made current: the generator may be resumed from a different context
+    request_span = tracer.start_span("llm.stream", chain_id=chain_id, model=model, call_name=name or '', endpoint=endpoint.key)
+
+    for attempt in range(settings.llm_max_retries + 1):
+        streamed_output = False
+        try:
+            async with llm_scheduler.reserve(endpoint.key, priority=priority, estimated_tokens=estimated_tokens) as limiter:
+                async with client.beta.chat.completions.stream(**{**chat_settings, 'model': endpoint.model}, stream_options={"include_usage": True}) as stream:
+                    async for event in stream:
+                        if event.type == "content.delta":
+                            streamed_output = True
+                            yield {"type": "partial", "data": event.parsed if response_format else event.snapshot}
+                    completion = await stream.get_final_completion()
+                limiter.record_usage(completion.usage, estimated_tokens)
+
+            message = completion.choices[0].message
+            answer = message.parsed if response_format else message.content
+            success = True
+            break
         except Exception as e:
-            logger.error(f"Failed to log LLM call: {e}")
-            session.rollback()
-        finally:
-            session.close()
+            # Once output has been relayed we can't take it back, so only retry before that.
+            if not streamed_output and is_retryable(e) and attempt < settings.llm_max_retries:
+                delay = llm_scheduler.get_retry_delay(attempt, e)
+                logger.warning(f"[ask_llm_stream] {endpoint.key} attempt {attempt + 1} failed with {type(e).__name__}, retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            logger.error(f"[ask_llm_stream] Exception during LLM call: {e}")
+            answer = f"LLM call failed: {str(e)}"
+            response_data = {"error": str(e)}
+            break
+
+    llm_request_duration.observe(time.perf_counter() - started_at, model=model, name=name or '', outcome="success" if success else "error")
+    if not success:
+        request_span.error = answer
+    tracer.end_span(request_span)
+    if success:
+        record_usage(endpoint.model, name, completion.usage)
+
+    log_id = await save_llm_log(
+        model=endpoint.model,
+        name=name,
+        chain_id=str(chain_id),
+        messages=messages,
+        response=get_response_data(completion) if success else response_data,
+        answer=serialize_answer(answer),
+        success=success,
+        cache_key=cache_key,
+    )
 
     if not success:
         raise Exception(answer)
-    return answer, completion, chain_id
+
+    if cache_key:
+        await response_cache.set(cache_key, CachedResponse(answer=answer, completion=completion, log_id=log_id))
+        await semantic_cache.add(model, name, messages, serialize_answer(answer), log_id)
+
+    yield {"type": "final", "answer": answer, "completion": completion, "chain_id": chain_id}
 
 
 async def get_llm_image(
@@ -121,36 +410,40 @@ async def get_llm_image(
         size=default_image_size,
         response_format=default_image_response_format,
         style=default_image_style,
-        chain_id=None
+        chain_id=None,
+        priority=PRIORITY_BACKGROUND
 ):
     if not chain_id:
-        chain_id = uuid4()
+        chain_id = current_chain_id() or uuid4()
+    
+    with llm_request_duration.time(model=model, name='image'), span("llm.image", chain_id=chain_id, model=model):
+        image_response = await llm_scheduler.run(
+            model,
+            lambda: get_llm_client().images.with_raw_response.generate(
+                prompt=prompt,
+                model=model,
+                n=n,
+                size=size,
+                response_format=response_format,
+                style=style,
+                timeout=image_timeout,
+            ),
+            priority=priority,
+        )
     
-    image_response = await client.images.generate(
-        prompt=prompt,
+    await save_llm_log(
         model=model,
-        n=n,
-        size=size,
-        response_format=response_format,
-        style=style
+        messages=prompt,
+        # not the images themselves, they're in the blob store once saved
+        response={
+            "created": image_response.created,
+            "images": len(image_response.data),
+            "revised_prompts": [obj.revised_prompt for obj in image_response.data],
+        },
+        success=True,
+        chain_id=str(chain_id)
     )
     
-    with get_session() as session:
-        try:
-            log_entry = LLMLogTable(
-                model=model,
-                messages=prompt,
-                response=str(image_response)[:100],
-                chain_id=str(chain_id)
-            )
-            session.add(log_entry)
-            session.commit()
-        except Exception as e:
-            logger.error(f"Failed to log LLM call: {e}")
-            session.rollback()
-        finally:
-            session.close()
-    
     if response_format == 'b64_json':
         return [base64.b64decode(obj.b64_json) for obj in image_response.data]
     return image_response
\ No newline at end of file
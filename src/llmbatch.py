@@ -0,0 +1,230 @@
+import asyncio
+import json
+from dataclasses import dataclass
+from typing import Any, Optional
+from uuid import uuid4
+
+from config import settings
+from logger import logger
+
+from llm import ask_llm, default_model, get_chat_settings, get_llm_client, save_llm_log, serialize_answer
+from llmscheduler import PRIORITY_BACKGROUND
+
+
+@dataclass
+class LLMCall:
+    messages: list
+    response_format: Any = None
+    name: Optional[str] = None
+    model: str = default_model
+
+
+async def ask_llm_many(calls, chain_id: str, concurrency: int, priority: int = PRIORITY_BACKGROUND) -> list:
+    '''
+    Run many `ask_llm` calls with at most `concurrency` of them in flight (on top of the
+    scheduler's per-model limits). Returns each call's answer, or the exception it raised.
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(call):
+        async with semaphore:
+            answer, _, _ = await ask_llm(
+                messages=call.messages,
+                response_format=call.response_format,
+                model=call.model,
+                chain_id=chain_id,
+                name=call.name,
+                priority=priority,
+            )
+            return answer
+
+    return await asyncio.gather(*[run(call) for call in calls], return_exceptions=True)
+
+
+''' Offline batches '''
+
+def get_batch_request_body(call: LLMCall) -> dict:
+    ''' The chat completion request body for one line of a batch input file '''
+    from openai.lib._parsing._completions import type_to_response_format_param
+
+    body = get_chat_settings(call.messages, None, call.model)
+    if call.response_format:
+        body['response_format'] = type_to_response_format_param(call.response_format)
+    return body
+
+
+class BatchBackend:
+    '''
+    Runs a list of OpenAI-Batch-style request lines (`{"custom_id", "method", "url", "body"}`).
+    `poll` returns None until the batch is done, then its output lines
+    (`{"custom_id", "response": {"status_code", "body"}, "error"}`).
+    '''
+
+    async def submit(self, lines: list) -> str:
+        raise NotImplementedError
+
+    async def poll(self, batch_id: str) -> Optional[list]:
+        raise NotImplementedError
+
+
+class OpenAIBatchBackend(BatchBackend):
+    ''' The provider's Batch API: cheaper, but results can take up to its 24h completion window '''
+
+    pending_statuses = ('validating', 'in_progress', 'finalizing')
+
+    async def submit(self, lines):
+        input_file = await get_llm_client().files.create(
+            file=(f"batch-{uuid4()}.jsonl", '\n'.join(json.dumps(line) for line in lines).encode()),
+            purpose='batch',
+        )
+        batch = await get_llm_client().batches.create(
+            input_file_id=input_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h',
+        )
+        logger.info(f"[OpenAIBatchBackend] submitted batch {batch.id} with {len(lines)} requests")
+        return batch.id
+
+    async def poll(self, batch_id):
+        batch = await get_llm_client().batches.retrieve(batch_id)
+        if batch.status in self.pending_statuses:
+            return None
+        if batch.status == 'failed':
+            raise Exception(f"Batch {batch_id} failed: {batch.errors}")
+
+        # completed, or expired / cancelled with whatever finished before that
+        output = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                content = await get_llm_client().files.content(file_id)
+                output.extend(json.loads(line) for line in content.text.splitlines() if line.strip())
+        return output
+
+
+def stub_from_schema(schema: dict, defs: dict = None):
+    ''' The simplest value that satisfies a JSON schema, E.g. {"title": "stub", "text": "stub"} '''
+    defs = schema.get('$defs', {}) if defs is None else defs
+    if '$ref' in schema:
+        return stub_from_schema(defs[schema['$ref'].split('/')[-1]], defs)
+    if 'enum' in schema:
+        return schema['enum'][0]
+    if schema.get('type') == 'object':
+        return {key: stub_from_schema(value, defs) for key, value in schema.get('properties', {}).items()}
+    return {'string': 'stub', 'integer': 1, 'number': 1.0, 'boolean': False, 'array': []}.get(schema.get('type'))
+
+
+class LocalBatchBackend(BatchBackend):
+    ''' Completes batches in memory with stub answers, for trying out the offline flow without the provider '''
+
+    def __init__(self):
+        self.batches = {}
+
+    async def submit(self, lines):
+        batch_id = f"local-batch-{uuid4()}"
+        self.batches[batch_id] = [self.complete(line) for line in lines]
+        return batch_id
+
+    async def poll(self, batch_id):
+        return self.batches[batch_id]   # kept, so a retried poll gets the same output
+
+    def complete(self, line):
+        body = line['body']
+        response_format = body.get('response_format')
+        if response_format:
+            content = json.dumps(stub_from_schema(response_format['json_schema']['schema']))
+        else:
+            content = 'stub'
+        return {
+            "id": f"local-{uuid4()}",
+            "custom_id": line['custom_id'],
+            "response": {
+                "status_code": 200,
+                "body": {
+                    "id": f"local-{uuid4()}",
+                    "object": "chat.completion",
+                    "model": body['model'],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+                },
+            },
+            "error": None,
+        }
+
+
+batch_backends = {
+    'openai': OpenAIBatchBackend,
+    'local': LocalBatchBackend,
+}
+
+
+def get_batch_backend() -> BatchBackend:
+    try:
+        return batch_backends[settings.llm_batch_backend]()
+    except KeyError:
+        raise ValueError(f"Unknown LLM batch backend: {settings.llm_batch_backend}")
+
+
+llm_batch_backend = get_batch_backend()
+
+
+def get_batch_answer(call: LLMCall, line: Optional[dict]):
+    ''' Parse one output line into the call's answer, raises if the request failed '''
+    if line is None:
+        raise Exception("No result in batch output")
+    response = line.get('response') or {}
+    if line.get('error') or response.get('status_code') != 200:
+        raise Exception(f"Batch request failed: {line.get('error') or response.get('body')}")
+
+    content = response['body']['choices'][0]['message']['content']
+    return call.response_format.model_validate_json(content) if call.response_format else content
+
+
+def get_batch_lines(calls) -> list:
+    return [
+        {"custom_id": str(i), "method": "POST", "url": "/v1/chat/completions", "body": get_batch_request_body(call)}
+        for i, call in enumerate(calls)
+    ]
+
+
+async def submit_offline(calls) -> str:
+    """
+    Submit the calls as one batch file, returns the batch's id for `poll_offline`. Save the id
+    (E.g. in the payload of the job that polls it) before waiting on it: submitting again is
+    another paid batch.
+    """
+    return await llm_batch_backend.submit(get_batch_lines(calls))
+
+
+async def poll_offline(batch_id: str) -> Optional[list]:
+    """ None while the batch runs, then its output lines for `get_offline_answers` """
+    return await llm_batch_backend.poll(batch_id)
+
+
+async def get_offline_answers(calls, output: list, chain_id: str) -> list:
+    """
+    Each call's answer (or the exception for it) from a finished batch's output, like
+    `ask_llm_many` returns them. Each result is logged to `ai_llm_logs` under `chain_id`
+    like a regular call.
+    """
+    by_custom_id = {line['custom_id']: line for line in output}
+    results = []
+    for i, call in enumerate(calls):
+        line = by_custom_id.get(str(i))
+        try:
+            answer = get_batch_answer(call, line)
+            success = True
+        except Exception as e:
+            answer = e
+            success = False
+
+        await save_llm_log(
+            model=call.model,
+            name=call.name,
+            chain_id=str(chain_id),
+            messages=call.messages,
+            response=((line or {}).get('response') or {}).get('body') or {"error": str(answer)},
+            answer=serialize_answer(answer if success else f"LLM call failed: {answer}"),
+            success=success,
+        )
+        results.append(answer)
+    return results
@@ -0,0 +1,129 @@
+import datetime
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from sqlalchemy import select
+
+from config import settings
+from logger import logger
+
+from database import get_async_session
+from apps.main.models import LLMLogTable
+
+
+@dataclass
+class CachedResponse:
+    answer: Any
+    completion: Any       # None when the answer was rebuilt from the log table
+    log_id: str           # the ai_llm_logs row that produced this answer
+
+
+def get_cache_key(chat_settings: dict) -> str:
+    ''' Identical (model, messages, settings, response_format) inputs share a key '''
+    key_data = {k: v for k, v in chat_settings.items() if k != 'response_format'}
+    response_format = chat_settings.get('response_format')
+    if response_format is not None:
+        key_data['response_format'] = response_format.model_json_schema()
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResponseCache:
+    async def get(self, key: str, response_format=None) -> Optional[CachedResponse]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: CachedResponse):
+        raise NotImplementedError
+
+
+class MemoryResponseCache(ResponseCache):
+    ''' LRU with a TTL, per process '''
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+
+    async def get(self, key, response_format=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    async def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class LogTableResponseCache(ResponseCache):
+    ''' Answers from earlier successful calls in `ai_llm_logs`, shared across processes and restarts '''
+
+    def __init__(self, ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+
+    async def get(self, key, response_format=None):
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl_seconds)
+        async with get_async_session() as session:
+            log = await session.scalar(
+                select(LLMLogTable)
+                .where(
+                    LLMLogTable.cache_key == key,
+                    LLMLogTable.success == True,
+                    LLMLogTable.cache_hit == False,
+                    LLMLogTable.created_at >= since,
+                )
+                .order_by(LLMLogTable.created_at.desc())
+                .limit(1)
+            )
+            if not log:
+                return None
+
+        try:
+            answer = response_format.model_validate_json(log.answer) if response_format else log.answer
+        except Exception as e:
+            logger.warning(f"[LogTableResponseCache] could not rebuild answer from log {log.id}: {e}")
+            return None
+        return CachedResponse(answer=answer, completion=None, log_id=log.id)
+
+    async def set(self, key, value):
+        pass  # the log row written by ask_llm is the entry
+
+
+class TieredResponseCache(ResponseCache):
+    ''' Checks each tier in order, and backfills the faster tiers on a hit '''
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+
+    async def get(self, key, response_format=None):
+        for i, tier in enumerate(self.tiers):
+            value = await tier.get(key, response_format)
+            if value is not None:
+                for faster_tier in self.tiers[:i]:
+                    await faster_tier.set(key, value)
+                return value
+        return None
+
+    async def set(self, key, value):
+        for tier in self.tiers:
+            await tier.set(key, value)
+
+
+def get_response_cache() -> ResponseCache:
+    tiers = [MemoryResponseCache(settings.llm_cache_max_entries, settings.llm_cache_ttl_seconds)]
+    if settings.llm_cache_persistent:
+        tiers.append(LogTableResponseCache(settings.llm_cache_ttl_seconds))
+    return TieredResponseCache(tiers)
+
+
+response_cache = get_response_cache()
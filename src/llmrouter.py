@@ -0,0 +1,173 @@
+import asyncio
+import functools
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+from config import settings
+from logger import logger
+from metrics import percentile, registry, llm_endpoint_latency, llm_fallbacks, llm_hedged_requests
+
+
+@dataclass(frozen=True)
+class LLMEndpoint:
+    model: str
+    base_url: Optional[str] = None   # None is the default client (the provider, or llm_base_url)
+    api_key: Optional[str] = None    # None is openai_api_key
+
+    @property
+    def key(self) -> str:
+        ''' Also its `llm_scheduler` limiter, so per-endpoint limits go in llm_model_limits under this '''
+        return self.model if self.base_url is None else f"{self.model}@{self.base_url}"
+
+
+class EndpointStats:
+    ''' Recent latencies (an EWMA, and a window for percentiles) and consecutive failures of one endpoint '''
+
+    def __init__(self, window: int, alpha: float):
+        self.latencies = deque(maxlen=window)
+        self.alpha = alpha
+        self.ewma = None
+        self.failures = 0
+        self.skip_until = 0.0
+
+    def observe(self, seconds: float):
+        self.latencies.append(seconds)
+        self.ewma = seconds if self.ewma is None else self.alpha * seconds + (1 - self.alpha) * self.ewma
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= settings.llm_endpoint_failure_threshold:
+            self.skip_until = time.monotonic() + settings.llm_endpoint_cooldown_seconds
+
+    def is_healthy(self) -> bool:
+        return time.monotonic() >= self.skip_until
+
+    def get_p95(self) -> Optional[float]:
+        ''' None until there are enough samples to trust it '''
+        if len(self.latencies) < settings.llm_hedge_min_samples:
+            return None
+        return percentile(list(self.latencies), 0.95)
+
+
+class LLMRouter:
+    '''
+    Sends each call to one of the endpoints configured for its name in `llm_routes` (or just
+    the requested model on the default client). The first healthy endpoint is the primary. If it
+    hasn't answered within its observed p95, the same request is hedged to the next endpoint: the
+    first success wins and the other is cancelled. If an endpoint fails (after the scheduler's
+    retries), the call falls back to the next one; after `llm_endpoint_failure_threshold`
+    failures in a row an endpoint is skipped for `llm_endpoint_cooldown_seconds`.
+    '''
+
+    def __init__(self, routes: dict):
+        self.routes = {
+            name: [LLMEndpoint(**endpoint) for endpoint in endpoints]
+            for name, endpoints in routes.items()
+        }
+        self.stats = {}
+
+    def get_stats(self, endpoint: LLMEndpoint) -> EndpointStats:
+        if endpoint.key not in self.stats:
+            self.stats[endpoint.key] = EndpointStats(settings.llm_latency_window, settings.llm_latency_ewma_alpha)
+        return self.stats[endpoint.key]
+
+    def get_endpoints(self, name: str, model: str) -> list:
+        ''' The name's endpoints, healthy ones first, each group in configured order '''
+        endpoints = self.routes.get(name) or [LLMEndpoint(model=model)]
+        return sorted(endpoints, key=lambda endpoint: not self.get_stats(endpoint).is_healthy())
+
+    def get_hedge_delay(self, endpoint: LLMEndpoint) -> Optional[float]:
+        if not settings.llm_hedging_enabled:
+            return None
+        p95 = self.get_stats(endpoint).get_p95()
+        return None if p95 is None else max(p95, settings.llm_hedge_min_delay_ms / 1000)
+
+    async def attempt(self, endpoint: LLMEndpoint, make_request, tried: list):
+        tried.append(endpoint)
+        stats = self.get_stats(endpoint)
+        started_at = time.perf_counter()
+        try:
+            result = await make_request(endpoint, get_endpoint_client(endpoint.base_url, endpoint.api_key))
+        except asyncio.CancelledError:
+            raise   # lost a hedge race, that says nothing about the endpoint
+        except Exception:
+            stats.record_failure()
+            raise
+        stats.observe(time.perf_counter() - started_at)
+        return result
+
+    async def run_hedged(self, name: str, primary: LLMEndpoint, hedge: Optional[LLMEndpoint], make_request, tried: list):
+        '''
+        (result, endpoint) from `primary`, or from `hedge` if that answers first once hedged.
+        Every endpoint actually sent the request is added to `tried`.
+        '''
+        primary_task = asyncio.ensure_future(self.attempt(primary, make_request, tried))
+        delay = self.get_hedge_delay(primary)
+        if hedge is None or delay is None:
+            return await primary_task, primary
+
+        done, _ = await asyncio.wait({primary_task}, timeout=delay)
+        if done:
+            return primary_task.result(), primary
+
+        logger.info(f"[LLMRouter] {name}: {primary.key} slower than {delay:.2f}s, hedging to {hedge.key}")
+        tasks = {primary_task: primary, asyncio.ensure_future(self.attempt(hedge, make_request, tried)): hedge}
+        pending = set(tasks)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        llm_hedged_requests.inc(name=name or '', winner='hedge' if tasks[task] is hedge else 'primary')
+                        return task.result(), tasks[task]
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def run(self, name: str, model: str, make_request):
+        '''
+        `make_request(endpoint, client)` sends the call to one endpoint (E.g. through
+        `llm_scheduler`). Returns (result, the endpoint that answered).
+        '''
+        endpoints = self.get_endpoints(name, model)
+        tried = []
+        while True:
+            untried = [endpoint for endpoint in endpoints if endpoint not in tried]
+            primary, hedge = untried[0], (untried[1] if len(untried) > 1 else None)
+            try:
+                return await self.run_hedged(name, primary, hedge, make_request, tried)
+            except Exception as e:
+                if all(endpoint in tried for endpoint in endpoints):
+                    raise
+                llm_fallbacks.inc(name=name or '')
+                logger.warning(f"[LLMRouter] {name}: {primary.key} failed with {type(e).__name__}, falling back")
+
+
+@functools.cache
+def get_endpoint_client(base_url: Optional[str], api_key: Optional[str]):
+    ''' The shared client for the default endpoint, and one more per other base_url / api_key '''
+    from llm import create_llm_client, get_llm_client  # llm imports this module
+
+    if base_url is None and api_key is None:
+        return get_llm_client()
+    return create_llm_client(base_url=base_url, api_key=api_key)
+
+
+llm_router = LLMRouter(settings.llm_routes)
+
+
+@registry.collector
+async def collect_endpoint_latency():
+    for key, stats in llm_router.stats.items():
+        if stats.ewma is not None:
+            llm_endpoint_latency.set(stats.ewma, endpoint=key, stat='ewma')
+        if (p95 := stats.get_p95()) is not None:
+            llm_endpoint_latency.set(p95, endpoint=key, stat='p95')
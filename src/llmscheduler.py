@@ -0,0 +1,229 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import random
+import re
+import time
+from contextlib import asynccontextmanager
+
+from config import settings
+from logger import logger
+
+
+# Priority classes, lower runs first.
+PRIORITY_INTERACTIVE = 0   # a user is waiting on the response, e.g. haiku generation
+PRIORITY_BACKGROUND = 10   # background tasks, e.g. critiques and image prompts
+
+@functools.cache
+def get_retryable_errors() -> tuple:
+    import openai  # on first use, so importing the app doesn't pay for the SDK
+
+    return (
+        openai.RateLimitError,
+        openai.APIConnectionError,   # includes APITimeoutError
+        openai.InternalServerError,
+    )
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    import openai
+
+    return isinstance(error, openai.RateLimitError)
+
+
+def is_retryable(error: Exception) -> bool:
+    return isinstance(error, get_retryable_errors())
+
+
+def parse_reset_duration(value: str) -> float:
+    ''' Rate limit reset headers look like "1s", "6m0s" or "20ms" '''
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(amount) * units[unit] for amount, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', value or ''))
+
+
+class PrioritySemaphore:
+    ''' A semaphore that hands free slots to the lowest priority value first, FIFO within a priority '''
+
+    def __init__(self, value: int):
+        self.value = value
+        self.waiters = []
+        self.counter = itertools.count()
+
+    async def acquire(self, priority: int):
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # we were handed a slot just as we got cancelled
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, waiter = heapq.heappop(self.waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.value += 1
+
+
+class TokenBucket:
+    ''' Refills continuously up to `per_minute`, and can be corrected from rate limit headers '''
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, amount: float):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                wait = self.blocked_until - time.monotonic()
+                if wait <= 0:
+                    self.refill()
+                    if self.tokens >= amount:
+                        self.tokens -= amount
+                        return
+                    wait = (amount - self.tokens) / self.rate
+                await asyncio.sleep(wait)
+
+    def consume(self, amount: float):
+        ''' Account for usage after the fact, e.g. when a call used more tokens than estimated '''
+        self.refill()
+        self.tokens -= amount
+
+    def update(self, remaining: float, reset_seconds: float):
+        ''' The provider knows best: never assume more headroom than it reports '''
+        self.refill()
+        self.tokens = min(self.tokens, remaining)
+        if remaining <= 0 and reset_seconds:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + reset_seconds)
+
+    def block_for(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class ModelLimiter:
+    def __init__(self, max_concurrency: int, requests_per_minute: int, tokens_per_minute: int):
+        self.slots = PrioritySemaphore(max_concurrency)
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def record_usage(self, usage, estimated_tokens: int):
+        ''' Settle the token estimate against what the call actually used '''
+        if usage and getattr(usage, 'total_tokens', None):
+            self.tokens.consume(usage.total_tokens - estimated_tokens)
+
+    def update_from_headers(self, headers):
+        if 'x-ratelimit-remaining-requests' in headers:
+            self.requests.update(
+                float(headers['x-ratelimit-remaining-requests']),
+                parse_reset_duration(headers.get('x-ratelimit-reset-requests')),
+            )
+        if 'x-ratelimit-remaining-tokens' in headers:
+            self.tokens.update(
+                float(headers['x-ratelimit-remaining-tokens']),
+                parse_reset_duration(headers.get('x-ratelimit-reset-tokens')),
+            )
+
+
+class LLMScheduler:
+    '''
+    Every provider call goes through `run`: it waits for a concurrency slot for its model
+    (by priority), then for request and token budget, and retries retryable errors with
+    jittered exponential backoff.
+    '''
+
+    def __init__(self):
+        self.limiters = {}
+
+    def get_limiter(self, model: str) -> ModelLimiter:
+        if model not in self.limiters:
+            limits = {
+                'max_concurrency': settings.llm_max_concurrency,
+                'requests_per_minute': settings.llm_requests_per_minute,
+                'tokens_per_minute': settings.llm_tokens_per_minute,
+                **settings.llm_model_limits.get(model, {}),
+            }
+            self.limiters[model] = ModelLimiter(**limits)
+        return self.limiters[model]
+
+    def get_retry_delay(self, attempt: int, error: Exception) -> float:
+        response = getattr(error, 'response', None)
+        if response is not None:
+            if 'retry-after-ms' in response.headers:
+                return float(response.headers['retry-after-ms']) / 1000
+            if 'retry-after' in response.headers:
+                try:
+                    return float(response.headers['retry-after'])
+                except ValueError:
+                    pass
+        delay = min(settings.llm_retry_max_delay, settings.llm_retry_base_delay * 2 ** attempt)
+        return delay * random.uniform(0.5, 1)
+
+    async def run(self, model: str, make_request, priority: int = PRIORITY_INTERACTIVE, estimated_tokens: int = 0):
+        '''
+        `make_request` is called (possibly several times) to send the request, and must return
+        a raw response (`client....with_raw_response....`) so we can read its rate limit headers.
+        '''
+        limiter = self.get_limiter(model)
+
+        for attempt in range(settings.llm_max_retries + 1):
+            await limiter.slots.acquire(priority)
+            try:
+                await limiter.requests.acquire(1)
+                await limiter.tokens.acquire(estimated_tokens)
+                raw_response = await make_request()
+            except get_retryable_errors() as e:
+                response = getattr(e, 'response', None)
+                if response is not None:
+                    limiter.update_from_headers(response.headers)
+                if attempt == settings.llm_max_retries:
+                    raise
+                delay = self.get_retry_delay(attempt, e)
+                if is_rate_limit_error(e):
+                    # Hold back everyone on this model, not just this call.
+                    limiter.requests.block_for(delay)
+                logger.warning(f"[LLMScheduler] {model} attempt {attempt + 1} failed with {type(e).__name__}, retrying in {delay:.2f}s")
+            else:
+                limiter.update_from_headers(raw_response.headers)
+                result = raw_response.parse()
+                limiter.record_usage(getattr(result, 'usage', None), estimated_tokens)
+                return result
+            finally:
+                limiter.slots.release()
+
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def reserve(self, model: str, priority: int = PRIORITY_INTERACTIVE, estimated_tokens: int = 0):
+        '''
+        Hold a slot and budget for a call `run` can't wrap, e.g. a stream. The caller owns
+        retries, and should `record_usage` on the yielded limiter when it's done.
+        '''
+        limiter = self.get_limiter(model)
+        await limiter.slots.acquire(priority)
+        try:
+            await limiter.requests.acquire(1)
+            await limiter.tokens.acquire(estimated_tokens)
+            yield limiter
+        finally:
+            limiter.slots.release()
+
+
+llm_scheduler = LLMScheduler()
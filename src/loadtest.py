@@ -0,0 +1,341 @@
+''' End-to-end load test: the real app, against `fakeopenai`, with mixed traffic and many dashboard viewers.
+
+Usage: `python -m loadtest --duration 60 --projects 5 --viewers 40 --concurrency 20 --output run.json`
+
+Starts the fake provider and `uvicorn app:app` (on a fresh SQLite database, with `LLM_BASE_URL`
+pointing at the fake), opens `--viewers` dashboard websockets per project, and has `--concurrency`
+clients send a weighted mix of project creation, `/haiku`, `/haiku-critique`,
+`/generate-image-prompts` and `/generate-image` for `--duration` seconds. It then waits `--drain`
+seconds for queued jobs to finish and prints a JSON report:
+- per operation: count, errors, throughput, p50 / p99 latency
+- dashboards: messages and bytes received, and the lag from a change being recorded to a viewer
+  receiving it (p50 / p99 / max)
+- the app's RSS (start / peak / end) and what the fake provider served
+Provider-side latency, errors and image sizes are passed through to `fakeopenai`.
+'''
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+from websockets.asyncio.client import connect
+
+from metrics import percentile
+
+
+# operation -> relative weight in the traffic mix
+default_mix = {
+    "create_project": 1,
+    "haiku": 8,
+    "haiku_critique": 4,
+    "generate_image_prompts": 2,
+    "generate_image": 1,
+}
+
+
+class LoadTestState:
+    ''' What the traffic and the viewers have seen so far, shared between them '''
+
+    def __init__(self):
+        self.project_ids = []
+        self.haiku_ids = []
+        self.prompts = []   # (prompt_id, haiku_id), from image_prompt_saved deltas
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.viewer_messages = 0
+        self.viewer_bytes = 0
+        self.viewer_errors = 0
+        self.delivery_lags = []
+
+
+def summarize(values: list) -> dict:
+    return {
+        "p50_ms": round(percentile(values, 0.5) * 1000, 1),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+        "max_ms": round(max(values, default=0) * 1000, 1),
+    }
+
+
+def read_rss_mb(pid: int):
+    ''' Resident set size from /proc, None where that isn't available '''
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+async def wait_for_http(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as http:
+        while True:
+            try:
+                if (await http.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if process.poll() is not None:
+                raise RuntimeError(f"{process.args} exited with {process.returncode}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{url} not up within {timeout}s")
+            await asyncio.sleep(0.1)
+
+
+def stop_process(process: subprocess.Popen, timeout: float = 15):
+    ''' SIGTERM, then SIGKILL if it hasn't exited within `timeout`, so a hung server never outlives the run '''
+    process.terminate()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        print(f"{process.args} did not exit within {timeout}s of SIGTERM, killing it", file=sys.stderr)
+        process.kill()
+        process.wait()
+
+
+async def view_dashboard(ws_url: str, state: LoadTestState, stop: asyncio.Event):
+    try:
+        async with connect(ws_url, max_size=None) as websocket:
+            while not stop.is_set():
+                try:
+                    raw = await asyncio.wait_for(websocket.recv(), timeout=1)
+                except asyncio.TimeoutError:
+                    continue
+                received_at = datetime.datetime.utcnow()
+                state.viewer_messages += 1
+                state.viewer_bytes += len(raw)
+
+                message = json.loads(raw)
+                if message.get("type") != "delta":
+                    continue
+                if message.get("created_at"):
+                    state.delivery_lags.append((received_at - datetime.datetime.fromisoformat(message["created_at"])).total_seconds())
+                data = message.get("data") or {}
+                if message["kind"] == "haiku_created":
+                    state.haiku_ids.append(data["haiku"]["id"])
+                elif message["kind"] == "image_prompt_saved":
+                    state.prompts.append((data["image_prompt"]["id"], data["haiku_id"]))
+    except Exception:
+        state.viewer_errors += 1
+
+
+async def run_operation(http: httpx.AsyncClient, operation: str, state: LoadTestState):
+    if operation == "create_project":
+        response = await http.post("/projects/", json={"name": f"loadtest {len(state.project_ids)}"})
+        if response.status_code == 200:
+            state.project_ids.append(response.json()["project_id"])
+        return response
+    if operation == "haiku":
+        # a new description each time, so this measures the provider path rather than the response cache
+        description = f"a frog in a quiet pond, take {random.randrange(10 ** 9)}"
+        return await http.post("/projects/haiku", json={"project_id": random.choice(state.project_ids), "description": description})
+    if operation == "haiku_critique":
+        return await http.post("/projects/haiku-critique", json={"haiku_id": random.choice(state.haiku_ids)})
+    if operation == "generate_image_prompts":
+        return await http.post("/projects/generate-image-prompts", json={"haiku_id": random.choice(state.haiku_ids)})
+    if operation == "generate_image":
+        prompt_id, haiku_id = random.choice(state.prompts)
+        return await http.post("/projects/generate-image", json={"prompt_id": prompt_id, "haiku_id": haiku_id})
+    raise ValueError(f"Unknown operation {operation}")
+
+
+def choose_operation(mix: dict, state: LoadTestState) -> str:
+    ''' A weighted pick, among the operations there's something to run on yet '''
+    available = {
+        "create_project": True,
+        "haiku": bool(state.project_ids),
+        "haiku_critique": bool(state.haiku_ids),
+        "generate_image_prompts": bool(state.haiku_ids),
+        "generate_image": bool(state.prompts),
+    }
+    operations = [operation for operation in mix if available[operation] and mix[operation] > 0]
+    return random.choices(operations, weights=[mix[operation] for operation in operations])[0]
+
+
+async def send_traffic(http: httpx.AsyncClient, mix: dict, state: LoadTestState, deadline: float):
+    while time.monotonic() < deadline:
+        operation = choose_operation(mix, state)
+        started_at = time.perf_counter()
+        try:
+            response = await run_operation(http, operation, state)
+            failed = response.status_code >= 400
+        except httpx.HTTPError:
+            failed = True
+        state.latencies[operation].append(time.perf_counter() - started_at)
+        if failed:
+            state.errors[operation] += 1
+
+
+async def sample_rss(pid: int, samples: list, stop: asyncio.Event):
+    while not stop.is_set():
+        if (rss := read_rss_mb(pid)) is not None:
+            samples.append(rss)
+        await asyncio.sleep(0.5)
+
+
+def read_metric(metrics_text: str, name: str) -> dict:
+    ''' Label string -> value for each series of `name` in a /metrics response, E.g. {'status="queued"': 3.0} '''
+    values = {}
+    for line in metrics_text.splitlines():
+        if line.startswith(name + '{') or line.startswith(name + ' '):
+            series, value = line.rsplit(' ', 1)
+            values[series[len(name):].strip('{}')] = float(value)
+    return values
+
+
+def get_fake_provider_args(args) -> list:
+    fake_args = [
+        "--port", str(args.fake_port),
+        "--chat-latency", args.chat_latency,
+        "--image-latency", args.image_latency,
+        "--error-rate", str(args.error_rate),
+        "--rate-limit-rate", str(args.rate_limit_rate),
+    ]
+    if args.image_size:
+        fake_args += ["--image-size", args.image_size]
+    return fake_args
+
+
+def get_app_env(args, directory: str) -> dict:
+    env = {
+        **os.environ,
+        "LLM_BASE_URL": f"http://127.0.0.1:{args.fake_port}/v1",
+        "OPENAI_API_KEY": "loadtest",
+        "DB_ENGINE_URL": f"sqlite:///{directory}/loadtest.sqlite",
+        "BLOB_STORE_PATH": os.path.join(directory, "blobs"),
+        "LLM_LOG_ARCHIVE_PATH": os.path.join(directory, "llm_log_archive"),
+        "JOBS_WORKER_CONCURRENCY": str(args.job_concurrency),
+        "TRACING_EXPORTER": "none",
+    }
+    if not args.provider_limits:
+        # the fake provider has no rate limits, so neither should our scheduler
+        env.update({
+            "LLM_MAX_CONCURRENCY": "256",
+            "LLM_REQUESTS_PER_MINUTE": "1000000",
+            "LLM_TOKENS_PER_MINUTE": "1000000000",
+            "LLM_MODEL_LIMITS": "{}",
+        })
+    return env
+
+
+async def run_load_test(args) -> dict:
+    mix = {**default_mix, **json.loads(args.mix)} if args.mix else default_mix
+    state = LoadTestState()
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    with tempfile.TemporaryDirectory() as directory:
+        fake = subprocess.Popen([sys.executable, "-m", "fakeopenai", *get_fake_provider_args(args)])
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--port", str(args.port), "--log-level", "warning",
+             "--ws", "websockets", "--ws-per-message-deflate", "true"],
+            env=get_app_env(args, directory),
+        )
+        stop = asyncio.Event()
+        rss_samples = []
+        try:
+            await wait_for_http(f"http://127.0.0.1:{args.fake_port}/stats", fake)
+            await wait_for_http(f"{base_url}/metrics", server)
+            rss_task = asyncio.create_task(sample_rss(server.pid, rss_samples, stop))
+
+            limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.request_timeout) as http:
+                for _ in range(args.projects):
+                    await run_operation(http, "create_project", state)
+
+                viewers = [
+                    asyncio.create_task(view_dashboard(f"ws://127.0.0.1:{args.port}/projects/dashboard/{project_id}?snapshot={args.snapshot}", state, stop))
+                    for project_id in list(state.project_ids)
+                    for _ in range(args.viewers)
+                ]
+
+                started_at = time.perf_counter()
+                deadline = time.monotonic() + args.duration
+                await asyncio.gather(*[send_traffic(http, mix, state, deadline) for _ in range(args.concurrency)])
+                elapsed = time.perf_counter() - started_at
+
+            await asyncio.sleep(args.drain)   # let queued jobs finish and their deltas reach the viewers
+            stop.set()
+            await asyncio.gather(*viewers, rss_task)
+
+            async with httpx.AsyncClient() as http:
+                provider_stats = (await http.get(f"http://127.0.0.1:{args.fake_port}/stats")).json()
+                app_metrics = (await http.get(f"{base_url}/metrics")).text
+        finally:
+            stop.set()
+            for process in (server, fake):
+                stop_process(process)
+
+    total_count = sum(len(latencies) for latencies in state.latencies.values())
+    return {
+        "config": vars(args),
+        "duration_s": round(elapsed, 2),
+        "requests": {
+            operation: {
+                "count": len(latencies),
+                "errors": state.errors[operation],
+                "throughput_rps": round(len(latencies) / elapsed, 2),
+                **summarize(latencies),
+            }
+            for operation, latencies in sorted(state.latencies.items())
+        },
+        "total": {
+            "count": total_count,
+            "errors": sum(state.errors.values()),
+            "throughput_rps": round(total_count / elapsed, 2),
+        },
+        "dashboards": {
+            "viewers": len(viewers),
+            "viewer_errors": state.viewer_errors,
+            "messages": state.viewer_messages,
+            "bytes": state.viewer_bytes,
+            "delivery_lag": summarize(state.delivery_lags),
+        },
+        "rss_mb": {
+            "start": rss_samples[0] if rss_samples else None,
+            "peak": max(rss_samples, default=None),
+            "end": rss_samples[-1] if rss_samples else None,
+        },
+        # jobs still queued / running here hadn't finished within --drain
+        "jobs": read_metric(app_metrics, "job_queue_depth"),
+        "cache_hits": read_metric(app_metrics, "llm_cache_hits_total"),
+        "provider": provider_stats,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the app end to end against a fake OpenAI server.")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of traffic")
+    parser.add_argument("--drain", type=float, default=10, help="seconds to wait for queued jobs afterwards")
+    parser.add_argument("--concurrency", type=int, default=20, help="clients sending requests")
+    parser.add_argument("--projects", type=int, default=5)
+    parser.add_argument("--viewers", type=int, default=20, help="dashboard websockets per project")
+    parser.add_argument("--snapshot", default="summary", choices=["summary", "full"])
+    parser.add_argument("--mix", default=None, help=f"JSON weights overriding {default_mix}")
+    parser.add_argument("--request-timeout", type=float, default=120)
+    parser.add_argument("--port", type=int, default=8020)
+    parser.add_argument("--fake-port", type=int, default=8021)
+    parser.add_argument("--chat-latency", default="lognormal:800,0.4")
+    parser.add_argument("--image-latency", default="lognormal:8000,0.3")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--image-size", default="512x512")
+    parser.add_argument("--job-concurrency", type=int, default=16, help="the app's in-process job worker slots")
+    parser.add_argument("--provider-limits", action="store_true", help="keep the app's configured provider rate limits")
+    parser.add_argument("--output", default=None, help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load_test(args))
+    encoded = json.dumps(report, indent=2)
+    print(encoded)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(encoded + "\n")
@@ -0,0 +1,171 @@
+import asyncio
+import datetime
+import json
+import os
+from itertools import groupby
+
+import zstandard
+from sqlalchemy import delete, insert, select
+
+from config import settings
+from logger import logger
+
+from database import get_async_session
+from apps.main.models import LLMLogArchiveIndexTable, LLMLogTable
+from jobs import enqueue_job, job_handler
+from logsink import strip_redundant_fields
+
+
+'''
+Retention for `ai_llm_logs`. A daily job moves rows older than `llm_log_retention_days` into
+append-only segment files, one per day (`2025-01-31.jsonl.zst`). Each chain's rows go in their
+own zstd frame, and `ai_llm_log_archive_index` records where, so a chain is read back without
+decompressing the rest of its day.
+'''
+
+def serialize_log(log) -> dict:
+    return {
+        "id": log.id,
+        "chain_id": log.chain_id,
+        "name": log.name,
+        "model": log.model,
+        "messages": log.messages,
+        "response": log.response,
+        "answer": log.answer,
+        "success": log.success,
+        "cache_key": log.cache_key,
+        "cache_hit": log.cache_hit,
+        "created_at": log.created_at.isoformat() if log.created_at else None,
+    }
+
+
+def get_segment_name(day: datetime.date) -> str:
+    return f"{day.isoformat()}.jsonl.zst"
+
+
+def write_frames(logs: list) -> list:
+    '''
+    Append `logs` (sorted by day, chain_id, created_at) to their days' segments, one frame per
+    chain and day. Returns an index row for each frame. Blocking, run it in a thread.
+    '''
+    os.makedirs(settings.llm_log_archive_path, exist_ok=True)
+    compressor = zstandard.ZstdCompressor(level=settings.llm_log_compression_level)
+    index_rows = []
+    for day, day_logs in groupby(logs, key=lambda log: log["created_at"][:10]):
+        segment = get_segment_name(datetime.date.fromisoformat(day))
+        with open(os.path.join(settings.llm_log_archive_path, segment), 'ab') as f:
+            for chain_id, chain_logs in groupby(day_logs, key=lambda log: log["chain_id"]):
+                chain_logs = list(chain_logs)
+                frame = compressor.compress(''.join(json.dumps(log, default=str) + '\n' for log in chain_logs).encode())
+                index_rows.append({
+                    "chain_id": chain_id,
+                    "segment": segment,
+                    "offset": f.tell(),
+                    "length": len(frame),
+                    "count": len(chain_logs),
+                })
+                f.write(frame)
+            f.flush()
+            os.fsync(f.fileno())
+    return index_rows
+
+
+def read_frame(segment: str, offset: int, length: int) -> list:
+    with open(os.path.join(settings.llm_log_archive_path, segment), 'rb') as f:
+        f.seek(offset)
+        frame = f.read(length)
+    lines = zstandard.ZstdDecompressor().decompress(frame).decode().splitlines()
+    return [json.loads(line) for line in lines if line]
+
+
+def get_retention_cutoff(now: datetime.datetime) -> datetime.datetime:
+    ''' Only whole days are archived, so each day's segment is written by one run '''
+    today = datetime.datetime.combine(now.date(), datetime.time())
+    return today - datetime.timedelta(days=settings.llm_log_retention_days)
+
+
+async def compact_batch(cutoff: datetime.datetime) -> int:
+    ''' Archive up to `llm_log_compaction_batch_size` rows older than `cutoff`, returns how many '''
+    async with get_async_session() as session:
+        logs = (await session.scalars(
+            select(LLMLogTable)
+            .where(LLMLogTable.created_at < cutoff)
+            .order_by(LLMLogTable.created_at)
+            .limit(settings.llm_log_compaction_batch_size)
+        )).all()
+        if not logs:
+            return 0
+
+        records = sorted(
+            (strip_redundant_fields(serialize_log(log)) for log in logs),
+            key=lambda log: (log["created_at"][:10], log["chain_id"], log["created_at"]),
+        )
+        # Written before the rows are deleted: if we crash in between, the rows are archived
+        # again next run and the first copy is never indexed, so nothing is lost or duplicated.
+        index_rows = await asyncio.to_thread(write_frames, records)
+
+        await session.execute(insert(LLMLogArchiveIndexTable), index_rows)
+        await session.execute(
+            delete(LLMLogTable)
+            .where(LLMLogTable.id.in_([log.id for log in logs]))
+            .execution_options(synchronize_session=False)
+        )
+    return len(logs)
+
+
+async def compact_llm_logs() -> int:
+    cutoff = get_retention_cutoff(datetime.datetime.utcnow())
+    total = 0
+    while count := await compact_batch(cutoff):
+        total += count
+    logger.info(f"[compact_llm_logs] archived {total} logs older than {cutoff.date()}")
+    return total
+
+
+def get_next_compaction_time(now: datetime.datetime) -> datetime.datetime:
+    run_at = datetime.datetime.combine(now.date(), datetime.time(hour=settings.llm_log_compaction_hour))
+    return run_at if run_at > now else run_at + datetime.timedelta(days=1)
+
+
+async def schedule_log_compaction():
+    ''' Queue the next daily compaction. Every process calls this, the idempotency key keeps it to one job a day '''
+    if settings.llm_log_retention_days <= 0:
+        return
+    run_at = get_next_compaction_time(datetime.datetime.utcnow())
+    await enqueue_job(
+        "compact_llm_logs",
+        {},
+        idempotency_key=f"compact-llm-logs:{run_at.date().isoformat()}",
+        run_after=run_at,
+    )
+
+
+@job_handler("compact_llm_logs")
+async def process_log_compaction():
+    """ Background job: archive old logs, then queue tomorrow's run """
+    archived = await compact_llm_logs()
+    await schedule_log_compaction()
+    return {"archived": archived}
+
+
+async def get_chain_logs(chain_id: str) -> list:
+    ''' Every log in a chain, oldest first, whether still in `ai_llm_logs` or archived '''
+    async with get_async_session() as session:
+        hot_logs = (await session.scalars(
+            select(LLMLogTable).where(LLMLogTable.chain_id == chain_id).order_by(LLMLogTable.created_at)
+        )).all()
+        frames = (await session.scalars(
+            select(LLMLogArchiveIndexTable).where(LLMLogArchiveIndexTable.chain_id == chain_id)
+        )).all()
+
+    archived_logs = []
+    for frame in frames:
+        try:
+            logs = await asyncio.to_thread(read_frame, frame.segment, frame.offset, frame.length)
+        except Exception as e:
+            logger.error(f"[get_chain_logs] could not read {frame.segment} at {frame.offset}: {e}", exc_info=True)
+            continue
+        archived_logs.extend({**log, "archived": True} for log in logs)
+
+    logs = archived_logs + [{**serialize_log(log), "archived": False} for log in hot_logs]
+    return sorted(logs, key=lambda log: log["created_at"] or '')
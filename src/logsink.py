@@ -0,0 +1,167 @@
+import asyncio
+import datetime
+import json
+import random
+from collections import deque
+from uuid import uuid4
+
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+
+from config import settings
+from logger import logger
+
+from database import get_async_session
+from apps.main.models import LLMLogTable
+
+
+def summarize_response(response: dict) -> dict:
+    ''' What we keep of a completion when its full body isn't stored '''
+    return {key: response[key] for key in ("id", "model", "created", "usage") if key in response}
+
+
+def apply_response_policy(record: dict) -> dict:
+    '''
+    Keep failures in full, but only sample successful responses, and truncate
+    any response bigger than `llm_log_response_max_bytes`.
+    '''
+    response = record.get("response")
+    if not isinstance(response, dict) or not record.get("success"):
+        return record
+
+    if random.random() >= settings.llm_log_response_sample_rate:
+        return {**record, "response": {**summarize_response(response), "sampled_out": True}}
+
+    encoded = json.dumps(response, default=str)
+    if len(encoded) > settings.llm_log_response_max_bytes:
+        return {**record, "response": {
+            **summarize_response(response),
+            "truncated": True,
+            "preview": encoded[:settings.llm_log_response_max_bytes],
+        }}
+    return record
+
+
+def strip_redundant_fields(record: dict) -> dict:
+    '''
+    Drop what a successful completion repeats from the row's other columns: the first
+    choice's content / parsed (that's `answer`), its empty fields, and a `model` equal to the column.
+    '''
+    response = record.get("response")
+    if not isinstance(response, dict) or not record.get("success") or record.get("answer") is None:
+        return record
+
+    response = {key: value for key, value in response.items() if not (key == "model" and value == record.get("model"))}
+    choices = response.get("choices")
+    if isinstance(choices, list) and choices and isinstance(choices[0], dict) and isinstance(choices[0].get("message"), dict):
+        message = {key: value for key, value in choices[0]["message"].items() if key not in ("content", "parsed") and value is not None}
+        response["choices"] = [{**choices[0], "message": message}, *choices[1:]]
+    return {**record, "response": response}
+
+
+class LLMLogSink:
+    '''
+    Buffers `ai_llm_logs` rows in memory and inserts them in batches from a background task,
+    so inference calls don't wait on a commit. Flushes every `max_batch` rows or `flush_ms`,
+    whichever comes first, and drops the oldest rows if more than `max_pending` pile up.
+    A batch that fails on a busy database goes back to the buffer for the next flush.
+    '''
+
+    def __init__(self, max_batch: int, flush_ms: int, max_pending: int, shutdown_attempts: int = 5):
+        self.max_batch = max_batch
+        self.flush_ms = flush_ms
+        self.max_pending = max_pending
+        self.shutdown_attempts = shutdown_attempts
+        self.pending = deque()
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        self.stopping = False
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            # let the task finish its flush, cancelling it mid-insert could lose or repeat that batch
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+            self.stopping = False
+
+        for attempt in range(self.shutdown_attempts):
+            if await self.flush():
+                return
+            await asyncio.sleep(self.flush_ms / 1000)
+        logger.error(f"[LLMLogSink] gave up on {len(self.pending)} log rows at shutdown")
+
+    async def write(self, record: dict) -> str:
+        """ Queue a log row, returns its id """
+        # Every row gets every column, so a batch inserts as one executemany.
+        record = strip_redundant_fields(apply_response_policy({
+            "name": None,
+            "response": None,
+            "answer": None,
+            "success": False,
+            "cache_key": None,
+            "cache_hit": False,
+            **record,
+            "id": record.get("id") or str(uuid4()),
+            "created_at": record.get("created_at") or datetime.datetime.utcnow(),
+        }))
+
+        if not self.task:
+            # Not running (E.g. a one-off script), so write it now.
+            await self.insert([record])
+            return record["id"]
+
+        if len(self.pending) >= self.max_pending:
+            self.pending.popleft()
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning(f"[LLMLogSink] buffer full, dropped {self.dropped} log rows so far")
+
+        self.pending.append(record)
+        if len(self.pending) >= self.max_batch:
+            self.wakeup.set()
+        return record["id"]
+
+    async def run(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> bool:
+        """ Insert the buffered rows, returns False if a batch has to be retried """
+        while self.pending:
+            batch = [self.pending.popleft() for _ in range(min(self.max_batch, len(self.pending)))]
+            if not await self.insert(batch):
+                # ahead of whatever was queued meanwhile, for the next flush
+                self.pending.extendleft(reversed(batch))
+                return False
+        return True
+
+    async def insert(self, records) -> bool:
+        """ False if the rows weren't written but can be retried """
+        try:
+            async with get_async_session() as session:
+                await session.execute(insert(LLMLogTable), records)
+        except OperationalError as e:
+            # E.g. "database is locked" after the busy timeout
+            logger.warning(f"[LLMLogSink] Failed to write {len(records)} LLM logs, retrying: {e}")
+            return False
+        except Exception as e:
+            logger.error(f"[LLMLogSink] Failed to write {len(records)} LLM logs: {e}", exc_info=True)
+        return True
+
+
+llm_log_sink = LLMLogSink(
+    max_batch=settings.llm_log_batch_size,
+    flush_ms=settings.llm_log_flush_ms,
+    max_pending=settings.llm_log_max_pending,
+)
@@ -0,0 +1,188 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+from logger import logger
+
+
+''' A small Prometheus-style metrics registry, rendered in the text exposition format at /metrics '''
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.values = {}
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        for key, value in sorted(self.values.items()):
+            lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value) -> list:
+        return [f"{self.name}{format_labels(self.label_names, key)} {value}"]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = ()):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        if key not in self.values:
+            self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        series = self.values[key]
+        # counts are per bucket here, and made cumulative when rendered
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series["counts"][index] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        ''' Observe the duration of the block, with an "outcome" label of "success" or "error" when it has one '''
+        start = time.perf_counter()
+        outcome = 'success'
+        try:
+            yield
+        except BaseException:
+            outcome = 'error'
+            raise
+        finally:
+            if 'outcome' in self.label_names:
+                labels['outcome'] = outcome
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render_value(self, key, series):
+        lines = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets, series["counts"]):
+            cumulative += count
+            le = f'le="{bucket}"'
+            lines.append(f"{self.name}_bucket{format_labels(self.label_names, key, le)} {cumulative}")
+        le = 'le="+Inf"'
+        lines.append(f"{self.name}_bucket{format_labels(self.label_names, key, le)} {series['count']}")
+        lines.append(f"{self.name}_sum{format_labels(self.label_names, key)} {series['sum']}")
+        lines.append(f"{self.name}_count{format_labels(self.label_names, key)} {series['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labels=()) -> Counter:
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()) -> Gauge:
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=()) -> Histogram:
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def collector(self, func):
+        ''' Register an async function that updates gauges just before each scrape '''
+        self.collectors.append(func)
+        return func
+
+    async def render(self) -> str:
+        for collect in self.collectors:
+            try:
+                await collect()
+            except Exception as e:
+                logger.error(f"[metrics] collector {collect.__name__} failed: {e}", exc_info=True)
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+latency_buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+query_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+llm_request_duration = registry.histogram(
+    'llm_request_duration_seconds', 'Provider call latency, including retries', ('model', 'name', 'outcome'), latency_buckets,
+)
+llm_tokens = registry.counter('llm_tokens_total', 'Tokens used, from completion.usage', ('model', 'name', 'kind'))
+llm_endpoint_latency = registry.gauge('llm_endpoint_latency_seconds', 'Recent latency per routed endpoint, as an EWMA and a p95', ('endpoint', 'stat'))
+llm_hedged_requests = registry.counter('llm_hedged_requests_total', 'Calls hedged to a second endpoint, by which one answered first', ('name', 'winner'))
+llm_fallbacks = registry.counter('llm_fallbacks_total', 'Calls that fell back to another endpoint after an error', ('name',))
+llm_cache_hits = registry.counter('llm_cache_hits_total', 'Calls answered from a cache', ('name', 'tier'))
+semantic_cache_events = registry.counter('semantic_cache_events_total', 'Semantic cache hits, misses, evictions and expirations', ('name', 'event'))
+
+db_query_duration = registry.histogram('db_query_duration_seconds', 'SQL statement latency', ('operation',), query_buckets)
+
+job_queue_depth = registry.gauge('job_queue_depth', 'Jobs in the ai_job table, by status', ('status',))
+job_duration = registry.histogram('job_duration_seconds', 'Background job run time', ('name', 'outcome'), latency_buckets)
+
+websocket_connections = registry.gauge('websocket_connections', 'Open dashboard websockets')
+websocket_sent_bytes = registry.counter('websocket_sent_bytes_total', 'Bytes sent to dashboard websockets', ('kind',))
+websocket_sent_messages = registry.counter('websocket_sent_messages_total', 'Messages sent to dashboard websockets', ('kind',))
+
+
+def percentile(values: list, fraction: float) -> float:
+    ''' Nearest-rank percentile of raw samples, E.g. for benchmark reports. 0 for no samples '''
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def record_usage(model: str, name: str, usage):
+    ''' Count a completion's tokens, `usage` may be None (E.g. images) '''
+    if usage is None:
+        return
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        if getattr(usage, kind, None):
+            llm_tokens.inc(getattr(usage, kind), model=model, name=name or '', kind=kind.replace('_tokens', ''))
@@ -0,0 +1,80 @@
+''' Brings the database schema up to date.
+
+Usage: `python -m migrate`
+
+Creates any missing tables from `models.py`, then applies the pending modules in
+`migrations/` and records them in `ai_schema_migrations`. The app runs this on startup
+for SQLite; for Postgres, run it as a deploy step. Either way it holds a lock while it runs
+(see `migration_lock`), so several workers starting at once on a fresh database take turns.
+'''
+import fcntl
+import importlib
+import pkgutil
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+import migrations
+from apps.main.models import Base
+from database import get_engine
+from logger import logger
+
+
+def get_migrations():
+    names = sorted(module.name for module in pkgutil.iter_modules(migrations.__path__))
+    return [(name, importlib.import_module(f"migrations.{name}")) for name in names]
+
+
+# pg_advisory_lock key, arbitrary but the same in every process
+MIGRATION_LOCK_KEY = 7411_2001
+
+
+@contextmanager
+def migration_lock(bind):
+    ''' A file lock next to the SQLite database, a session advisory lock on Postgres '''
+    if bind.dialect.name == 'postgresql':
+        with bind.connect() as connection:
+            connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            connection.commit()
+            try:
+                yield
+            finally:
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+                connection.commit()
+    elif bind.dialect.name == 'sqlite' and bind.url.database not in (None, '', ':memory:'):
+        with open(f"{bind.url.database}.migrate.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        yield  # an in-memory database only has the one process
+
+
+def run_migrations(bind=None):
+    bind = bind or get_engine()
+    with migration_lock(bind):
+        apply_migrations(bind)
+
+
+def apply_migrations(bind):
+    Base.metadata.create_all(bind=bind)
+
+    with bind.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS ai_schema_migrations (version VARCHAR PRIMARY KEY, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+        ))
+        applied = set(connection.execute(text("SELECT version FROM ai_schema_migrations")).scalars())
+
+    for name, module in get_migrations():
+        if name in applied:
+            continue
+        with bind.begin() as connection:
+            module.upgrade(connection)
+            connection.execute(text("INSERT INTO ai_schema_migrations (version) VALUES (:version)"), {"version": name})
+        logger.info(f"[migrate] applied {name}")
+
+
+if __name__ == "__main__":
+    run_migrations()
@@ -0,0 +1,62 @@
+''' Moves legacy `ai_haiku_image.image_b64` rows into the blob store.
+
+Usage: `python -m migrate_images`, though `migrations/m0004_image_blobs.py` also runs it
+on startup / `python -m migrate`.
+
+Safe to re-run: rows that already have a `blob_hash` are skipped, and the
+`image_b64` column is only dropped once every row has been moved.
+'''
+import base64
+
+from sqlalchemy import inspect, text
+
+from blobstore import blob_store, guess_mime_type
+from database import get_engine
+from logger import logger
+
+
+def migrate_images(connection=None, batch_size: int = 100):
+    if connection is None:
+        with get_engine().begin() as connection:
+            return migrate_images(connection, batch_size)
+
+    columns = {column['name'] for column in inspect(connection).get_columns('ai_haiku_image')}
+    if 'image_b64' not in columns:
+        logger.info("[migrate_images] ai_haiku_image has no image_b64 column, nothing to do.")
+        return 0
+
+    for column, column_type in [('blob_hash', 'VARCHAR(64)'), ('size', 'INTEGER'), ('mime_type', 'VARCHAR')]:
+        if column not in columns:
+            connection.execute(text(f"ALTER TABLE ai_haiku_image ADD COLUMN {column} {column_type}"))
+
+    migrated = 0
+    while True:
+        rows = connection.execute(
+            text("SELECT id, image_b64 FROM ai_haiku_image WHERE blob_hash IS NULL AND image_b64 IS NOT NULL LIMIT :limit"),
+            {"limit": batch_size}
+        ).all()
+        if not rows:
+            break
+
+        for image_id, image_b64 in rows:
+            image_bytes = base64.b64decode(image_b64)
+            blob_hash = blob_store.put(image_bytes)
+            connection.execute(
+                text("UPDATE ai_haiku_image SET blob_hash = :blob_hash, size = :size, mime_type = :mime_type WHERE id = :id"),
+                {"blob_hash": blob_hash, "size": len(image_bytes), "mime_type": guess_mime_type(image_bytes), "id": image_id}
+            )
+        migrated += len(rows)
+        logger.info(f"[migrate_images] moved {migrated} images into the blob store")
+
+    remaining = connection.execute(text("SELECT COUNT(*) FROM ai_haiku_image WHERE blob_hash IS NULL")).scalar()
+    if remaining:
+        logger.error(f"[migrate_images] {remaining} images could not be migrated, keeping image_b64.")
+        return migrated
+    connection.execute(text("ALTER TABLE ai_haiku_image DROP COLUMN image_b64"))
+
+    logger.info(f"[migrate_images] done, migrated {migrated} images and dropped image_b64.")
+    return migrated
+
+
+if __name__ == "__main__":
+    migrate_images()
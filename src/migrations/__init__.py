@@ -0,0 +1,6 @@
+''' Schema migrations, applied in file name order by `python -m migrate`.
+
+Each module defines `upgrade(connection)`, which runs inside its own transaction. Since
+`create_all` already builds fresh databases from `models.py`, migrations must be no-ops
+on a schema that is already up to date (E.g. `CREATE INDEX IF NOT EXISTS`).
+'''
@@ -0,0 +1,10 @@
+''' ai_llm_logs.cache_key / cache_hit, for databases created before the response cache '''
+from sqlalchemy import inspect, text
+
+
+def upgrade(connection):
+    columns = {column['name'] for column in inspect(connection).get_columns('ai_llm_logs')}
+    if 'cache_key' not in columns:
+        connection.execute(text("ALTER TABLE ai_llm_logs ADD COLUMN cache_key VARCHAR"))
+    if 'cache_hit' not in columns:
+        connection.execute(text("ALTER TABLE ai_llm_logs ADD COLUMN cache_hit BOOLEAN DEFAULT FALSE"))
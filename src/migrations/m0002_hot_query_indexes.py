@@ -0,0 +1,21 @@
+''' Indexes for the foreign keys and created_at orderings the dashboard and log queries use '''
+from sqlalchemy import text
+
+
+indexes = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_ai_project_uuid ON ai_project (uuid)",
+    "CREATE INDEX IF NOT EXISTS ix_ai_haiku_project_id_created_at ON ai_haiku (project_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_ai_haiku_image_prompt_haiku_id_created_at ON ai_haiku_image_prompt (haiku_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_ai_haiku_image_prompt_id_created_at ON ai_haiku_image (haiku_image_prompt_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_ai_haiku_critique_haiku_id_created_at ON ai_haiku_critique (haiku_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_ai_llm_logs_chain_id_created_at ON ai_llm_logs (chain_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_ai_llm_logs_name_created_at ON ai_llm_logs (name, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_ai_llm_logs_cache_key_created_at ON ai_llm_logs (cache_key, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_ai_llm_logs_created_at ON ai_llm_logs (created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_ai_job_status_run_after ON ai_job (status, run_after)",
+]
+
+
+def upgrade(connection):
+    for statement in indexes:
+        connection.execute(text(statement))
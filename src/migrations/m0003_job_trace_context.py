@@ -0,0 +1,8 @@
+''' ai_job.trace_context, for databases created before tracing '''
+from sqlalchemy import inspect, text
+
+
+def upgrade(connection):
+    columns = {column['name'] for column in inspect(connection).get_columns('ai_job')}
+    if 'trace_context' not in columns:
+        connection.execute(text("ALTER TABLE ai_job ADD COLUMN trace_context JSON"))
@@ -0,0 +1,6 @@
+''' ai_haiku_image.image_b64 -> the blob store, for databases created before blobstore.py '''
+from migrate_images import migrate_images
+
+
+def upgrade(connection):
+    migrate_images(connection)
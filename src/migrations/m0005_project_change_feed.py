@@ -0,0 +1,12 @@
+''' The dashboard change feed: ai_project_change, and ai_project.change_seq for projects that predate it '''
+from sqlalchemy import inspect, text
+
+from apps.main.models import ProjectChangeTable
+
+
+def upgrade(connection):
+    ProjectChangeTable.__table__.create(connection, checkfirst=True)
+
+    project_columns = {column['name'] for column in inspect(connection).get_columns('ai_project')}
+    if 'change_seq' not in project_columns:
+        connection.execute(text("ALTER TABLE ai_project ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0"))
@@ -0,0 +1,249 @@
+import datetime
+import hashlib
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from sqlalchemy import select
+
+from config import settings
+from logger import logger
+from metrics import semantic_cache_events
+
+from database import get_async_session
+from apps.main.models import LLMLogTable
+
+if TYPE_CHECKING:
+    import numpy as np  # imported where it's used, so the semantic cache costs nothing at startup when it's off
+
+
+# words that rarely change what a prompt asks for, E.g. "a cat in rain" vs "cat in the rain"
+stopwords = {
+    'a', 'an', 'the', 'of', 'in', 'on', 'at', 'to', 'for', 'with', 'and', 'or', 'is', 'are',
+    'be', 'this', 'that', 'it', 'its', 'by', 'from', 'as', 'into', 'about', 'some',
+}
+
+
+def get_prompt_text(messages) -> str:
+    ''' The text of every message, in order '''
+    parts = []
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, list):
+            content = ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+        parts.append(content or '')
+    return '\n'.join(parts)
+
+
+def normalize_prompt(text: str) -> list:
+    ''' Lowercased words, without punctuation or stopwords '''
+    return [word for word in re.findall(r"[a-z0-9']+", text.lower()) if word not in stopwords]
+
+
+class Embedder:
+    dims: int
+
+    def embed(self, text: str) -> 'np.ndarray':
+        ''' A unit length float32 vector '''
+        raise NotImplementedError
+
+
+class HashingEmbedder(Embedder):
+    '''
+    Hashes word unigrams and bigrams into `dims` buckets (with a sign, so collisions tend to
+    cancel out), with sublinear term frequencies. Needs no model or network.
+    '''
+
+    def __init__(self, dims: int):
+        self.dims = dims
+
+    def bucket(self, feature: str):
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, 'little')
+        return value % self.dims, 1.0 if value >> 63 else -1.0
+
+    def embed(self, text):
+        import numpy as np
+
+        words = normalize_prompt(text)
+        features = Counter(words)
+        features.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+
+        vector = np.zeros(self.dims, dtype=np.float32)
+        for feature, count in features.items():
+            index, sign = self.bucket(feature)
+            weight = 1 + np.log(count)
+            vector[index] += sign * (weight if ' ' not in feature else weight * 0.5)
+
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+embedders = {
+    'hashing': lambda: HashingEmbedder(settings.semantic_cache_dims),
+}
+
+
+def get_embedder() -> Embedder:
+    try:
+        return embedders[settings.semantic_cache_embedder]()
+    except KeyError:
+        raise ValueError(f"Unknown semantic cache embedder: {settings.semantic_cache_embedder}")
+
+
+@dataclass
+class SemanticMatch:
+    answer_text: str
+    log_id: str
+    similarity: float
+
+
+class VectorIndex:
+    '''
+    Answers to earlier calls for one (model, name), searched by cosine similarity. Holds at
+    most `max_entries`, evicting the least recently used; entries expire after `ttl_seconds`.
+    '''
+
+    def __init__(self, dims: int, max_entries: int, ttl_seconds: int):
+        import numpy as np
+
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.vectors = np.zeros((max_entries, dims), dtype=np.float32)
+        self.entries = []   # (answer_text, log_id, expires_at, last_used), row i of `vectors` is entries[i]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def remove(self, i: int):
+        ''' Swap the last row into slot i, so removal is O(dims) '''
+        last = len(self.entries) - 1
+        if i != last:
+            self.vectors[i] = self.vectors[last]
+            self.entries[i] = self.entries[last]
+        self.entries.pop()
+
+    def add(self, vector: 'np.ndarray', answer_text: str, log_id: str, expires_at: float = None) -> int:
+        ''' Returns how many entries were evicted to make room '''
+        evicted = 0
+        if len(self.entries) >= self.max_entries:
+            self.remove(min(range(len(self.entries)), key=lambda i: self.entries[i][3]))
+            evicted = 1
+
+        now = time.monotonic()
+        self.vectors[len(self.entries)] = vector
+        self.entries.append((answer_text, log_id, expires_at or now + self.ttl_seconds, now))
+        return evicted
+
+    def search(self, vector: 'np.ndarray'):
+        ''' The most similar unexpired entry as (similarity, index), or None '''
+        import numpy as np
+
+        if not self.entries:
+            return None
+
+        similarities = self.vectors[:len(self.entries)] @ vector
+        now = time.monotonic()
+        for i in np.argsort(similarities)[::-1]:
+            if self.entries[i][2] >= now:
+                return float(similarities[i]), int(i)
+        return None
+
+    def expire(self) -> int:
+        now = time.monotonic()
+        expired = [i for i, entry in enumerate(self.entries) if entry[2] < now]
+        for i in reversed(expired):
+            self.remove(i)
+        return len(expired)
+
+    def touch(self, i: int):
+        answer_text, log_id, expires_at, _ = self.entries[i]
+        self.entries[i] = (answer_text, log_id, expires_at, time.monotonic())
+
+
+class SemanticResponseCache:
+    '''
+    Finds an earlier answer to a prompt that is nearly the same as this one. Only used for
+    call names with a threshold in `semantic_cache_thresholds` (or all of them, with
+    `semantic_cache_default_threshold`), since for some calls (E.g. critiquing a haiku)
+    a small change in the prompt should change the answer.
+    An index is warmed from `ai_llm_logs` the first time its (model, name) is asked for.
+    '''
+
+    def __init__(self, embedder: Embedder, max_entries: int, ttl_seconds: int):
+        self.embedder = embedder
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.indexes = {}
+
+    def get_threshold(self, name: str):
+        return settings.semantic_cache_thresholds.get(name, settings.semantic_cache_default_threshold)
+
+    def is_enabled_for(self, name: str) -> bool:
+        return settings.semantic_cache_enabled and self.get_threshold(name) is not None
+
+    async def get_index(self, model: str, name: str) -> VectorIndex:
+        key = (model, name)
+        if key not in self.indexes:
+            self.indexes[key] = VectorIndex(self.embedder.dims, self.max_entries, self.ttl_seconds)
+            await self.load(model, name, self.indexes[key])
+        return self.indexes[key]
+
+    async def load(self, model: str, name: str, index: VectorIndex):
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl_seconds)
+        try:
+            async with get_async_session() as session:
+                logs = (await session.execute(
+                    select(LLMLogTable.id, LLMLogTable.messages, LLMLogTable.answer, LLMLogTable.created_at)
+                    .where(
+                        LLMLogTable.name == name,
+                        LLMLogTable.model == model,
+                        LLMLogTable.success == True,
+                        LLMLogTable.cache_hit == False,
+                        LLMLogTable.created_at >= since,
+                    )
+                    .order_by(LLMLogTable.created_at.desc())
+                    .limit(self.max_entries)
+                )).all()
+        except Exception as e:
+            logger.error(f"[SemanticResponseCache] Failed to load logs for name={name}: {e}", exc_info=True)
+            return
+
+        now_wall, now = datetime.datetime.utcnow(), time.monotonic()
+        for log in reversed(logs):
+            expires_at = now + self.ttl_seconds - (now_wall - log.created_at).total_seconds()
+            index.add(self.embedder.embed(get_prompt_text(log.messages)), log.answer, log.id, expires_at)
+        logger.info(f"[SemanticResponseCache] loaded {len(logs)} answers for model={model} name={name}")
+
+    async def get(self, model: str, name: str, messages):
+        ''' The closest earlier answer above the name's threshold, or None '''
+        if not self.is_enabled_for(name):
+            return None
+
+        index = await self.get_index(model, name)
+        semantic_cache_events.inc(index.expire(), name=name, event='expired')
+        found = index.search(self.embedder.embed(get_prompt_text(messages)))
+        if found is None or found[0] < self.get_threshold(name):
+            semantic_cache_events.inc(name=name, event='miss')
+            return None
+
+        similarity, i = found
+        index.touch(i)
+        semantic_cache_events.inc(name=name, event='hit')
+        answer_text, log_id, _, _ = index.entries[i]
+        return SemanticMatch(answer_text=answer_text, log_id=log_id, similarity=similarity)
+
+    async def add(self, model: str, name: str, messages, answer_text: str, log_id: str):
+        if not self.is_enabled_for(name):
+            return
+        index = await self.get_index(model, name)
+        semantic_cache_events.inc(index.add(self.embedder.embed(get_prompt_text(messages)), answer_text, log_id), name=name, event='evicted')
+
+
+semantic_cache = SemanticResponseCache(
+    get_embedder(),
+    max_entries=settings.semantic_cache_max_entries,
+    ttl_seconds=settings.semantic_cache_ttl_seconds,
+)
@@ -0,0 +1,108 @@
+''' Test setup: a throwaway SQLite database, blob store and log archive, and fake providers in-process '''
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# before anything imports config
+test_dir = tempfile.mkdtemp(prefix="ai_workflow_starter_tests_")
+os.environ.update({
+    "DB_ENGINE_URL": f"sqlite:///{test_dir}/test.sqlite",
+    "BLOB_STORE_PATH": os.path.join(test_dir, "blobs"),
+    "LLM_LOG_ARCHIVE_PATH": os.path.join(test_dir, "llm_log_archive"),
+    "EVENT_BUS_SOCKET_PATH": os.path.join(test_dir, "events.sock"),
+    "OPENAI_API_KEY": "test",
+    "EVENT_BUS_BACKEND": "local",
+    "TRACING_EXPORTER": "memory",
+    "STARTUP_WARMUP": "false",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import pytest
+
+
+@pytest.fixture(scope="session")
+def run():
+    ''' Runs a coroutine to completion. One loop for the session, since the async engine's pool is bound to it '''
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    from migrate import run_migrations
+
+    run_migrations()
+    return test_dir
+
+
+@pytest.fixture
+def fake_provider(monkeypatch):
+    '''
+    Every LLM client talks to an in-process `fakeopenai` app instead of the network, one app per
+    base_url (None is the default client). Yields base_url -> app, so a test can set an app's
+    latency / error rates on its `state`, or add one with `fakeopenai.create_app(...)` up front.
+    '''
+    import fakeopenai
+    import llm
+    import llmrouter
+    from openai import AsyncOpenAI
+
+    apps = {}
+
+    def create_llm_client(base_url=None, limits=None, http2=None, api_key=None):
+        app = apps.setdefault(base_url, fakeopenai.create_app())
+        return AsyncOpenAI(
+            api_key=api_key or "test",
+            base_url=base_url or "http://fakeopenai/v1",
+            max_retries=0,
+            http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=app)),
+        )
+
+    monkeypatch.setattr(llm, "create_llm_client", create_llm_client)
+    llm.get_llm_client.cache_clear()
+    llmrouter.get_endpoint_client.cache_clear()
+    apps[None] = fakeopenai.create_app()
+    yield apps
+    llm.get_llm_client.cache_clear()
+    llmrouter.get_endpoint_client.cache_clear()
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_http(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return httpx.get(url)
+        except httpx.TransportError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+@pytest.fixture
+def app_server():
+    ''' `uvicorn app:app` in a subprocess on the test database, yields (base_url, process) '''
+    port = get_free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_for_http(f"{base_url}/metrics", process)
+        yield base_url, process
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
@@ -0,0 +1,56 @@
+import asyncio
+
+from sqlalchemy import func, select
+
+from apps.main.models import ProjectChangeTable, ProjectTable, get_changes_since, get_project_seq, prune_change_feed, save_haiku
+from config import settings
+from database import get_async_session
+
+
+def create_project(run) -> int:
+    async def create():
+        async with get_async_session() as session:
+            project = ProjectTable(name="change feed")
+            session.add(project)
+            await session.flush()
+            return project.id
+
+    return run(create())
+
+
+def count_changes(run, project_id: int) -> int:
+    async def count():
+        async with get_async_session() as session:
+            return await session.scalar(select(func.count()).where(ProjectChangeTable.project_id == project_id))
+
+    return run(count())
+
+
+def test_each_project_gets_its_own_gapless_seq(run):
+    first, second = create_project(run), create_project(run)
+
+    async def write():
+        # interleaved, and concurrent within each project
+        await asyncio.gather(*[save_haiku(project_id, f"haiku {i}", "text") for i in range(5) for project_id in (first, second)])
+
+    run(write())
+    for project_id in (first, second):
+        changes = run(get_changes_since(project_id, 0))
+        assert [change["seq"] for change in changes] == [1, 2, 3, 4, 5]
+        assert run(get_project_seq(project_id)) == 5
+
+
+def test_prune_keeps_the_latest_max_gap_changes(run, monkeypatch):
+    monkeypatch.setattr(settings, "dashboard_feed_max_gap", 3)
+    project_id = create_project(run)
+    for i in range(5):
+        run(save_haiku(project_id, f"haiku {i}", "text"))
+
+    # pruning is a periodic job now, writes leave the feed alone
+    assert count_changes(run, project_id) == 5
+    assert run(prune_change_feed()) >= 2
+    assert count_changes(run, project_id) == 3
+
+    assert run(get_changes_since(project_id, 2)) is None  # pruned, so what came after can't be trusted
+    assert [change["seq"] for change in run(get_changes_since(project_id, 3))] == [4, 5]
+    assert run(get_project_seq(project_id)) == 5
@@ -0,0 +1,77 @@
+import asyncio
+import signal
+import subprocess
+import time
+
+import httpx
+import pytest
+from websockets.asyncio.client import connect
+
+
+def get_open_websockets(base_url: str) -> float:
+    metrics = httpx.get(f"{base_url}/metrics").text
+    return next(float(line.split()[1]) for line in metrics.splitlines() if line.startswith("websocket_connections "))
+
+
+def create_project(base_url: str) -> int:
+    return httpx.post(f"{base_url}/projects/", json={"name": "dashboard test"}).json()["project_id"]
+
+
+def test_closed_dashboard_is_unregistered(run, app_server):
+    base_url, _ = app_server
+    project_id = create_project(base_url)
+
+    async def open_and_close():
+        async with connect(f"{base_url.replace('http', 'ws')}/projects/dashboard/{project_id}") as websocket:
+            assert b'"snapshot"' in (await websocket.recv()).encode()
+            assert get_open_websockets(base_url) == 1
+
+    run(open_and_close())
+    deadline = time.monotonic() + 5
+    while get_open_websockets(base_url) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert get_open_websockets(base_url) == 0
+
+
+def test_shutdown_with_open_dashboard(run, app_server):
+    base_url, process = app_server
+    project_id = create_project(base_url)
+
+    async def watch_then_stop():
+        async with connect(f"{base_url.replace('http', 'ws')}/projects/dashboard/{project_id}") as websocket:
+            await websocket.recv()
+            process.terminate()
+            await asyncio.wait_for(websocket.wait_closed(), 10)
+        try:
+            return process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            return None
+
+    # uvicorn re-raises the signal once it has shut down gracefully
+    assert run(watch_then_stop()) in (0, -signal.SIGTERM), "uvicorn should exit on SIGTERM with a dashboard open"
+
+
+def test_failed_stream_ends_its_partial(run, monkeypatch):
+    from apps.main import routes
+
+    published = []
+
+    async def publish(channel, message):
+        published.append(message)
+
+    async def failing_stream(**kwargs):
+        yield {"type": "partial", "data": {"title": "An old"}}
+        raise RuntimeError("provider went away")
+
+    monkeypatch.setattr(routes.event_bus, "publish", publish)
+    monkeypatch.setattr(routes, "ask_llm_stream", failing_stream)
+
+    async def generate():
+        async for _ in routes.stream_haiku(routes.HaikuRequest(project_id=1, description="a pond"), "stream-1", "chain-1"):
+            pass
+
+    with pytest.raises(RuntimeError):
+        run(generate())
+    partials = [message["partial"] for message in published]
+    assert [(partial["stream_id"], partial["done"]) for partial in partials] == [("stream-1", False), ("stream-1", True)]
+    assert partials[-1]["data"]["error"] == "provider went away"
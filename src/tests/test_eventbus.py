@@ -0,0 +1,80 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from eventbus import UnixSocketEventBus
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A worker on the bus: joins it and, if given a channel, publishes a numbered tick on it every 50ms.
+WORKER = '''
+import asyncio, os, sys
+from eventbus import UnixSocketEventBus
+
+async def main(socket_path, channel=None):
+    bus = UnixSocketEventBus(socket_path, reconnect_delay=0.1)
+    await bus.start()
+    tick = 0
+    while True:
+        await asyncio.sleep(0.05)
+        if channel:
+            tick += 1
+            await bus.publish(channel, {"tick": tick, "pid": os.getpid()})
+
+asyncio.run(main(*sys.argv[1:]))
+'''
+
+
+def start_worker(*args) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-c", WORKER, *args], cwd=SRC_DIR)
+
+
+def wait_for(predicate, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_events_cross_processes_and_survive_the_broker(run):
+    socket_path = os.path.join(tempfile.mkdtemp(prefix="eventbus_test_"), "events.sock")
+    broker = start_worker(socket_path)
+    publisher = None
+    bus = UnixSocketEventBus(socket_path, reconnect_delay=0.1)
+
+    async def receive_ticks(queue, count: int) -> list:
+        ticks = []
+        while len(ticks) < count:
+            ticks.append(await asyncio.wait_for(queue.get(), timeout=10))
+        return ticks
+
+    async def scenario():
+        async with bus.subscribe("ticks") as queue:
+            ticks = await receive_ticks(queue, 3)
+            assert {tick["pid"] for tick in ticks} == {publisher.pid}
+            assert not bus.server, "the first worker holds the lock, so it's the broker"
+
+            broker.send_signal(signal.SIGKILL)
+            broker.wait()
+            # drop what was in flight, then the publisher's ticks have to come back through a new broker
+            while not queue.empty():
+                queue.get_nowait()
+            ticks = await receive_ticks(queue, 3)
+            assert {tick["pid"] for tick in ticks} == {publisher.pid}
+            assert ticks == sorted(ticks, key=lambda tick: tick["tick"])
+
+    try:
+        wait_for(lambda: os.path.exists(socket_path))
+        publisher = start_worker(socket_path, "ticks")
+        run(bus.start())
+        run(scenario())
+    finally:
+        run(bus.stop())
+        for process in (broker, publisher):
+            if process and process.poll() is None:
+                process.kill()
+                process.wait()
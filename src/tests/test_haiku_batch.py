@@ -0,0 +1,64 @@
+from uuid import uuid4
+
+import llmbatch
+from apps.main.models import ProjectTable, get_project_data
+from apps.main.routes import poll_haiku_batch_chunk, process_haiku_batch_chunk
+from database import get_async_session
+from jobs import get_job
+from llmbatch import LocalBatchBackend
+
+
+class SlowBatchBackend(LocalBatchBackend):
+    ''' Still running on the first poll of each batch '''
+
+    def __init__(self):
+        super().__init__()
+        self.submitted = []
+        self.polled = set()
+
+    async def submit(self, lines):
+        batch_id = await super().submit(lines)
+        self.submitted.append(batch_id)
+        return batch_id
+
+    async def poll(self, batch_id):
+        if batch_id not in self.polled:
+            self.polled.add(batch_id)
+            return None
+        return await super().poll(batch_id)
+
+
+def test_offline_chunk_is_submitted_once_and_polled_from_rescheduled_jobs(run, monkeypatch):
+    backend = SlowBatchBackend()
+    monkeypatch.setattr(llmbatch, "llm_batch_backend", backend)
+
+    async def create_project():
+        async with get_async_session() as session:
+            project = ProjectTable(name="offline batch")
+            session.add(project)
+            await session.flush()
+            return project.id
+
+    project_id = run(create_project())
+    chunk = dict(project_id=project_id, batch_id=str(uuid4()), start=0, descriptions=["a pond", "a frog"], critique=True, offline=True)
+
+    submitted = run(process_haiku_batch_chunk(**chunk))
+    retried = run(process_haiku_batch_chunk(**chunk))
+    assert retried["poll_job_id"] == submitted["poll_job_id"]
+    assert len(backend.submitted) == 1
+
+    # what the worker would do: run each queued poll job, until the chunk is saved
+    result, stages = submitted, []
+    while "poll_job_id" in result:
+        payload = run(get_job(result["poll_job_id"]))["payload"]
+        stages.append((payload["stage"], payload.get("polls", 0)))
+        result = run(poll_haiku_batch_chunk(**payload))
+        if payload["stage"] == "haikus" and not result.get("pending"):
+            # a retried poll finds the follow-ups it already submitted
+            assert run(poll_haiku_batch_chunk(**payload))["poll_job_id"] == result["poll_job_id"]
+
+    assert stages == [("haikus", 0), ("haikus", 1), ("follow_ups", 0), ("follow_ups", 1)]
+    assert len(backend.submitted) == 2
+    assert len(result["haiku_ids"]) == 2 and result["failed"] == []
+    haikus = run(get_project_data(project_id))["haikus"]
+    assert all(haiku["critiques"] for haiku in haikus)
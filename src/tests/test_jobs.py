@@ -0,0 +1,104 @@
+import asyncio
+import datetime
+import sqlite3
+from types import SimpleNamespace
+from uuid import uuid4
+
+import httpx
+from sqlalchemy.exc import OperationalError
+
+import jobs
+from app import app
+from apps.main.models import ProjectTable, save_haiku
+from config import settings
+from database import get_async_session
+from jobs import JobWorker, get_job, job_handler
+
+
+@job_handler("test_slow_job")
+async def slow_job(seconds: float):
+    await asyncio.sleep(seconds)
+    return {"slept": seconds}
+
+
+def test_idempotency_keys_are_namespaced_per_endpoint(run):
+    async def scenario():
+        async with get_async_session() as session:
+            project = ProjectTable(name="idempotency")
+            session.add(project)
+            await session.flush()
+            project_id = project.id
+        haiku_id = await save_haiku(project_id, "title", "text")
+
+        headers = {"Idempotency-Key": str(uuid4())}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://app") as client:
+            critique = await client.post("/projects/haiku-critique", json={"haiku_id": haiku_id}, headers=headers)
+            retried = await client.post("/projects/haiku-critique", json={"haiku_id": haiku_id}, headers=headers)
+            image = await client.post("/projects/generate-image", json={"prompt_id": str(uuid4()), "haiku_id": haiku_id}, headers=headers)
+        return critique.json()["job_id"], retried.json()["job_id"], image.json()["job_id"]
+
+    critique_job_id, retried_job_id, image_job_id = run(scenario())
+    assert retried_job_id == critique_job_id
+    assert image_job_id != critique_job_id
+    assert run(get_job(image_job_id))["name"] == "process_image_generation"
+
+
+def test_heartbeat_survives_a_failed_extension(run, monkeypatch):
+    monkeypatch.setattr(settings, "jobs_visibility_timeout", 0.15)
+    extensions = []
+
+    async def extend_job_lock(job_id, worker_id):
+        extensions.append(job_id)
+        if len(extensions) == 1:
+            raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(jobs, "extend_job_lock", extend_job_lock)
+    job = SimpleNamespace(
+        id=str(uuid4()), name="test_slow_job", payload={"seconds": 0.3}, attempts=1, max_attempts=1,
+        run_after=datetime.datetime.utcnow(), trace_context=None,
+    )
+    run(JobWorker(1).run_job(job))
+
+    # one beat every 50ms over a 300ms job: it kept going after the first one failed
+    assert len(extensions) >= 3
+
+
+def test_slot_keeps_running_after_complete_job_fails(run, monkeypatch):
+    monkeypatch.setattr(settings, "jobs_poll_interval", 0.01)
+    queued = [
+        SimpleNamespace(
+            id=str(uuid4()), name="test_slow_job", payload={"seconds": 0}, attempts=1, max_attempts=1,
+            run_after=datetime.datetime.utcnow(), trace_context=None,
+        )
+        for _ in range(2)
+    ]
+    completed = []
+
+    async def claim_job(worker_id):
+        return queued.pop(0) if queued else None
+
+    async def complete_job(job_id, worker_id, result=None):
+        if not completed:
+            completed.append(None)
+            raise OperationalError("UPDATE ai_jobs ...", {}, sqlite3.OperationalError("database is locked"))
+        completed.append(job_id)
+
+    monkeypatch.setattr(jobs, "claim_job", claim_job)
+    monkeypatch.setattr(jobs, "complete_job", complete_job)
+    second_job_id = queued[1].id
+
+    async def scenario():
+        worker = JobWorker(1)
+        slot = asyncio.create_task(worker.run_slot())
+        for _ in range(100):
+            if second_job_id in completed:
+                break
+            await asyncio.sleep(0.01)
+        done = slot.done()
+        slot.cancel()
+        await asyncio.gather(slot, return_exceptions=True)
+        return done
+
+    slot_ended = run(scenario())
+    assert not slot_ended
+    assert completed == [None, second_job_id]
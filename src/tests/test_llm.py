@@ -0,0 +1,69 @@
+import asyncio
+from uuid import uuid4
+
+import llm
+from apps.main.schemas import Haiku
+from llm import ask_llm, ask_llm_stream
+from tracing import tracer, trace_id_for_chain
+
+
+def get_spans(run, chain_id) -> dict:
+    run(tracer.flush())
+    return {span.name: span for span in tracer.exporter.get_trace(trace_id_for_chain(chain_id))}
+
+
+def test_ask_llm_is_traced(run, fake_provider):
+    chain_id = str(uuid4())
+    answer, completion, returned_chain_id = run(ask_llm(
+        messages=[{"role": "user", "content": f"Generate a haiku about {chain_id}."}],
+        response_format=Haiku,
+        chain_id=chain_id,
+        name="haiku-generate",
+    ))
+
+    assert isinstance(answer, Haiku)
+    assert returned_chain_id == chain_id
+    assert fake_provider[None].state.stats["requests"] == 1
+
+    spans = get_spans(run, chain_id)
+    assert spans["llm.cache_lookup"].attributes["call_name"] == "haiku-generate"
+    assert spans["llm.request"].attributes["call_name"] == "haiku-generate"
+    assert spans["llm.request"].error is None
+
+
+def test_ask_llm_stream_is_traced(run, fake_provider):
+    chain_id = str(uuid4())
+
+    async def collect():
+        return [event async for event in ask_llm_stream(
+            messages=[{"role": "user", "content": f"Generate a haiku about {chain_id}."}],
+            response_format=Haiku,
+            chain_id=chain_id,
+            name="haiku-generate",
+        )]
+
+    events = run(collect())
+
+    assert events[-1]["type"] == "final"
+    assert isinstance(events[-1]["answer"], Haiku)
+    spans = get_spans(run, chain_id)
+    assert spans["llm.stream"].attributes["call_name"] == "haiku-generate"
+    assert spans["llm.stream"].error is None
+
+
+def test_identical_concurrent_calls_send_one_request(run, fake_provider, monkeypatch):
+    async def slow_semantic_lookup(model, name, messages, response_format):
+        # E.g. waiting on the semantic index's load: calls starting meanwhile must join, not send their own
+        await asyncio.sleep(0.05)
+        return None, None
+
+    monkeypatch.setattr(llm, "get_semantic_cache_hit", slow_semantic_lookup)
+    messages = [{"role": "user", "content": f"Generate a haiku about {uuid4()}."}]
+
+    async def ask_at_once():
+        return await asyncio.gather(*[ask_llm(messages=messages, response_format=Haiku, name="haiku-generate") for _ in range(5)])
+
+    answers = [answer for answer, _, _ in run(ask_at_once())]
+    assert fake_provider[None].state.stats["requests"] == 1
+    assert all(answer == answers[0] for answer in answers)
+    assert not llm.inflight_llm_calls
@@ -0,0 +1,77 @@
+import time
+from uuid import uuid4
+
+import fakeopenai
+from apps.main.schemas import Haiku
+from config import settings
+from llm import ask_llm
+from llmrouter import LLMRouter, llm_router
+from metrics import llm_fallbacks, llm_hedged_requests
+
+
+def route(monkeypatch, fake_provider, name: str, **apps):
+    ''' Route `name` to a fake endpoint per app, in order, and return their base urls '''
+    base_urls = []
+    for label, app in apps.items():
+        base_url = f"http://{label}-{uuid4().hex[:8]}/v1"
+        fake_provider[base_url] = app
+        base_urls.append(base_url)
+    routes = {name: [{"model": "gpt-4o-mini", "base_url": base_url, "api_key": "test"} for base_url in base_urls]}
+    monkeypatch.setattr(llm_router, "routes", {**llm_router.routes, **LLMRouter(routes).routes})
+    return base_urls
+
+
+def ask(run, name: str):
+    return run(ask_llm(
+        messages=[{"role": "user", "content": f"Generate a haiku about {uuid4()}."}],
+        response_format=Haiku,
+        name=name,
+        cache=False,
+    ))
+
+
+def test_slow_primary_is_hedged(run, fake_provider, monkeypatch):
+    monkeypatch.setattr(settings, "llm_hedge_min_samples", 5)
+    monkeypatch.setattr(settings, "llm_hedge_min_delay_ms", 50)
+    primary = fakeopenai.create_app(chat_latency="fixed:10")
+    secondary = fakeopenai.create_app(chat_latency="fixed:10")
+    route(monkeypatch, fake_provider, "hedge-test", primary=primary, secondary=secondary)
+
+    # enough fast answers for the primary to have a p95
+    for _ in range(5):
+        ask(run, "hedge-test")
+    assert secondary.state.stats["requests"] == 0
+
+    hedged_before = llm_hedged_requests.values.get(("hedge-test", "hedge"), 0)
+    primary.state.chat_latency = fakeopenai.parse_latency("fixed:3000")
+    started_at = time.perf_counter()
+    answer, _, _ = ask(run, "hedge-test")
+
+    assert isinstance(answer, Haiku)
+    assert time.perf_counter() - started_at < 1, "the slow primary should have been cancelled"
+    assert primary.state.stats["requests"] == 6
+    assert secondary.state.stats["requests"] == 1
+    assert llm_hedged_requests.values.get(("hedge-test", "hedge"), 0) == hedged_before + 1
+
+
+def test_failing_endpoint_falls_back(run, fake_provider, monkeypatch):
+    monkeypatch.setattr(settings, "llm_max_retries", 0)
+    monkeypatch.setattr(settings, "llm_endpoint_failure_threshold", 2)
+    failing = fakeopenai.create_app(error_rate=1.0)
+    healthy = fakeopenai.create_app()
+    failing_url, healthy_url = route(monkeypatch, fake_provider, "fallback-test", failing=failing, healthy=healthy)
+
+    fallbacks_before = llm_fallbacks.values.get(("fallback-test",), 0)
+    for _ in range(2):
+        answer, _, _ = ask(run, "fallback-test")
+        assert isinstance(answer, Haiku)
+
+    assert failing.state.stats["errors"] == 2
+    assert healthy.state.stats["requests"] == 2
+    assert llm_fallbacks.values.get(("fallback-test",), 0) == fallbacks_before + 2
+
+    # after llm_endpoint_failure_threshold failures in a row, it's skipped for the cooldown
+    assert [endpoint.base_url for endpoint in llm_router.get_endpoints("fallback-test", "gpt-4o-mini")] == [healthy_url, failing_url]
+    ask(run, "fallback-test")
+    assert failing.state.stats["requests"] == 2
+    assert llm_fallbacks.values.get(("fallback-test",), 0) == fallbacks_before + 2
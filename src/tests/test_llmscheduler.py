@@ -0,0 +1,140 @@
+import asyncio
+import time
+from uuid import uuid4
+
+import openai
+import pytest
+
+import fakeopenai
+import llm
+from config import settings
+from llmscheduler import LLMScheduler, PrioritySemaphore, TokenBucket, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+
+
+def send_to(client):
+    return lambda: client.chat.completions.with_raw_response.create(
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": "scheduler test"}],
+    )
+
+
+def spy_retry_delays(monkeypatch, scheduler: LLMScheduler) -> list:
+    delays = []
+    get_retry_delay = scheduler.get_retry_delay
+
+    def record(attempt, error):
+        delays.append(get_retry_delay(attempt, error))
+        return delays[-1]
+
+    monkeypatch.setattr(scheduler, "get_retry_delay", record)
+    return delays
+
+
+def test_priority_semaphore_serves_lowest_priority_first(run):
+    semaphore = PrioritySemaphore(1)
+    order = []
+
+    async def worker(label: str, priority: int):
+        await semaphore.acquire(priority)
+        order.append(label)
+        await asyncio.sleep(0)
+        semaphore.release()
+
+    async def scenario():
+        await semaphore.acquire(PRIORITY_INTERACTIVE)
+        waiters = [
+            asyncio.create_task(worker(label, priority))
+            for label, priority in [("bg1", PRIORITY_BACKGROUND), ("ui1", PRIORITY_INTERACTIVE), ("bg2", PRIORITY_BACKGROUND), ("ui2", PRIORITY_INTERACTIVE)]
+        ]
+        await asyncio.sleep(0)  # all four queued behind the held slot
+        semaphore.release()
+        await asyncio.gather(*waiters)
+
+    run(scenario())
+    assert order == ["ui1", "ui2", "bg1", "bg2"]
+    assert semaphore.value == 1
+
+
+def test_scheduler_runs_interactive_calls_ahead_of_background(run, fake_provider, monkeypatch):
+    monkeypatch.setattr(settings, "llm_max_concurrency", 1)
+    fake_provider[None].state.chat_latency = fakeopenai.parse_latency("fixed:20")
+    client = llm.create_llm_client()
+    scheduler = LLMScheduler()
+    order = []
+
+    async def call(label: str, priority: int):
+        await scheduler.run("gpt-4o-mini", send_to(client), priority=priority)
+        order.append(label)
+
+    async def scenario():
+        first = asyncio.create_task(call("first", PRIORITY_BACKGROUND))
+        await asyncio.sleep(0.005)  # holds the only slot
+        queued = [asyncio.create_task(call(f"bg{i}", PRIORITY_BACKGROUND)) for i in range(3)]
+        await asyncio.sleep(0)
+        queued += [asyncio.create_task(call(f"ui{i}", PRIORITY_INTERACTIVE)) for i in range(2)]
+        await asyncio.gather(first, *queued)
+
+    run(scenario())
+    assert order == ["first", "ui0", "ui1", "bg0", "bg1", "bg2"]
+
+
+def test_token_bucket_waits_for_refill_and_provider_resets(run):
+    bucket = TokenBucket(per_minute=1200)  # 20 per second
+
+    async def timed_acquire(amount: float) -> float:
+        started_at = time.monotonic()
+        await bucket.acquire(amount)
+        return time.monotonic() - started_at
+
+    assert run(timed_acquire(1200)) < 0.05
+    assert 0.4 < run(timed_acquire(10)) < 0.7  # 10 tokens at 20/s
+
+    bucket.update(remaining=0, reset_seconds=0.3)
+    assert bucket.tokens <= 0
+    assert 0.25 < run(timed_acquire(1)) < 0.6
+
+
+def test_rate_limited_call_is_retried_after_retry_after(run, fake_provider, monkeypatch):
+    monkeypatch.setattr(settings, "llm_max_retries", 3)
+    app = fake_provider[None]
+    app.state.rate_limit_rate = 1.0
+    client = llm.create_llm_client()
+    scheduler = LLMScheduler()
+    delays = spy_retry_delays(monkeypatch, scheduler)
+    send = send_to(client)
+    attempts = 0
+
+    def make_request():
+        nonlocal attempts
+        attempts += 1
+        if attempts == 3:
+            app.state.rate_limit_rate = 0.0  # the third attempt gets through
+        return send()
+
+    started_at = time.monotonic()
+    completion = run(scheduler.run(f"gpt-4o-mini-{uuid4().hex[:8]}", make_request))
+
+    assert completion.choices[0].message.content
+    assert attempts == 3
+    assert app.state.stats["rate_limited"] == 2
+    assert app.state.stats["requests"] == 3
+    assert delays == [0.2, 0.2]  # fakeopenai's retry-after-ms
+    assert time.monotonic() - started_at >= 0.4
+
+
+def test_server_errors_back_off_exponentially_then_give_up(run, fake_provider, monkeypatch):
+    monkeypatch.setattr(settings, "llm_max_retries", 3)
+    monkeypatch.setattr(settings, "llm_retry_base_delay", 0.02)
+    app = fake_provider[None]
+    app.state.error_rate = 1.0
+    scheduler = LLMScheduler()
+    delays = spy_retry_delays(monkeypatch, scheduler)
+
+    with pytest.raises(openai.InternalServerError):
+        run(scheduler.run("gpt-4o-mini", send_to(llm.create_llm_client())))
+
+    assert app.state.stats["errors"] == 4  # the first attempt and 3 retries
+    assert len(delays) == 3
+    for attempt, delay in enumerate(delays):
+        # jittered down to half of base * 2^attempt at most
+        assert 0.02 * 2 ** attempt * 0.5 <= delay <= 0.02 * 2 ** attempt
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import random
+import sqlite3
+from uuid import uuid4
+
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+import logsink
+from apps.main.models import LLMLogTable
+from database import get_async_session
+from logsink import LLMLogSink
+
+
+def get_logged_ids(run, name: str) -> list:
+    async def select_ids():
+        async with get_async_session() as session:
+            return (await session.scalars(select(LLMLogTable.id).where(LLMLogTable.name == name))).all()
+
+    return run(select_ids())
+
+
+def test_concurrent_writers_lose_and_repeat_nothing_across_shutdown(run, caplog):
+    name = f"stress-{uuid4()}"
+    # one sink per process that would share the database (the app, the workers...), flushing often
+    sinks = [LLMLogSink(max_batch=20, flush_ms=5, max_pending=100_000) for _ in range(4)]
+    written = []
+
+    async def writer(i):
+        for j in range(40):
+            written.append(await random.choice(sinks).write({"name": name, "model": "gpt-4o-mini", "chain_id": str(i), "messages": [{"n": j}], "success": True}))
+            await asyncio.sleep(random.random() / 200)
+
+    async def flush_at_once():
+        while any(sink.task for sink in sinks):
+            await asyncio.gather(*[sink.flush() for sink in sinks])
+            await asyncio.sleep(0.002)
+
+    async def scenario():
+        for sink in sinks:
+            await sink.start()
+        writers = [asyncio.create_task(writer(i)) for i in range(50)]
+        flusher = asyncio.create_task(flush_at_once())
+        await asyncio.sleep(0.1)
+        # shut down while the writers are still going, later rows are written one by one
+        await asyncio.gather(*[sink.stop() for sink in sinks])
+        await asyncio.gather(*writers, flusher)
+
+    with caplog.at_level(logging.WARNING, logger="logger"):
+        run(scenario())
+
+    logged = get_logged_ids(run, name)
+    assert len(written) == 50 * 40
+    assert sorted(logged) == sorted(written)
+    assert not [record for record in caplog.records if "LLMLogSink" in record.getMessage()]
+    assert all(not sink.pending for sink in sinks)
+
+
+def test_a_batch_that_hits_a_locked_database_is_retried(run, monkeypatch):
+    name = f"locked-{uuid4()}"
+    get_async_session = logsink.get_async_session
+    attempts = []
+
+    def locked_once():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise OperationalError("INSERT INTO ai_llm_logs ...", {}, sqlite3.OperationalError("database is locked"))
+        return get_async_session()
+
+    monkeypatch.setattr(logsink, "get_async_session", locked_once)
+    sink = LLMLogSink(max_batch=100, flush_ms=5, max_pending=1000)
+
+    async def scenario():
+        await sink.start()
+        ids = [await sink.write({"name": name, "model": "gpt-4o-mini", "chain_id": "locked", "messages": [], "success": True}) for _ in range(10)]
+        await sink.stop()
+        return ids
+
+    written = run(scenario())
+    assert len(attempts) >= 2
+    assert sorted(get_logged_ids(run, name)) == sorted(written)
@@ -0,0 +1,67 @@
+import base64
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+from sqlalchemy import create_engine
+
+import fakeopenai
+from blobstore import blob_store
+from migrate import get_migrations, run_migrations
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_concurrent_migrations_on_a_fresh_database():
+    database_path = os.path.join(tempfile.mkdtemp(prefix="migrate_test_"), "fresh.sqlite")
+    env = {**os.environ, "DB_ENGINE_URL": f"sqlite:///{database_path}"}
+
+    # like several workers starting at once
+    processes = [
+        subprocess.Popen([sys.executable, "-m", "migrate"], cwd=SRC_DIR, env=env, stderr=subprocess.PIPE, text=True)
+        for _ in range(6)
+    ]
+    for process in processes:
+        _, stderr = process.communicate(timeout=60)
+        assert process.returncode == 0, stderr
+
+    with sqlite3.connect(database_path) as connection:
+        applied = [version for version, in connection.execute("SELECT version FROM ai_schema_migrations ORDER BY version")]
+    assert applied == [name for name, _ in get_migrations()]
+
+
+def test_legacy_images_are_moved_to_the_blob_store_on_migrate():
+    database_path = os.path.join(tempfile.mkdtemp(prefix="migrate_test_"), "legacy.sqlite")
+    image_bytes = base64.b64decode(fakeopenai.get_noise_png_b64("32x32"))
+    with sqlite3.connect(database_path) as connection:
+        # ai_haiku_image as it was before blobstore.py
+        connection.execute("CREATE TABLE ai_haiku_image (id VARCHAR PRIMARY KEY, haiku_image_prompt_id VARCHAR, image_b64 TEXT, created_at DATETIME)")
+        connection.execute("INSERT INTO ai_haiku_image (id, image_b64) VALUES ('legacy', ?)", (base64.b64encode(image_bytes).decode(),))
+
+    run_migrations(create_engine(f"sqlite:///{database_path}"))
+
+    with sqlite3.connect(database_path) as connection:
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(ai_haiku_image)")}
+        blob_hash, size, mime_type = connection.execute("SELECT blob_hash, size, mime_type FROM ai_haiku_image").fetchone()
+    assert "image_b64" not in columns
+    assert (size, mime_type) == (len(image_bytes), "image/png")
+    assert blob_store.get(blob_hash) == image_bytes
+
+
+def test_projects_from_before_the_change_feed_get_a_feed_position():
+    database_path = os.path.join(tempfile.mkdtemp(prefix="migrate_test_"), "legacy.sqlite")
+    with sqlite3.connect(database_path) as connection:
+        # ai_project as it was before the dashboard change feed
+        connection.execute("CREATE TABLE ai_project (id INTEGER PRIMARY KEY, uuid VARCHAR, name VARCHAR, created_at DATETIME, updated_at DATETIME)")
+        connection.execute("INSERT INTO ai_project (id, name) VALUES (1, 'legacy')")
+
+    run_migrations(create_engine(f"sqlite:///{database_path}"))
+
+    with sqlite3.connect(database_path) as connection:
+        assert connection.execute("SELECT id, change_seq FROM ai_project").fetchall() == [(1, 0)]
+        change_columns = {row[1] for row in connection.execute("PRAGMA table_info(ai_project_change)")}
+        indexes = {row[1] for row in connection.execute("PRAGMA index_list(ai_project_change)")}
+    assert {"project_id", "seq"} <= change_columns
+    assert "ix_ai_project_change_project_id_seq" in indexes
@@ -0,0 +1,103 @@
+import base64
+from contextlib import contextmanager
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import event
+
+import fakeopenai
+from apps.main.models import (
+    LLMLogTable, ProjectTable, get_changes_since, get_haiku_by_id, get_project_data, get_project_haikus_page,
+    save_generated_image, save_haiku, save_haiku_critique, save_image_prompt,
+)
+from database import get_async_engine, get_async_session, get_engine
+from logarchive import get_chain_logs
+
+
+@contextmanager
+def capture_queries():
+    ''' The SELECTs sent while the block runs, as (statement, parameters) '''
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            queries.append((statement, parameters))
+
+    sync_engine = get_async_engine().sync_engine
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(sync_engine, "before_cursor_execute", before_cursor_execute)
+
+
+def get_query_plan(statement: str, parameters) -> list:
+    connection = get_engine().raw_connection()
+    try:
+        return [row[3] for row in connection.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()]
+    finally:
+        connection.close()
+
+
+def assert_uses_indexes(queries: list):
+    assert queries
+    for statement, parameters in queries:
+        plan = get_query_plan(statement, parameters)
+        for step in plan:
+            assert not step.startswith("SCAN"), f"full scan in {plan} for {statement}"
+            assert "TEMP B-TREE" not in step, f"sort without an index in {plan} for {statement}"
+
+
+@pytest.fixture
+def project(run):
+    ''' A project with a haiku that has an image prompt, an image and a critique '''
+    async def create():
+        async with get_async_session() as session:
+            project = ProjectTable(name="query plans")
+            session.add(project)
+            await session.flush()
+            project_id = project.id
+        haiku_id = await save_haiku(project_id, "title", "an old silent pond")
+        prompt_id = await save_image_prompt(haiku_id, "a frog")
+        await save_generated_image(prompt_id, base64.b64decode(fakeopenai.get_noise_png_b64("64x64")))
+        await save_haiku_critique(haiku_id, {"creativity_score": 5, "vocabulary_density": 0.5, "rizz_level": 3})
+        return project_id, haiku_id
+
+    return run(create())
+
+
+def test_project_data_uses_indexes(run, project):
+    project_id, _ = project
+    with capture_queries() as queries:
+        data = run(get_project_data(project_id))
+    assert data["haikus"][0]["image_prompts"][0]["images"]
+    assert_uses_indexes(queries)
+
+
+def test_haiku_by_id_uses_primary_key(run, project):
+    _, haiku_id = project
+    with capture_queries() as queries:
+        assert run(get_haiku_by_id(haiku_id))
+    assert_uses_indexes(queries)
+
+
+def test_paginated_haikus_and_change_feed_use_indexes(run, project):
+    project_id, _ = project
+    with capture_queries() as queries:
+        page = run(get_project_haikus_page(project_id, limit=1))
+        run(get_changes_since(project_id, 0))
+    assert page
+    assert_uses_indexes(queries)
+
+
+def test_chain_lookup_uses_index(run):
+    chain_id = str(uuid4())
+
+    async def save_log():
+        async with get_async_session() as session:
+            session.add(LLMLogTable(chain_id=chain_id, name="query-plans", model="gpt-4o-mini", messages=[], success=True))
+
+    run(save_log())
+    with capture_queries() as queries:
+        run(get_chain_logs(chain_id))
+    assert_uses_indexes(queries)
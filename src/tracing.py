@@ -0,0 +1,278 @@
+import asyncio
+import contextvars
+import functools
+import hashlib
+import json
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Optional
+
+import httpx
+
+from config import settings
+from logger import logger
+
+
+''' Spans, with a chain's chain_id as their trace id, so a slow chain can be broken down by stage '''
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def new_trace_id() -> str:
+    return os.urandom(16).hex()
+
+
+def new_span_id() -> str:
+    return os.urandom(8).hex()
+
+
+def trace_id_for_chain(chain_id) -> str:
+    ''' A chain_id uuid is its trace id as is, anything else is hashed into one '''
+    chain_id = str(chain_id)
+    hex_id = chain_id.replace('-', '').lower()
+    if len(hex_id) == 32 and all(c in '0123456789abcdef' for c in hex_id):
+        return hex_id
+    return hashlib.sha256(chain_id.encode()).hexdigest()[:32]
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    chain_id: Optional[str]
+    start_ns: int
+    end_ns: Optional[int] = None
+    attributes: dict = field(default_factory=dict)
+    error: Optional[str] = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def context(self) -> dict:
+        ''' What a child needs to continue this trace, E.g. in a background job '''
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "chain_id": self.chain_id}
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "chain_id": self.chain_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": self.end_ns and (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class SpanExporter:
+    async def export(self, spans: list):
+        raise NotImplementedError
+
+
+class MemorySpanExporter(SpanExporter):
+    ''' Keeps the latest `max_spans` in memory, see `GET /traces/{chain_id}` '''
+
+    def __init__(self, max_spans: int):
+        self.spans = deque(maxlen=max_spans)
+
+    async def export(self, spans):
+        self.spans.extend(spans)
+
+    def get_trace(self, trace_id: str) -> list:
+        return sorted((span for span in self.spans if span.trace_id == trace_id), key=lambda span: span.start_ns)
+
+
+class FileSpanExporter(SpanExporter):
+    ''' Appends spans to a JSON lines file '''
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, spans):
+        with open(self.path, 'a') as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), default=str) + '\n')
+
+    async def export(self, spans):
+        await asyncio.to_thread(self.write, spans)
+
+
+def to_otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OTLPSpanExporter(SpanExporter):
+    ''' Sends spans to an OpenTelemetry collector over OTLP/HTTP, JSON encoded '''
+
+    def __init__(self, endpoint: str, service_name: str):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.client = httpx.AsyncClient(timeout=10)
+
+    def to_otlp(self, span: Span) -> dict:
+        attributes = {**span.attributes, **({"chain_id": span.chain_id} if span.chain_id else {})}
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": key, "value": to_otlp_value(value)} for key, value in attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+
+    async def export(self, spans):
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": "ai_workflow_starter"}, "spans": [self.to_otlp(span) for span in spans]}],
+        }]}
+        response = await self.client.post(self.endpoint, json=payload)
+        response.raise_for_status()
+
+
+class Tracer:
+    '''
+    Creates spans and exports the finished ones in batches from a background task, like
+    `LLMLogSink`. Spans are created even with no exporter, since they also carry the
+    current chain_id down to `ask_llm` and into background jobs.
+    '''
+
+    def __init__(self, exporter: Optional[SpanExporter], flush_ms: int, max_pending: int):
+        self.exporter = exporter
+        self.flush_ms = flush_ms
+        self.pending = deque(maxlen=max_pending)
+        self.task = None
+
+    def start_span(self, name: str, chain_id=None, parent: dict = None, start_ns: int = None, **attributes) -> Span:
+        '''
+        Start a span without making it current (E.g. in an async generator, whose steps may run
+        in different contexts). It belongs to `chain_id`'s trace if given, otherwise to its
+        parent's: `parent` (a `Span.context()`, E.g. from another process) or the current span.
+        '''
+        if parent is None:
+            parent_span = current_span.get()
+            parent = parent_span and parent_span.context()
+
+        if chain_id is not None:
+            trace_id = trace_id_for_chain(chain_id)
+            if parent and parent["trace_id"] != trace_id:
+                parent = None  # a new chain starts a new trace
+        elif parent:
+            trace_id = parent["trace_id"]
+            chain_id = parent.get("chain_id")
+        else:
+            trace_id = new_trace_id()
+
+        return Span(
+            name=name,
+            trace_id=trace_id,
+            span_id=new_span_id(),
+            parent_id=parent and parent["span_id"],
+            chain_id=chain_id and str(chain_id),
+            start_ns=start_ns or time.time_ns(),
+            attributes=attributes,
+        )
+
+    def end_span(self, span: Span, end_ns: int = None):
+        span.end_ns = end_ns or time.time_ns()
+        if self.exporter:
+            self.pending.append(span)  # the oldest are dropped if the exporter can't keep up
+
+    @contextmanager
+    def span(self, name: str, chain_id=None, parent: dict = None, **attributes):
+        ''' A span around the block, current for anything it calls '''
+        span = self.start_span(name, chain_id=chain_id, parent=parent, **attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            current_span.reset(token)
+            self.end_span(span)
+
+    async def start(self):
+        if self.exporter:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_ms / 1000)
+            await self.flush()
+
+    async def flush(self):
+        while self.pending:
+            batch = [self.pending.popleft() for _ in range(min(512, len(self.pending)))]
+            try:
+                await self.exporter.export(batch)
+            except Exception as e:
+                logger.error(f"[Tracer] Failed to export {len(batch)} spans: {e}")
+
+
+def current_trace_context() -> Optional[dict]:
+    span = current_span.get()
+    return span and span.context()
+
+
+def current_chain_id() -> Optional[str]:
+    span = current_span.get()
+    return span and span.chain_id
+
+
+def traced(name: str = None):
+    ''' Run an async function in a span, named after the function by default '''
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with tracer.span(name or func.__name__):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+span_exporters = {
+    'none': lambda: None,
+    'memory': lambda: MemorySpanExporter(settings.tracing_memory_max_spans),
+    'file': lambda: FileSpanExporter(settings.tracing_file_path),
+    'otlp': lambda: OTLPSpanExporter(settings.tracing_otlp_endpoint, settings.tracing_service_name),
+}
+
+
+def get_span_exporter() -> Optional[SpanExporter]:
+    try:
+        return span_exporters[settings.tracing_exporter]()
+    except KeyError:
+        raise ValueError(f"Unknown tracing exporter: {settings.tracing_exporter}")
+
+
+tracer = Tracer(get_span_exporter(), flush_ms=settings.tracing_flush_ms, max_pending=settings.tracing_max_pending)
+span = tracer.span
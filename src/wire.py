@@ -0,0 +1,62 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+import orjson
+
+from config import settings
+
+
+''' How dashboard payloads are encoded on the wire, negotiated per websocket with `?format=` '''
+
+class WireFormat:
+    name: str
+    binary: bool   # sent as binary websocket frames, otherwise as text
+
+    def encode(self, data):
+        raise NotImplementedError
+
+    async def send(self, websocket, encoded):
+        if self.binary:
+            await websocket.send_bytes(encoded)
+        else:
+            await websocket.send_text(encoded)
+
+
+class JSONWireFormat(WireFormat):
+    ''' orjson, kept as str since it goes out as a text frame. Values it doesn't know are sent as str '''
+    name = 'json'
+    binary = False
+
+    def encode(self, data) -> str:
+        return orjson.dumps(data, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+class MessagePackWireFormat(WireFormat):
+    ''' Smaller and faster to parse than JSON, bytes values travel as raw binary rather than base64 '''
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, data) -> bytes:
+        return msgpack.packb(data, default=str, datetime=False)
+
+
+wire_formats = {
+    'json': JSONWireFormat(),
+    'msgpack': MessagePackWireFormat(),
+}
+
+
+def get_wire_format(name: str) -> WireFormat:
+    try:
+        return wire_formats[name]
+    except KeyError:
+        raise ValueError(f"Unknown wire format: {name}")
+
+
+# big payloads (snapshots) are encoded here, so the event loop keeps serving the other sockets meanwhile
+encode_pool = ThreadPoolExecutor(max_workers=settings.wire_encode_workers, thread_name_prefix='wire-encode')
+
+
+async def encode_off_loop(wire_format: WireFormat, data):
+    return await asyncio.get_running_loop().run_in_executor(encode_pool, wire_format.encode, data)
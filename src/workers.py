@@ -0,0 +1,56 @@
+''' Standalone background job worker.
+
+Usage: `python -m workers [--concurrency 8]`
+
+Run as many of these as you like next to the web app (with JOBS_RUN_IN_APP=false), and use
+EVENT_BUS_BACKEND=unix so the dashboards hear about what they finish.
+'''
+import argparse
+import asyncio
+import signal
+
+from apps.main.models import Base
+from apps.main.routes import schedule_change_feed_pruning  # importing the routes registers the job handlers
+from config import settings
+from eventbus import event_bus
+from imagederivatives import shutdown_derivative_pool
+from jobs import JobWorker, job_handlers
+from logarchive import schedule_log_compaction
+from logsink import llm_log_sink
+from migrate import run_migrations
+from logger import logger
+from tracing import tracer
+
+
+async def main(concurrency: int):
+    if settings.db_engine_url.startswith("sqlite"):
+        run_migrations()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await event_bus.start()
+    await llm_log_sink.start()
+    await tracer.start()
+    worker = JobWorker(concurrency)
+    await worker.start()
+    await schedule_log_compaction()
+    await schedule_change_feed_pruning()
+    logger.info(f"[workers] handling {sorted(job_handlers)}")
+
+    await stop.wait()
+
+    await worker.stop()
+    await llm_log_sink.stop()
+    await event_bus.stop()
+    await tracer.stop()
+    shutdown_derivative_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run background jobs from the queue.")
+    parser.add_argument("--concurrency", type=int, default=settings.jobs_worker_concurrency)
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency))
@@ -0,0 +1,174 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+from uuid import uuid4
+
+from pydantic import BaseModel
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from logger import logger
+
+from database import get_async_session
+from apps.main.models import WorkflowStepTable
+from jobs import job_handler
+from llm import ask_llm
+from llmscheduler import PRIORITY_BACKGROUND
+from tracing import span
+
+
+# name -> Workflow, so a queued run can find its workflow by name
+workflows = {}
+
+
+@dataclass
+class Step:
+    '''
+    One node of a workflow. Either a chat call, built by `prompt` (E.g. a `prompts.py` builder
+    returning (prompt_text, response_format)), or any other async work done by `run`. `save`
+    can store the answer and return what downstream steps should see instead.
+    Each of these is called with the `WorkflowRun`.
+    '''
+    name: str
+    depends_on: tuple = ()
+    prompt: Optional[Callable] = None   # (run) -> (prompt_text, response_format)
+    run: Optional[Callable] = None      # async (run) -> result
+    save: Optional[Callable] = None     # async (run, answer) -> result
+    when: Optional[Callable] = None     # (run) -> bool, the step is skipped (result None) when False
+    priority: int = PRIORITY_BACKGROUND
+
+
+class Workflow:
+    ''' A DAG of steps. Steps whose dependencies are done run concurrently '''
+
+    def __init__(self, name: str, steps: list):
+        self.name = name
+        self.steps = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError(f"Workflow {name} has two steps named {step.name}")
+            if (step.prompt is None) == (step.run is None):
+                raise ValueError(f"Step {step.name} needs exactly one of `prompt` or `run`")
+            self.steps[step.name] = step
+
+        for step in steps:
+            for dependency in step.depends_on:
+                if dependency not in self.steps:
+                    raise ValueError(f"Step {step.name} depends on unknown step {dependency}")
+        self.check_acyclic()
+
+        workflows[name] = self
+
+    def check_acyclic(self):
+        done, visiting = set(), set()
+
+        def visit(step_name):
+            if step_name in done:
+                return
+            if step_name in visiting:
+                raise ValueError(f"Workflow {self.name} has a cycle through {step_name}")
+            visiting.add(step_name)
+            for dependency in self.steps[step_name].depends_on:
+                visit(dependency)
+            visiting.discard(step_name)
+            done.add(step_name)
+
+        for step_name in self.steps:
+            visit(step_name)
+
+
+@dataclass
+class WorkflowRun:
+    workflow: Workflow
+    run_id: str                                   # also the chain_id of every inference call in the run
+    inputs: dict
+    results: dict = field(default_factory=dict)   # step name -> result, JSON-able so it can be checkpointed
+
+
+def to_result(value):
+    ''' Step results are kept as plain JSON, so a resumed run sees exactly what a fresh one would '''
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode='json')
+    return value
+
+
+async def get_checkpoints(run_id: str) -> dict:
+    async with get_async_session() as session:
+        rows = (await session.scalars(select(WorkflowStepTable).where(WorkflowStepTable.run_id == run_id))).all()
+        return {row.step: row.result for row in rows}
+
+
+async def save_checkpoint(run: WorkflowRun, step_name: str, result):
+    try:
+        async with get_async_session() as session:
+            session.add(WorkflowStepTable(run_id=run.run_id, workflow=run.workflow.name, step=step_name, result=result))
+            await session.commit()
+    except IntegrityError:
+        pass  # another attempt at this run got there first
+
+
+async def run_step(run: WorkflowRun, step: Step):
+    if step.when and not step.when(run):
+        return None
+
+    with span(f"workflow.step {step.name}", chain_id=run.run_id, workflow=run.workflow.name):
+        if step.run:
+            answer = await step.run(run)
+        else:
+            prompt_text, response_format = step.prompt(run)
+            answer, _, _ = await ask_llm(
+                messages=[{"role": "user", "content": prompt_text}],
+                response_format=response_format,
+                chain_id=run.run_id,
+                name=f"{run.workflow.name}.{step.name}",
+                priority=step.priority,
+            )
+
+        if step.save:
+            answer = await step.save(run, answer)
+        return to_result(answer)
+
+
+async def run_workflow(workflow: Workflow, inputs: dict, run_id: str = None) -> dict:
+    '''
+    Run every step of `workflow`, skipping the ones a previous attempt at `run_id` already
+    checkpointed. Returns the results by step name. If a step fails, the steps that don't
+    depend on it still finish (and are checkpointed) before its error is raised.
+    '''
+    run_id = run_id or str(uuid4())
+    run = WorkflowRun(workflow=workflow, run_id=run_id, inputs=inputs, results=await get_checkpoints(run_id))
+    if run.results:
+        logger.info(f"[run_workflow] resuming {workflow.name} run_id={run_id} after {sorted(run.results)}")
+
+    tasks = {}
+
+    async def execute(step: Step):
+        for dependency in step.depends_on:
+            await tasks[dependency]
+        if step.name in run.results:
+            return run.results[step.name]
+
+        result = await run_step(run, step)
+        run.results[step.name] = result
+        await save_checkpoint(run, step.name, result)
+        return result
+
+    for step in workflow.steps.values():
+        tasks[step.name] = asyncio.ensure_future(execute(step))
+    outcomes = await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    errors = [(name, outcome) for name, outcome in zip(tasks, outcomes) if isinstance(outcome, Exception)]
+    if errors:
+        failed = [name for name, _ in errors]
+        logger.error(f"[run_workflow] {workflow.name} run_id={run_id} steps not completed: {failed}")
+        raise errors[0][1]
+    return run.results
+
+
+@job_handler("run_workflow")
+async def process_workflow(workflow: str, run_id: str, inputs: dict):
+    """ Background job for a workflow run; a retried job resumes from the run's checkpoints """
+    if workflow not in workflows:
+        raise ValueError(f"No workflow named {workflow}")
+    await run_workflow(workflows[workflow], inputs, run_id=run_id)
+    return {"run_id": run_id}